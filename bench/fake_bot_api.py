@@ -0,0 +1,104 @@
+import asyncio
+import json
+import time
+from collections import Counter
+
+from aiohttp import web
+from telegram.request import BaseRequest, RequestData
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "TONPrivateWalletBot"}
+
+
+class FakeBotAPI(BaseRequest):
+    """In-process Bot API transport, answers every call after `latency` seconds without any network
+
+    Sent and edited messages are echoed back as Message objects, everything else returns True.
+    The results of answerInlineQuery are handed to whoever waits in `inline_answers`.
+    `app()` serves the same answers over HTTP, for bots running in other processes.
+    """
+
+    def __init__(self, latency: float = 0.02):
+        self.latency = latency
+        self.calls = Counter()
+        self.inline_answers = {}
+        self.rendered = Counter()
+        self._rendered_changed = None
+        self._message_id = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def inline_answer(self, query_id: str) -> asyncio.Future:
+        return self.inline_answers.setdefault(query_id, asyncio.get_running_loop().create_future())
+
+    async def do_request(self, url: str, method: str, request_data: RequestData = None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        parameters = request_data.parameters if request_data is not None else {}
+        return 200, json.dumps({"ok": True, "result": await self.call(url.rsplit("/", 1)[-1], parameters)}).encode()
+
+    def app(self) -> web.Application:
+        async def handle(request: web.Request) -> web.Response:
+            parameters = dict(await request.post()) if request.can_read_body else {}
+            return web.json_response({"ok": True, "result": await self.call(request.match_info["method"], parameters)})
+
+        app = web.Application()
+        app.router.add_post("/{token}/{method}", handle)
+        return app
+
+    async def wait_rendered(self, chat_id: int, count: int, timeout: float = 30):
+        """Waits until `count` messages were sent or edited in the chat"""
+        async def wait():
+            while self.rendered[chat_id] < count:
+                if self._rendered_changed is None:
+                    self._rendered_changed = asyncio.get_running_loop().create_future()
+                await asyncio.shield(self._rendered_changed)
+
+        await asyncio.wait_for(wait(), timeout)
+
+    async def call(self, api_method: str, parameters: dict):
+        self.calls[api_method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if api_method == "getMe":
+            result = BOT_USER
+        elif api_method in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            result = self._message(parameters)
+        elif api_method == "answerInlineQuery":
+            results = parameters["results"]
+            if isinstance(results, str):
+                results = json.loads(results)
+            future = self.inline_answer(parameters["inline_query_id"])
+            if not future.done():
+                future.set_result(results)
+            result = True
+        else:
+            result = True
+
+        if api_method in ("sendMessage", "editMessageText") and "chat_id" in parameters:
+            self.rendered[int(parameters["chat_id"])] += 1
+            if self._rendered_changed is not None:
+                self._rendered_changed.set_result(None)
+                self._rendered_changed = None
+        return result
+
+    def _message(self, parameters: dict):
+        if "inline_message_id" in parameters:
+            return True
+
+        chat_id = int(parameters["chat_id"])
+        message_id = parameters.get("message_id")
+        if message_id is None:
+            self._message_id += 1
+            message_id = self._message_id
+
+        return {
+            "message_id": int(message_id),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": parameters.get("text", ""),
+        }
@@ -0,0 +1,285 @@
+import asyncio
+import base64
+import hashlib
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+from tonsdk.boc import Cell, Slice
+from tonsdk.utils import Address, to_nano
+
+
+class FakeToncenter:
+    """Local stand-in for the toncenter endpoints the wallet uses
+
+    Accounts are created on first sight with `balance` TON. An external message is accepted
+    when its seqno matches the account seqno, and is applied (seqno bumped, sent value
+    debited and credited) `confirm_delay` seconds later, like a block being produced.
+    Every request waits `latency` seconds and fails with `error_code` at `error_rate`.
+    Any address answers the jetton get methods as a master, its wallets hold `jetton_balance`.
+    """
+
+    def __init__(self, latency: float = 0.05, error_rate: float = 0, error_code: int = 503,
+                 confirm_delay: float = 1, balance: float = 100, jetton_balance: int = 5_000_000):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.confirm_delay = confirm_delay
+        self.balance = to_nano(balance, "TON")
+        self.jetton_balance = jetton_balance
+
+        self.calls = Counter()
+        self.errors = Counter()
+        self._accounts = {}
+        self._inflight = set()
+        self._jetton_wallets = {}
+        self._lt = 1_000_000
+
+    def app(self, latency: float = None, error_rate: float = None) -> web.Application:
+        """An endpoint on the shared chain state, `latency` and `error_rate` override the defaults"""
+        behaviour = {
+            "latency": self.latency if latency is None else latency,
+            "error_rate": self.error_rate if error_rate is None else error_rate,
+        }
+
+        app = web.Application(client_max_size=2 ** 20)
+        app.router.add_post("/jsonRPC", lambda request: self._jsonrpc(request, **behaviour))
+        app.router.add_post("/runGetMethod", lambda request: self._run_get_method(request, **behaviour))
+        app.router.add_post("/sendBoc", lambda request: self._send_boc(request, **behaviour))
+        return app
+
+    # Accounts
+
+    def account(self, address: str) -> dict:
+        raw = Address(address).to_string(False)
+        account = self._accounts.get(raw)
+        if account is None:
+            account = self._accounts[raw] = {
+                "address": Address(raw).to_string(True, True, True),
+                "balance": self.balance,
+                "seqno": 0,
+                "active": False,
+                "lt": self._next_lt(),
+                "transactions": [],
+            }
+        return account
+
+    def _next_lt(self) -> int:
+        self._lt += 1000
+        return self._lt
+
+    def _address_information(self, address: str) -> dict:
+        account = self.account(address)
+        return {
+            "balance": str(account["balance"]),
+            "code": "te6cc" if account["active"] else "",
+            "data": "",
+            "frozen_hash": "",
+            "last_transaction_id": {"@type": "internal.transactionId", "lt": str(account["lt"]), "hash": ""},
+            "state": "active" if account["active"] else "uninitialized",
+        }
+
+    def _wallet_information(self, address: str) -> dict:
+        account = self.account(address)
+        return {
+            "wallet": account["active"],
+            "balance": str(account["balance"]),
+            "account_state": "active" if account["active"] else "uninitialized",
+            "seqno": account["seqno"],
+            "last_transaction_id": {"@type": "internal.transactionId", "lt": str(account["lt"]), "hash": ""},
+        }
+
+    # Requests
+
+    async def _respond(self, name: str, handler, latency: float, error_rate: float):
+        self.calls[name] += 1
+        if latency:
+            await asyncio.sleep(latency)
+
+        if error_rate and random.random() < error_rate:
+            self.errors[name] += 1
+            return web.json_response({"ok": False, "code": self.error_code, "error": "injected"}, status=self.error_code)
+
+        try:
+            result = handler()
+        except ValueError as e:
+            self.errors[name] += 1
+            return web.json_response({"ok": False, "code": 500, "error": str(e)}, status=500)
+
+        # A batch is a list of complete responses
+        if isinstance(result, list) and name == "jsonRPC batch":
+            return web.json_response(result)
+        return web.json_response({"ok": True, "result": result})
+
+    def _methods(self, params: dict):
+        return {
+            "getAddressInformation": lambda: self._address_information(params["address"]),
+            "getWalletInformation": lambda: self._wallet_information(params["address"]),
+            "getTransactions": lambda: self._transactions(params),
+            "runGetMethod": lambda: self._run_method(params),
+            "sendBoc": lambda: self._accept(base64.b64decode(params["boc"])),
+            "estimateFee": lambda: self._estimate_fee(params),
+        }
+
+    async def _jsonrpc(self, request: web.Request, **behaviour) -> web.Response:
+        payload = await request.json()
+        if isinstance(payload, list):
+            return await self._respond("jsonRPC batch", lambda: self._batch(payload), **behaviour)
+
+        method, params = payload["method"], payload.get("params", {})
+        handler = self._methods(params).get(method)
+        if handler is None:
+            self.calls[method] += 1
+            return web.json_response({"ok": False, "code": 404, "error": "unknown method"}, status=404)
+
+        return await self._respond(method, handler, **behaviour)
+
+    def _batch(self, payload: list):
+        # The batch is answered as a whole, errors are reported per call
+        results = []
+        for call in payload:
+            self.calls[call["method"]] += 1
+            handler = self._methods(call.get("params", {})).get(call["method"])
+            try:
+                if handler is None:
+                    raise ValueError("unknown method")
+                results.append({"ok": True, "result": handler(), "id": call["id"]})
+            except ValueError as e:
+                self.errors[call["method"]] += 1
+                results.append({"ok": False, "code": 500, "error": str(e), "id": call["id"]})
+
+        return results
+
+    async def _run_get_method(self, request: web.Request, **behaviour) -> web.Response:
+        payload = await request.json()
+        return await self._respond("runGetMethod", lambda: self._run_method(payload), **behaviour)
+
+    async def _send_boc(self, request: web.Request, **behaviour) -> web.Response:
+        payload = await request.json()
+        return await self._respond("sendBoc", lambda: self._accept(base64.b64decode(payload["boc"])), **behaviour)
+
+    def _transactions(self, params: dict) -> list:
+        # Newest first, starting at lt when given, down to (excluding) to_lt
+        lt, to_lt = int(params.get("lt") or 0), int(params.get("to_lt") or 0)
+        transactions = [
+            transaction for transaction in reversed(self.account(params["address"])["transactions"])
+            if (not lt or int(transaction["transaction_id"]["lt"]) <= lt)
+            and int(transaction["transaction_id"]["lt"]) > to_lt
+        ]
+        return transactions[:int(params.get("limit") or 10)]
+
+    def _record(self, account: dict, in_msg: dict, out_msgs: list):
+        account["lt"] = self._next_lt()
+        account["transactions"].append({
+            "utime": int(time.time()),
+            "transaction_id": {"@type": "internal.transactionId", "lt": str(account["lt"]), "hash": f"h{account['lt']}"},
+            "fee": "0",
+            "in_msg": in_msg,
+            "out_msgs": out_msgs,
+        })
+
+    def _estimate_fee(self, params: dict) -> dict:
+        # Roughly what a v3r2 transfer costs, a deployment pays for the code and data as well
+        deploy = bool(params.get("init_code"))
+        return {
+            "@type": "query.fees",
+            "source_fees": {
+                "@type": "fees",
+                "in_fwd_fee": 1_500_000 if deploy else 1_000_000,
+                "storage_fee": 100,
+                "gas_fee": 3_308_000,
+                "fwd_fee": 1_000_000 + 2_000 * len(params.get("body", "")),
+            },
+            "destination_fees": [],
+        }
+
+    def _run_method(self, params: dict) -> dict:
+        method = params["method"]
+        if method == "get_wallet_address":
+            return self._jetton_wallet_address(params)
+        if method == "get_wallet_data":
+            return self._jetton_wallet_data(params)
+        if method != "seqno":
+            raise ValueError("unknown get method")
+        account = self.account(params["address"])
+        return {"@type": "smc.runResult", "exit_code": 0, "stack": [["num", hex(account["seqno"])]]}
+
+    def _jetton_wallet_address(self, params: dict) -> dict:
+        # Any address is a jetton master, its wallets are derived from the owner
+        owner = Slice(Cell.one_from_boc(base64.b64decode(params["stack"][0][1]))).read_msg_addr()
+        master = Address(params["address"]).to_string(False)
+        wallet = "0:" + hashlib.sha256(f"{master}|{owner.to_string(False)}".encode()).hexdigest()
+        self._jetton_wallets[wallet] = owner.to_string(False)
+
+        cell = Cell()
+        cell.bits.write_address(Address(wallet))
+        boc = base64.b64encode(cell.to_boc(False)).decode()
+        return {"@type": "smc.runResult", "exit_code": 0, "stack": [["cell", {"bytes": boc}]]}
+
+    def _jetton_wallet_data(self, params: dict) -> dict:
+        # Every jetton wallet holds `jetton_balance` units, the rest of the data is left out
+        if Address(params["address"]).to_string(False) not in self._jetton_wallets:
+            return {"@type": "smc.runResult", "exit_code": -13, "stack": []}
+        return {"@type": "smc.runResult", "exit_code": 0, "stack": [["num", hex(self.jetton_balance)]]}
+
+    def _accept(self, boc: bytes) -> dict:
+        # The same message sent through several endpoints lands once
+        message_hash = hashlib.sha256(boc).digest()
+        if message_hash in self._inflight:
+            return {"@type": "ok"}
+
+        message = Slice(Cell.one_from_boc(boc))
+        message.read_uint(2)  # ext_in_msg_info
+        message.read_msg_addr()
+        destination = message.read_msg_addr().to_string(False)
+        message.read_coins()
+        account = self.account(destination)
+
+        if message.read_bit():
+            # Wallet deployment, the state init is inline (split_depth, special, code, data, library)
+            if message.read_bit():
+                message.read_ref()
+            else:
+                message.skip_bits(5)
+                message.ref_offset += 2
+            if account["active"]:
+                raise ValueError("account is already active")
+            self._inflight.add(message_hash)
+            asyncio.get_running_loop().call_later(self.confirm_delay, self._apply, message_hash, account, [])
+            return {"@type": "ok"}
+
+        body = Slice(message.read_ref()) if message.read_bit() else message
+        body.skip_bits(512 + 32 + 32)  # signature, subwallet id, valid until
+        seqno = body.read_uint(32)
+        if not account["active"] or seqno != account["seqno"]:
+            raise ValueError(f"cannot apply external message, seqno {seqno} != {account['seqno']}")
+
+        orders = []
+        while body.ref_offset < len(body.refs):
+            body.read_uint(8)  # send mode
+            order = Slice(body.read_ref())
+            order.skip_bits(4)  # int_msg_info, ihr_disabled, bounce, bounced
+            order.read_msg_addr()
+            orders.append((order.read_msg_addr().to_string(False), order.read_coins()))
+
+        self._inflight.add(message_hash)
+        asyncio.get_running_loop().call_later(self.confirm_delay, self._apply, message_hash, account, orders)
+        return {"@type": "ok"}
+
+    def _apply(self, message_hash: bytes, account: dict, orders: list):
+        self._inflight.discard(message_hash)
+        account["active"] = True
+        account["seqno"] += 1
+
+        out_msgs = []
+        for destination, value in orders:
+            value = min(value, account["balance"])
+            account["balance"] -= value
+            receiver = self.account(destination)
+            receiver["balance"] += value
+            message = {"source": account["address"], "destination": receiver["address"], "value": str(value), "message": ""}
+            self._record(receiver, message, [])
+            out_msgs.append(message)
+
+        self._record(account, {"source": "", "destination": account["address"], "value": "0", "message": ""}, out_msgs)
@@ -0,0 +1,272 @@
+"""Load test: the real bot Application and handlers against a fake toncenter and an in-process Bot API
+
+    python bench/load.py --users 50 --toncenter-latency 0.05 --toncenter-error-rate 0.01
+
+Every synthetic user signs up (/start and the password twice), refreshes the wallet, sends
+TON to an address, opens its history and writes an inline cheque, then claims the cheque
+of the previous user.
+Reports updates/s, update latency percentiles per step, upstream call counts and memory.
+Nothing leaves the machine, the fake toncenter listens on localhost.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import resource
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "src"))
+
+from aiohttp import web
+from tonsdk.utils import Address
+
+from fake_bot_api import BOT_USER, FakeBotAPI
+from fake_toncenter import FakeToncenter
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--refreshes", type=int, default=3, help="refreshes per user")
+    parser.add_argument("--cheque-amount", default="0.5")
+    parser.add_argument("--toncenter-port", type=int, default=18081)
+    parser.add_argument("--toncenter-latency", type=float, default=0.05)
+    parser.add_argument("--toncenter-error-rate", type=float, default=0)
+    parser.add_argument("--toncenter-error-code", type=int, default=503)
+    parser.add_argument("--toncenter-rps", type=float, default=1000, help="client side rate limit")
+    parser.add_argument("--backends", type=int, default=1,
+                        help="toncenter endpoints, above 1 the client routes over them, latency and errors "
+                             "are injected on the first one only")
+    parser.add_argument("--backup-latency", type=float, default=0.05, help="latency of the other endpoints")
+    parser.add_argument("--batch-size", type=int, default=0, help="send toncenter calls as jsonRPC batches")
+    parser.add_argument("--confirm-delay", type=float, default=0.5, help="seconds until a sent message lands")
+    parser.add_argument("--bot-api-latency", type=float, default=0.02)
+    parser.add_argument("--jettons", type=int, default=0, help="jettons shown next to the TON balance")
+    parser.add_argument("--telegram-chat-rate", type=float, default=1,
+                        help="sends and edits per second in one chat, the synthetic users tap much faster than people")
+    return parser.parse_args()
+
+
+def percentile(values, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+class Driver:
+    """Feeds synthetic updates into the application and records when each one is processed"""
+
+    def __init__(self, application, bot_api: FakeBotAPI):
+        self.application = application
+        self.bot_api = bot_api
+        self.latencies = {}
+        self.errors = 0
+
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._pending = {}
+
+    def processed(self, update):
+        kind, started, future = self._pending.pop(update.update_id)
+        self.latencies.setdefault(kind, []).append(time.perf_counter() - started)
+        future.set_result(None)
+
+    async def error(self, update, context):
+        self.errors += 1
+
+    async def send(self, kind: str, **payload):
+        from telegram import Update
+
+        update_id = next(self._update_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[update_id] = (kind, time.perf_counter(), future)
+
+        update = Update.de_json({"update_id": update_id, **payload}, self.application.bot)
+        await self.application.update_queue.put(update)
+        await future
+
+    async def message(self, kind: str, user: dict, text: str):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user["id"], "type": "private"},
+            "from": user,
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        await self.send(kind, message=message)
+
+    async def callback(self, user: dict, data: str):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user["id"], "type": "private"},
+            "from": BOT_USER,
+            "text": ".",
+        }
+        callback_query = {"id": str(next(self._update_ids)), "from": user, "chat_instance": "bench", "data": data,
+                          "message": message}
+        await self.send(data, callback_query=callback_query)
+
+    async def cheque(self, user: dict, amount: str):
+        query_id = str(next(self._update_ids))
+        answer = self.bot_api.inline_answer(query_id)
+        await self.send("inline-query", inline_query={"id": query_id, "from": user, "query": amount, "offset": ""})
+
+        results = await asyncio.wait_for(answer, 30)
+        if not results:
+            return None
+
+        result_id = results[0]["id"]
+        chosen = {"result_id": result_id, "from": user, "query": amount, "inline_message_id": f"inline-{query_id}"}
+        await self.send("chosen-cheque", chosen_inline_result=chosen)
+        return result_id
+
+    async def user_flow(self, user_id: int, refreshes: int, address: str, amount: str):
+        user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+        password = f"bench password {user_id}"
+
+        await self.message("start", user, "/start")
+        await self.message("new-password", user, password)
+        await self.message("confirm_password", user, password)
+        for _ in range(refreshes):
+            await self.callback(user, "refresh")
+
+        await self.callback(user, "send")
+        await self.message("send-address", user, address)
+        await self.callback(user, "min_send")
+        await self.callback(user, "send-confirm")
+        await self.callback(user, "history")
+
+        return await self.cheque(user, amount)
+
+    async def claim(self, user_id: int, cheque_id: str):
+        user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+        await self.message("claim", user, f"/start accept-{cheque_id}")
+
+
+async def run(args):
+    from bot.bot import create_application
+    from bot.persistence import SQLitePersistence
+    from bot.scheduler import UserUpdateProcessor
+    from wallet.wallet import Wallet
+
+    toncenter = FakeToncenter(
+        latency=args.toncenter_latency,
+        error_rate=args.toncenter_error_rate,
+        error_code=args.toncenter_error_code,
+        confirm_delay=args.confirm_delay,
+    )
+    runners = []
+    for i in range(args.backends):
+        app = toncenter.app() if i == 0 else toncenter.app(latency=args.backup_latency, error_rate=0)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", args.toncenter_port + i).start()
+        runners.append(runner)
+
+    bot_api = FakeBotAPI(latency=args.bot_api_latency)
+    driver = None
+
+    class TimedUpdateProcessor(UserUpdateProcessor):
+        async def do_process_update(self, update, coroutine):
+            try:
+                await super().do_process_update(update, coroutine)
+            finally:
+                driver.processed(update)
+
+    processor = TimedUpdateProcessor(
+        int(os.environ.get("MAX_CONCURRENT_UPDATES", 64)), int(os.environ.get("MAX_USER_PENDING_UPDATES", 8)))
+    persistence = SQLitePersistence(filepath=os.path.join(os.environ["BENCH_DIRECTORY"], "bench.sqlite"))
+    application = create_application(persistence=persistence, request=bot_api, update_processor=processor)
+    driver = Driver(application, bot_api)
+    application.add_error_handler(driver.error)
+
+    address = Address("0:" + "11" * 32).to_string(True, True, True)
+    users = [100000 + i for i in range(args.users)]
+
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    try:
+        started = time.perf_counter()
+        cheques = await asyncio.gather(
+            *(driver.user_flow(user_id, args.refreshes, address, args.cheque_amount) for user_id in users))
+
+        # Let the sent transfers land before the cheques are paid out of the same wallets
+        await asyncio.sleep(args.confirm_delay)
+        await asyncio.gather(*(
+            driver.claim(user_id, cheque_id)
+            for user_id, cheque_id in zip(users, cheques[-1:] + cheques[:-1])
+            if cheque_id is not None
+        ))
+        elapsed = time.perf_counter() - started
+    finally:
+        await application.stop()
+        await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
+        for runner in runners:
+            await runner.cleanup()
+
+    report(args, driver, toncenter, bot_api, application.bot.rate_limiter, Wallet, elapsed)
+
+
+def report(args, driver, toncenter, bot_api, outbound, wallet_class, elapsed: float):
+    all_latencies = [latency for latencies in driver.latencies.values() for latency in latencies]
+
+    print(f"users: {args.users}, updates: {len(all_latencies)}, handler errors: {driver.errors}")
+    print(f"elapsed: {elapsed:.2f} s, throughput: {len(all_latencies) / elapsed:.1f} updates/s")
+    print()
+    print(f"{'update':<20}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for kind, latencies in list(driver.latencies.items()) + [("all", all_latencies)]:
+        print(f"{kind:<20}{len(latencies):>8}" + "".join(
+            f"{percentile(latencies, q) * 1000:>10.1f}" for q in (0.5, 0.95, 0.99)))
+
+    print()
+    print("toncenter calls:", dict(toncenter.calls), "errors:", dict(toncenter.errors))
+    print("bot api calls:", dict(bot_api.calls))
+    print(f"edits skipped: {outbound.skipped}, coalesced: {outbound.coalesced}, flood retries: {outbound.retried}")
+    for backend in getattr(wallet_class.client, "backends", []):
+        print(f"backend {backend.name}: latency {backend.latency * 1000:.1f} ms, error rate {backend.error_rate:.2f}, "
+              f"rate limiter {backend.client.limiter.stats()}")
+    if not hasattr(wallet_class.client, "backends"):
+        print("rate limiter:", wallet_class.client.limiter.stats())
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    print(f"peak rss: {usage.ru_maxrss / 1024:.1f} MB, key derivation workers: {children.ru_maxrss / 1024:.1f} MB")
+
+
+def main():
+    args = parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # The bot modules read their configuration on import
+        os.environ["BENCH_DIRECTORY"] = directory
+        os.environ.setdefault("BOT_TOKEN", "123456:bench")
+        os.environ.setdefault("TONCENTER_API_KEY", "bench")
+        os.environ["TONCENTER_BASE_URL"] = f"http://127.0.0.1:{args.toncenter_port}/"
+        os.environ["TONCENTER_BATCH_SIZE"] = str(args.batch_size)
+        if args.backends > 1:
+            os.environ["TONCENTER_ENDPOINTS"] = ",".join(
+                f"http://127.0.0.1:{args.toncenter_port + i}/" for i in range(args.backends))
+        os.environ["TONCENTER_RPS"] = str(args.toncenter_rps)
+        os.environ["CHEQUE_DB"] = os.path.join(directory, "cheques.sqlite")
+        os.environ["HISTORY_DB"] = os.path.join(directory, "history.sqlite")
+        os.environ["METRICS_PORT"] = "0"
+        os.environ["TELEGRAM_CHAT_RATE"] = str(args.telegram_chat_rate)
+        # Rates from a local stub, nothing asks CoinGecko
+        os.environ["FIAT_RATES"] = "USD=2.5,ILS=9.2"
+        # The fake toncenter treats any address as a jetton master
+        os.environ["JETTONS"] = ",".join(f"J{i}|0:{i + 1:064x}|6" for i in range(args.jettons))
+        os.environ.setdefault("KEY_DERIVATION_MAX_PENDING", str(args.users))
+
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
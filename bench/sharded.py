@@ -0,0 +1,241 @@
+"""Sharded load test: the bot as a front process and N worker processes, against local fakes
+
+    python bench/sharded.py --shards 4 --users 100
+
+Runs the fake toncenter and an HTTP fake Bot API in this process, starts the bot with
+BOT_MODE=sharded and posts synthetic updates to the front's webhook. Every synthetic user
+signs up (/start and the password twice), opens and cancels the send screen a few times and
+writes an inline cheque, each step waits for the bot to answer in the user's chat. Then every
+user claims the cheque of the previous one, paid out by the shard owning its sender.
+Reports updates/s and how the updates were spread over the shards. Throughput only scales
+with the shards up to the number of cores.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+from fake_bot_api import BOT_USER, FakeBotAPI
+from fake_toncenter import FakeToncenter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCH_DIR, "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+from bot.shards import ShardRing  # noqa: E402
+from bot.webhook import SECRET_HEADER  # noqa: E402
+
+WEBHOOK_SECRET = "bench-secret"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=3, help="send screens opened and cancelled per user")
+    parser.add_argument("--port", type=int, default=18180, help="front webhook, the fakes and the workers follow")
+    parser.add_argument("--toncenter-latency", type=float, default=0.05)
+    parser.add_argument("--bot-api-latency", type=float, default=0.02)
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    return parser.parse_args()
+
+
+class Driver:
+    """Posts the updates of each synthetic user to the front, one after the other"""
+
+    def __init__(self, url: str, bot_api: FakeBotAPI):
+        self.url = url
+        self.bot_api = bot_api
+        self.updates = 0
+
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._session = None
+
+    async def post(self, user: dict, wait: bool = True, **payload):
+        # The step is done once the bot rendered something new in the user's chat
+        rendered = self.bot_api.rendered[user["id"]]
+        update = {"update_id": next(self._update_ids), **payload}
+        while True:
+            async with self._session.post(self.url, json=update, headers={SECRET_HEADER: WEBHOOK_SECRET}) as response:
+                if response.status == 200:
+                    break
+            await asyncio.sleep(0.1)
+
+        if wait:
+            await self.bot_api.wait_rendered(user["id"], rendered + 1)
+        self.updates += 1
+
+    async def message(self, user: dict, text: str):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user["id"], "type": "private"},
+            "from": user,
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        await self.post(user, message=message)
+
+    async def callback(self, user: dict, data: str):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user["id"], "type": "private"},
+            "from": BOT_USER,
+            "text": ".",
+        }
+        await self.post(user, callback_query={
+            "id": str(next(self._update_ids)), "from": user, "chat_instance": "bench", "data": data,
+            "message": message})
+
+    async def cheque(self, user: dict, amount: str):
+        # Inline answers and the cheque's inline message are not rendered in the user's chat
+        query_id = str(next(self._update_ids))
+        answer = self.bot_api.inline_answer(query_id)
+        await self.post(user, wait=False, inline_query={"id": query_id, "from": user, "query": amount, "offset": ""})
+
+        results = await asyncio.wait_for(answer, 30)
+        if not results:
+            return None
+
+        result_id = results[0]["id"]
+        chosen = {"result_id": result_id, "from": user, "query": amount, "inline_message_id": f"inline-{query_id}"}
+        await self.post(user, wait=False, chosen_inline_result=chosen)
+        return result_id
+
+    async def user_flow(self, user_id: int, rounds: int):
+        user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+        password = f"bench password {user_id}"
+
+        await self.message(user, "/start")
+        await self.message(user, password)
+        await self.message(user, password)
+        for _ in range(rounds):
+            await self.callback(user, "send")
+            await self.callback(user, "cancel-send")
+
+        return await self.cheque(user, "0.5")
+
+    async def claim(self, user_id: int, cheque_id: str):
+        user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+        await self.message(user, f"/start accept-{cheque_id}")
+
+
+async def wait_listening(url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url):
+                    return
+            except aiohttp.ClientError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+
+
+async def wait_claimed(filepath: str, count: int, timeout: float) -> int:
+    deadline = time.monotonic() + timeout
+    while True:
+        with sqlite3.connect(filepath) as connection:
+            (claimed,), = connection.execute("SELECT COUNT(*) FROM cheques WHERE status = 'claimed'")
+        if claimed >= count or time.monotonic() > deadline:
+            return claimed
+        await asyncio.sleep(0.2)
+
+
+async def run(args, directory: str):
+    toncenter = FakeToncenter(latency=args.toncenter_latency, confirm_delay=0.5)
+    bot_api = FakeBotAPI(latency=args.bot_api_latency)
+    front_port, toncenter_port, bot_api_port, worker_port = (args.port + i for i in range(4))
+
+    runners = []
+    for app, port in ((toncenter.app(), toncenter_port), (bot_api.app(), bot_api_port)):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        runners.append(runner)
+
+    env = dict(
+        os.environ,
+        PYTHONPATH=SRC_DIR,
+        BOT_MODE="sharded",
+        SHARDS=str(args.shards),
+        SHARD_PORT=str(worker_port),
+        SHARD_FRONT_MODE="webhook",
+        WEBHOOK_HOST="127.0.0.1",
+        WEBHOOK_PORT=str(front_port),
+        WEBHOOK_SECRET=WEBHOOK_SECRET,
+        TELEGRAM_API_URL=f"http://127.0.0.1:{bot_api_port}",
+        BOT_TOKEN="123456:bench",
+        TONCENTER_API_KEY="bench",
+        TONCENTER_BASE_URL=f"http://127.0.0.1:{toncenter_port}/",
+        TONCENTER_RPS="10000",
+        TELEGRAM_GLOBAL_RATE="10000",
+        TELEGRAM_CHAT_RATE="100",
+        CHEQUE_DB=os.path.join(directory, "cheques.sqlite"),
+        HISTORY_DB=os.path.join(directory, "history.sqlite"),
+        METRICS_PORT="0",
+        FIAT_RATES="USD=2.5,ILS=9.2",
+    )
+    # The bot keeps its data in ../data
+    os.makedirs(os.path.join(directory, "data"))
+    os.makedirs(os.path.join(directory, "run"))
+    front = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(SRC_DIR, "run.py"), env=env, cwd=os.path.join(directory, "run"))
+
+    driver = Driver(f"http://127.0.0.1:{front_port}/webhook", bot_api)
+    users = [100000 + i for i in range(args.users)]
+    try:
+        await wait_listening(f"http://127.0.0.1:{front_port}/", args.startup_timeout)
+        for i in range(args.shards):
+            await wait_listening(f"http://127.0.0.1:{worker_port + i}/", args.startup_timeout)
+
+        async with aiohttp.ClientSession() as driver._session:
+            started = time.perf_counter()
+            cheques = await asyncio.gather(*(driver.user_flow(user_id, args.rounds) for user_id in users))
+            elapsed = time.perf_counter() - started
+
+            # Every user claims the cheque of the previous one, mostly paid out by another shard
+            await asyncio.sleep(1)
+            await asyncio.gather(*(
+                driver.claim(user_id, cheque_id)
+                for user_id, cheque_id in zip(users, cheques[-1:] + cheques[:-1]) if cheque_id is not None))
+            claimed = await wait_claimed(os.path.join(directory, "cheques.sqlite"), len(users), timeout=10)
+    finally:
+        front.terminate()
+        await front.wait()
+        for runner in runners:
+            await runner.cleanup()
+
+    ring = ShardRing(args.shards)
+    spread = [0] * args.shards
+    for user_id in users:
+        spread[ring.shard(user_id)] += 1
+
+    print(f"shards: {args.shards}, users: {args.users}, updates: {driver.updates}")
+    print(f"elapsed: {elapsed:.2f} s, throughput: {driver.updates / elapsed:.1f} updates/s")
+    print("users per shard:", spread)
+    print(f"cheques claimed: {claimed}/{len(users)}, paid out by another shard: "
+          f"{sum(ring.shard(a) != ring.shard(b) for a, b in zip(users, users[-1:] + users[:-1]))}")
+    print("toncenter calls:", dict(toncenter.calls))
+    print("bot api calls:", dict(bot_api.calls))
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(run(args, directory))
+
+
+if __name__ == "__main__":
+    main()
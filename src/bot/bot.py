@@ -1,9 +1,10 @@
+import asyncio
 import logging
 import os
-from uuid import uuid4
-from secrets import token_urlsafe
+import time
 
 from telegram import (
+    Bot,
     Update,
     InlineQueryResultArticle,
     InputTextMessageContent,
@@ -17,12 +18,25 @@ from telegram.ext import (
     CallbackQueryHandler,
     ContextTypes,
     filters,
-    PicklePersistence,
     InlineQueryHandler,
+    ChosenInlineResultHandler,
+    TypeHandler,
 )
 from telegram.constants import ParseMode
 
-from .handlers import handlers, start
+from .handlers import handlers, pay_cheque, start
+from .persistence import SQLitePersistence
+from .cheques import cheque_store
+from .scheduler import UserUpdateProcessor
+from .sessions import SessionEvictor
+from .shards import peers, run_front, shard_owner
+from .outbound import OutboundScheduler
+from .webhook import run_webhook
+from .shared_actions import watch_deposits
+from wallet.wallet import Wallet
+from wallet.limiter import Priority
+from wallet.metrics import Counter, Gauge, HANDLER_LATENCY, start_metrics_server
+from tonsdk.utils import to_nano
 
 
 logging.basicConfig(
@@ -39,8 +53,140 @@ logger = logging.getLogger(__name__)
 TOKEN = os.environ["BOT_TOKEN"]
 
 
+# Inline query tuning: debounce delay, balance snapshot age and Telegram side cache time
+INLINE_DEBOUNCE = float(os.environ.get("INLINE_DEBOUNCE", 0.4))
+INLINE_BALANCE_TTL = float(os.environ.get("INLINE_BALANCE_TTL", 30))
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", 30))
+
+_latest_inline_query = {}
+
+
+# Updates of different users run concurrently, the updates of one user in order
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", 64))
+MAX_USER_PENDING_UPDATES = int(os.environ.get("MAX_USER_PENDING_UPDATES", 8))
+
+
+# "polling", "webhook" or "sharded", the webhook server listens locally behind WEBHOOK_URL
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", 1000))
+
+# Sharded mode: a front process receives the updates (SHARD_FRONT_MODE, polling or on the webhook
+# above) and routes every user to one of SHARDS workers listening on SHARD_PORT onwards. The
+# workers are this bot in webhook mode, told their SHARD_INDEX of SHARD_COUNT
+SHARDS = int(os.environ.get("SHARDS", os.cpu_count() or 1))
+SHARD_PORT = int(os.environ.get("SHARD_PORT", 8500))
+SHARD_FRONT_MODE = os.environ.get("SHARD_FRONT_MODE", "polling")
+SHARD_INDEX = int(os.environ.get("SHARD_INDEX", 0))
+SHARD_COUNT = int(os.environ.get("SHARD_COUNT", 1))
+
+# Bot API server, e.g. a local one
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
+
+
+# User sessions idle for SESSION_IDLE_TTL seconds, or beyond the MAX_SESSIONS most recent, are
+# written back and dropped from memory every SESSION_EVICT_INTERVAL seconds
+SESSION_IDLE_TTL = float(os.environ.get("SESSION_IDLE_TTL", 900))
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", 10000))
+SESSION_EVICT_INTERVAL = float(os.environ.get("SESSION_EVICT_INTERVAL", 60))
+
+
+# Outbound Bot API pacing: sends and edits per second overall and per chat, flood wait retries
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", 30))
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", 1))
+TELEGRAM_CHAT_BURST = int(os.environ.get("TELEGRAM_CHAT_BURST", 5))
+TELEGRAM_MAX_RETRIES = int(os.environ.get("TELEGRAM_MAX_RETRIES", 3))
+
+
+# Prometheus metrics on http://METRICS_HOST:METRICS_PORT/metrics, port 0 disables them
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9101))
+
+
+def toncenter_backends():
+    # A routed client has one rate limiter per endpoint
+    backends = getattr(Wallet.client, "backends", None)
+    return [(backend.name, backend.client) for backend in backends] if backends else [("default", Wallet.client)]
+
+
+def limiter_stats(key: str):
+    return lambda: {
+        (name, priority): stats[key]
+        for name, client in toncenter_backends()
+        for priority, stats in client.limiter.stats().items()
+    }
+
+
+Gauge(
+    "twallet_toncenter_queued", "Toncenter requests waiting for the rate limiter, by priority",
+    limiter_stats("queued"), labelnames=("backend", "priority"),
+)
+Counter(
+    "twallet_toncenter_wait_seconds_total", "Time spent waiting for the rate limiter, by priority",
+    limiter_stats("waited"), labelnames=("backend", "priority"),
+)
+Gauge(
+    "twallet_toncenter_backend_latency_seconds", "Average latency of each routed toncenter backend",
+    lambda: {(backend.name,): backend.latency for backend in getattr(Wallet.client, "backends", [])},
+    labelnames=("backend",),
+)
+Gauge(
+    "twallet_toncenter_backend_open", "Whether the breaker of each routed toncenter backend is open",
+    lambda: {(backend.name,): int(backend.open) for backend in getattr(Wallet.client, "backends", [])},
+    labelnames=("backend",),
+)
+Gauge("twallet_key_derivation_pending", "Key derivations running or queued", lambda: Wallet.derivation_pool.pending)
+Counter(
+    "twallet_key_derivation_rejected_total", "Key derivations rejected as busy",
+    lambda: Wallet.derivation_pool.rejected,
+)
+Gauge("twallet_confirmations_pending", "Sent transfers waiting for confirmation", lambda: Wallet.confirmations.pending)
+Counter(
+    "twallet_telegram_edits_skipped_total", "Edits answered locally as they changed nothing",
+    lambda: outbound.skipped,
+)
+Counter(
+    "twallet_telegram_edits_coalesced_total", "Edits replaced by a newer edit before being sent",
+    lambda: outbound.coalesced,
+)
+Counter("twallet_telegram_retries_total", "Bot API calls retried after a flood wait", lambda: outbound.retried)
+Gauge("twallet_user_sessions", "User sessions loaded in memory", lambda: len(persistence.sessions))
+Counter(
+    "twallet_user_sessions_evicted_total", "User sessions evicted since the start",
+    lambda: evictor.evicted if evictor else 0,
+)
+Gauge("twallet_deposit_addresses", "Addresses watched for deposits", lambda: len(Wallet.deposits))
+Gauge(
+    "twallet_price_age_seconds", "Age of the TON rate of each currency",
+    lambda: {
+        (currency,): Wallet.prices.age(currency)
+        for currency in Wallet.prices.currencies if Wallet.prices.age(currency) is not None
+    },
+    labelnames=("currency",),
+)
+Counter(
+    "twallet_price_refresh_failures_total", "Failed price refreshes since the start",
+    lambda: Wallet.prices.failures,
+)
+
+metrics_runner = None
+evictor = None
+
+
 # Setup persistence
-persistence = PicklePersistence(filepath="../data/data.db")
+persistence = SQLitePersistence(
+    filepath="../data/data.sqlite", legacy_filepath="../data/data.db", owns=shard_owner(SHARD_INDEX, SHARD_COUNT))
+
+outbound = OutboundScheduler(
+    global_rate=TELEGRAM_GLOBAL_RATE,
+    chat_rate=TELEGRAM_CHAT_RATE,
+    chat_burst=TELEGRAM_CHAT_BURST,
+    max_retries=TELEGRAM_MAX_RETRIES,
+)
 
 
 # Handler for handling user messages
@@ -48,8 +194,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     state = context.user_data['state']
     await update.message.delete()
 
+    # Whatever the handler shows replaces the current screen
+    context.user_data.pop("screen", None)
     func = handlers.get(state)
-    next_state = await func(update, context)
+    with HANDLER_LATENCY.time(handler=state if func else "unknown"):
+        next_state = await func(update, context)
     context.user_data["state"] = next_state
 
 
@@ -57,25 +206,46 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_inline_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
 
+    context.user_data.pop("screen", None)
+
+    # callback_data comes from the client, only known handlers get a series of their own
     func = handlers.get(query.data)
-    next_state = await func(update, context)
+    with HANDLER_LATENCY.time(handler=query.data if func else "unknown"):
+        next_state = await func(update, context)
     context.user_data["state"] = next_state
 
 
+def cheque_markup(amount: float, cheque_id: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        [[
+            InlineKeyboardButton(
+                f"Claim {amount} TON",
+                url=f"https://t.me/TONPrivateWalletBot?start=accept-{cheque_id}",
+            )
+        ]]
+    )
+
+
 async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.inline_query.query
 
     if not query:  # empty query should not be handled
         return
 
+    # Telegram sends a query for almost every typed character, only answer the last one
+    user_id = update.inline_query.from_user.id
+    _latest_inline_query[user_id] = update.inline_query.id
+    await asyncio.sleep(INLINE_DEBOUNCE)
+    if _latest_inline_query.get(user_id) != update.inline_query.id:
+        return
+    _latest_inline_query.pop(user_id)
+
     wallet = context.user_data.get("wallet")
     if not wallet:
         print("No Wallet")
         await update.inline_query.answer([])
         return
 
-    await wallet.load_state()
-
     try:
         amount = float(query)
     except ValueError:
@@ -83,49 +253,169 @@ async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         await update.inline_query.answer([])
         return
 
-    if wallet.balance < amount:
+    # Inline query balances are cosmetic, a recent snapshot is good enough
+    if time.time() - wallet.loaded_at > INLINE_BALANCE_TTL:
+        await wallet.load_state(priority=Priority.background)
+
+    if amount <= 0 or wallet.balance < amount:
         print("Low balance")
         await update.inline_query.answer([])
         return
 
-    transfer_uuid = token_urlsafe(16)
-    if "transfers" not in context.bot_data:
-        context.bot_data["transfers"] = {}
-    context.bot_data["transfers"][transfer_uuid] = {"wallet": wallet, "amount": amount}
-
-    reply_markup = InlineKeyboardMarkup(
-        [[
-            InlineKeyboardButton(
-                f"Claim {amount} TON",
-                url=f"https://t.me/TONPrivateWalletBot?start=accept-{transfer_uuid}",
-            )
-        ]]
-    )
+    # The cheque is stored once the result is chosen (see chosen_cheque), or from its signed id
+    # on the first claim when Telegram does not report chosen results
     message = InputTextMessageContent(message_text=f"Cheque for <b>{amount}</b> TON", parse_mode=ParseMode.HTML)
+    cheque_id = cheque_store.new_id(user_id, to_nano(amount, "TON"))
 
     results = [
         InlineQueryResultArticle(
-            id=str(uuid4()),
+            id=cheque_id,
             title=f"Create a cheque: {amount} TON",
             description=f"Available: {wallet.balance} TON",
             input_message_content=message,
-            reply_markup=reply_markup,
+            reply_markup=cheque_markup(amount, cheque_id),
         ),
     ]
 
-    await update.inline_query.answer(results, cache_time=8)
+    await update.inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True)
 
 
-# Create the Telegram bot
-def main():
-    """Start the bot."""
-    application = Application.builder().token(TOKEN).persistence(persistence).build()
+async def chosen_cheque(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    result = update.chosen_inline_result
+    amount = float(result.query)
+
+    if await cheque_store.create(
+            result.from_user.id, to_nano(amount, "TON"), cheque_id=result.result_id,
+            inline_message_id=result.inline_message_id):
+        return
+
+    # Already stored: by the claim of a recipient who opened the link before this report came
+    # in, then it belongs to this message and may be paid already, or for another message
+    cheque = await cheque_store.attach(result.result_id, result.inline_message_id)
+    if cheque is None or result.inline_message_id is None or cheque.inline_message_id == result.inline_message_id:
+        return
+
+    # A cached result was sent again, give this message a cheque of its own
+    cheque_id = await cheque_store.create(
+        result.from_user.id, to_nano(amount, "TON"), inline_message_id=result.inline_message_id)
+    await context.bot.edit_message_reply_markup(
+        inline_message_id=result.inline_message_id,
+        reply_markup=cheque_markup(amount, cheque_id),
+    )
+
+
+async def watch_active_deposits(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Deposits are watched for the users active lately, each update of a user keeps his watch
+    if update.effective_user is not None and "wallet" in context.user_data:
+        watch_deposits(context.application, update.effective_user.id)
+
+
+async def post_init(application: Application) -> None:
+    # Cheques live in the cheque store now, the old ones hold whole wallets and can't be redeemed
+    application.bot_data.pop("transfers", None)
+
+    Wallet.deposits.start()
+    Wallet.prices.start()
+
+    global evictor
+    evictor = SessionEvictor(
+        application, idle_ttl=SESSION_IDLE_TTL, max_sessions=MAX_SESSIONS, interval=SESSION_EVICT_INTERVAL)
+    evictor.start()
+
+    global metrics_runner
+    if METRICS_PORT:
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+
+
+async def post_stop(application: Application) -> None:
+    # Evictions write to the persistence, which is flushed and closed on shutdown
+    if evictor is not None:
+        await evictor.stop()
+
+
+async def post_shutdown(application: Application) -> None:
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+    # Stop the background pollers, close the shared toncenter connection pool and the key derivation workers
+    await Wallet.deposits.stop()
+    await Wallet.prices.stop()
+    await Wallet.confirmations.stop()
+    await cheque_store.close()
+    await Wallet.history.close()
+    await Wallet.jettons.close()
+    await Wallet.client.close()
+    if peers is not None:
+        await peers.close()
+    Wallet.derivation_pool.shutdown()
+
+
+def create_application(persistence=persistence, request=None, update_processor=None) -> Application:
+    """The bot application with all its handlers, `request` replaces the Bot API transport"""
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .persistence(persistence)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(update_processor or UserUpdateProcessor(MAX_CONCURRENT_UPDATES, MAX_USER_PENDING_UPDATES))
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+        .rate_limiter(outbound)
+    )
+    if request is not None:
+        builder = builder.request(request)
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot")
+    application = builder.build()
 
     # on different commands - answer in Telegram
+    application.add_handler(TypeHandler(Update, watch_active_deposits), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_handler(CallbackQueryHandler(handle_inline_buttons))
-    application.add_handler(InlineQueryHandler(inline_query))
+    application.add_handler(InlineQueryHandler(inline_query, block=False))
+    application.add_handler(ChosenInlineResultHandler(chosen_cheque))
+
+    return application
+
+
+# Create the Telegram bot
+def main():
+    """Start the bot."""
+    if BOT_MODE == "sharded":
+        # The workers share the database, it is created and the legacy data migrated before they start
+        persistence.set_bot(Bot(TOKEN))
+        asyncio.run(persistence.prepare())
+        asyncio.run(run_front(
+            TOKEN,
+            shards=SHARDS,
+            worker_port=SHARD_PORT,
+            mode=SHARD_FRONT_MODE,
+            host=WEBHOOK_HOST,
+            port=WEBHOOK_PORT,
+            path=WEBHOOK_PATH,
+            url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            base_url=f"{TELEGRAM_API_URL}/bot" if TELEGRAM_API_URL else None,
+        ))
+        return
+
+    application = create_application()
 
     # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(
+            application,
+            host=WEBHOOK_HOST,
+            port=WEBHOOK_PORT,
+            path=WEBHOOK_PATH,
+            url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            # Cheque payouts forwarded by the other shards to the one owning the sender
+            calls={"pay-cheque": pay_cheque},
+        ))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
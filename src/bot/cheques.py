@@ -0,0 +1,198 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import sqlite3
+import struct
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cheques (
+    cheque_id TEXT PRIMARY KEY,
+    sender_id INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    status TEXT NOT NULL,
+    claimed_by INTEGER,
+    inline_message_id TEXT
+);
+CREATE INDEX IF NOT EXISTS cheques_created_at ON cheques (created_at);
+"""
+
+OPEN = "open"
+CLAIMING = "claiming"
+CLAIMED = "claimed"
+
+Cheque = namedtuple(
+    "Cheque", ["cheque_id", "sender_id", "amount", "created_at", "status", "claimed_by", "inline_message_id"])
+
+# Signed cheque ids: sender id, amount in nanotons, creation time and a nonce, then the signature.
+# 51 characters, so "accept-<id>" fits in a 64 character start parameter
+_ID_FORMAT = struct.Struct(">qQIH")
+_SIGNATURE_SIZE = 16
+
+
+class ChequeStore:
+    """Cheques as compact rows (sender user id, amount in nanotons, creation time, status)
+
+    Cheques expire `ttl` seconds after creation and are deleted shortly after. Claiming is a
+    single conditional update, so a cheque is handed out once even when several claims race,
+    from this process or any other one using the same database.
+
+    Cheque ids carry the cheque itself, signed with `secret` (see new_id). A cheque that was
+    handed out but never stored, because Telegram did not report the chosen inline result,
+    is stored from its id on the first claim.
+    """
+
+    def __init__(self, filepath: str, secret: bytes, ttl: float = 24 * 60 * 60, evict_interval: float = 60):
+        self.filepath = filepath
+        self.secret = secret
+        self.ttl = ttl
+        self.evict_interval = evict_interval
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cheques")
+        self._connection = None
+        self._evicted_at = 0
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.filepath, check_same_thread=False, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(SCHEMA)
+
+            # Stores created before cheques knew the message they were sent in
+            columns = [row[1] for row in self._connection.execute("PRAGMA table_info(cheques)")]
+            if "inline_message_id" not in columns:
+                self._connection.execute("ALTER TABLE cheques ADD COLUMN inline_message_id TEXT")
+
+        return self._connection
+
+    def _execute(self, query: str, params=()):
+        cursor = self._connect().execute(query, params)
+        return cursor.rowcount, cursor.fetchall()
+
+    def _sign(self, payload: bytes) -> bytes:
+        return hmac.new(self.secret, payload, hashlib.sha256).digest()[:_SIGNATURE_SIZE]
+
+    def new_id(self, sender_id: int, amount: int) -> str:
+        """A signed id for a cheque of `amount` nanotons from the sender, created now"""
+        payload = _ID_FORMAT.pack(sender_id, amount, int(time.time()), secrets.randbits(16))
+        return base64.urlsafe_b64encode(payload + self._sign(payload)).decode().rstrip("=")
+
+    def parse_id(self, cheque_id: str):
+        """(sender_id, amount, created_at) of a signed cheque id, None when it is not one of ours"""
+        try:
+            raw = base64.urlsafe_b64decode(cheque_id + "=" * (-len(cheque_id) % 4))
+        except ValueError:
+            return None
+        if len(raw) != _ID_FORMAT.size + _SIGNATURE_SIZE:
+            return None
+
+        payload, signature = raw[:_ID_FORMAT.size], raw[_ID_FORMAT.size:]
+        if not hmac.compare_digest(signature, self._sign(payload)):
+            return None
+
+        sender_id, amount, created_at, _ = _ID_FORMAT.unpack(payload)
+        return sender_id, amount, created_at
+
+    async def create(self, sender_id: int, amount: int, cheque_id: str = None, inline_message_id: str = None):
+        """Stores a new open cheque, returns its id or None if `cheque_id` is already taken
+
+        `inline_message_id` is the message the cheque was sent in, when it is known.
+        """
+        cheque_id = cheque_id or self.new_id(sender_id, amount)
+        inserted, _ = await self._call(
+            self._execute,
+            "INSERT OR IGNORE INTO cheques (cheque_id, sender_id, amount, created_at, status, inline_message_id) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (cheque_id, sender_id, amount, time.time(), OPEN, inline_message_id),
+        )
+
+        if time.monotonic() - self._evicted_at > self.evict_interval:
+            await self.evict()
+
+        return cheque_id if inserted else None
+
+    async def get(self, cheque_id: str):
+        _, rows = await self._call(self._execute, "SELECT * FROM cheques WHERE cheque_id = ?", (cheque_id,))
+        return Cheque(*rows[0]) if rows else None
+
+    async def attach(self, cheque_id: str, inline_message_id: str):
+        """Records the message of a cheque stored without one, returns the cheque as it is now"""
+        await self._call(
+            self._execute,
+            "UPDATE cheques SET inline_message_id = ? WHERE cheque_id = ? AND inline_message_id IS NULL",
+            (inline_message_id, cheque_id),
+        )
+        return await self.get(cheque_id)
+
+    async def claim(self, cheque_id: str, claimer_id: int):
+        """Reserves an open, unexpired cheque for the claimer, returns None if that is not possible"""
+        cheque = await self._claim(cheque_id, claimer_id)
+        if cheque is None and await self._restore(cheque_id):
+            cheque = await self._claim(cheque_id, claimer_id)
+        return cheque
+
+    async def _restore(self, cheque_id: str) -> bool:
+        # Stores a cheque that was never stored from its signed id, a stored one is left as it is
+        fields = self.parse_id(cheque_id)
+        if fields is None or fields[2] <= time.time() - self.ttl:
+            return False
+
+        sender_id, amount, created_at = fields
+        inserted, _ = await self._call(
+            self._execute,
+            "INSERT OR IGNORE INTO cheques (cheque_id, sender_id, amount, created_at, status) VALUES (?, ?, ?, ?, ?)",
+            (cheque_id, sender_id, amount, created_at, OPEN),
+        )
+        return bool(inserted)
+
+    async def _claim(self, cheque_id: str, claimer_id: int):
+        updated, _ = await self._call(
+            self._execute,
+            "UPDATE cheques SET status = ?, claimed_by = ? WHERE cheque_id = ? AND status = ? AND created_at > ?",
+            (CLAIMING, claimer_id, cheque_id, OPEN, time.time() - self.ttl),
+        )
+        if not updated:
+            return None
+
+        return await self.get(cheque_id)
+
+    async def release(self, cheque_id: str):
+        # The payout failed, the cheque can be claimed again
+        await self._call(
+            self._execute,
+            "UPDATE cheques SET status = ?, claimed_by = NULL WHERE cheque_id = ? AND status = ?",
+            (OPEN, cheque_id, CLAIMING),
+        )
+
+    async def complete(self, cheque_id: str):
+        await self._call(
+            self._execute, "UPDATE cheques SET status = ? WHERE cheque_id = ?", (CLAIMED, cheque_id))
+
+    async def evict(self):
+        self._evicted_at = time.monotonic()
+        deleted, _ = await self._call(
+            self._execute, "DELETE FROM cheques WHERE created_at < ?", (time.time() - self.ttl,))
+        return deleted
+
+    async def close(self):
+        if self._connection is not None:
+            await self._call(self._connection.close)
+            self._connection = None
+
+
+cheque_store = ChequeStore(
+    filepath=os.environ.get("CHEQUE_DB", "../data/data.sqlite"),
+    # Signs the cheque ids, changing it voids the cheques that were never stored
+    secret=(os.environ.get("CHEQUE_SECRET") or os.environ.get("BOT_TOKEN", "")).encode(),
+    ttl=float(os.environ.get("CHEQUE_TTL", 24 * 60 * 60)),
+)
@@ -5,13 +5,21 @@ from telegram.error import BadRequest
 from telegram.ext import ContextTypes
 from telegram.constants import ParseMode
 
-from .messages import WALLET_ADDRESS, SEND_AMOUNT, SEND_ADDRESS, SEND_CONFIRM, SETTINGS, LOGIN, INVALID_ADDRESS, WELCOME_MESSAGE
-from .shared_actions import show_wallet_options, send_receipt
+from .messages import WALLET_ADDRESS, SEND_AMOUNT, SEND_ADDRESS, SEND_CONFIRM, SETTINGS, LOGIN, INVALID_ADDRESS, WELCOME_MESSAGE, SERVICE_BUSY
+from .messages import HISTORY, HISTORY_EMPTY, HISTORY_IN, HISTORY_OUT
+from .shared_actions import fiat_value, show_wallet_options, send_receipt, watch_transfer, watch_deposits
 from .helpers import create_password_hash, is_password_valid
+from .cheques import cheque_store
+from .shards import peers
 
-from wallet.wallet import Wallet
+from wallet.wallet import TransferUncertain, Wallet
+from wallet.derivation import DerivationPoolBusy
+from wallet.limiter import Priority
+from wallet.metrics import HANDLER_LATENCY
 from wallet.utils import validate_address, to_ton, is_unbounceable_address, change_address
 
+HISTORY_PAGE_SIZE = 5
+
 
 async def deeplink_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     arg = context.user_data["redirect-args"].removeprefix("/start ")
@@ -23,7 +31,8 @@ async def deeplink_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["msg"].edit_text("⚠️ Invalid Link", reply_markup=reply_markup)
         return
 
-    result = await func(update, context)
+    with HANDLER_LATENCY.time(handler=f"deeplink-{action_key}"):
+        result = await func(update, context)
     return result
 
 
@@ -43,23 +52,59 @@ async def send_transfer_handler(update: Update, context: ContextTypes.DEFAULT_TY
     return await send_amount_handler(update, context, amount=context.user_data["send_amount"])
 
 
+async def pay_cheque(application, data: dict) -> dict:
+    """Sends a cheque from the sender's wallet to data["address"], on the shard owning the sender
+
+    Only that shard signs with the wallet, under its transfer lock and with its seqno, the
+    other shards forward the payout to it. The status is "sent", "unknown" when the transfer
+    may or may not have been sent, or why nothing was sent.
+    """
+    sender_id, amount = data["sender_id"], data["amount"]
+    if not application.persistence.owns(sender_id):
+        return await peers.call(sender_id, "pay-cheque", data)
+
+    try:
+        # The sender's session may not be loaded
+        sender_data = application.user_data[sender_id]
+        await application.persistence.refresh_user_data(sender_id, sender_data)
+        wallet = sender_data.get("wallet")
+        if wallet is None:
+            return {"status": "missing"}
+
+        await wallet.load_state(priority=Priority.transfer)
+    except Exception as e:
+        print(e, amount, data["address"])
+        return {"status": "error"}
+
+    if wallet.balance < amount:
+        return {"status": "insufficient"}
+
+    try:
+        await wallet.transfer(amount=amount, address=data["address"], comment="contact-transfer")
+    except TransferUncertain as e:
+        print(repr(e.__cause__), amount, data["address"])
+        return {"status": "unknown", "address": wallet.address, "seqno": e.seqno}
+    except Exception as e:
+        # Failed before sending or rejected by toncenter, nothing left the wallet
+        print(e, amount, data["address"])
+        return {"status": "error"}
+
+    return {"status": "sent", "address": wallet.address, "seqno": wallet.sent_seqno}
+
+
 async def accept_transfer_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # /start=accept-<transfer uuid>
     arg = context.user_data["redirect-args"].removeprefix("/start ")
-    transfer_uuid = arg.split("-")[1:][0]
-    transfer_data = context.bot_data.get("transfers", {}).pop(transfer_uuid, None)
+    # Cheque ids may contain "-" themselves
+    transfer_uuid = arg.split("-", 1)[1]
+    cheque = await cheque_store.claim(transfer_uuid, update.effective_user.id)
 
-    if transfer_data is None:
+    if cheque is None:
         await update.message.reply_text("⚠️ transfer was redeemed or canceled")
         return
 
     self_wallet = context.user_data["wallet"]
-    wallet = transfer_data["wallet"]
-    amount = float(transfer_data["amount"])
-
-    if wallet.balance < amount:
-        await update.message.reply_text("⚠️ The sender does not have sufficient funds on his balance")
-        return
+    amount = float(to_ton(cheque.amount))
 
     if not self_wallet.initialized:
         self_address = self_wallet.unbounceable_address
@@ -69,20 +114,60 @@ async def accept_transfer_handler(update: Update, context: ContextTypes.DEFAULT_
     msg = await update.message.reply_text("Claiming...")
 
     try:
-        await wallet.transfer(amount=amount, address=self_address, comment="contact-transfer")
+        result = await pay_cheque(
+            context.application, {"sender_id": cheque.sender_id, "amount": amount, "address": self_address})
     except Exception as e:
+        # The sender's shard did not answer, the transfer may have been sent so the cheque stays claimed
         print(e, amount, self_wallet.address)
-        await msg.edit_text("⚠️ Unknown error during transfer of funds")
+        await msg.edit_text(f"⚠️ The transfer of {amount} TON may not have been sent, check your balance later")
+        return
+
+    status = result["status"]
+    if status not in ("sent", "unknown"):
+        # Nothing was sent, the cheque can be claimed again
+        await cheque_store.release(transfer_uuid)
+        await msg.edit_text({
+            "missing": "⚠️ transfer was redeemed or canceled",
+            "insufficient": "⚠️ The sender does not have sufficient funds on his balance",
+        }.get(status, "⚠️ Unknown error during transfer of funds"))
         return
+
+    if status == "sent":
+        await cheque_store.complete(transfer_uuid)
+        await msg.edit_text(f"⏳ Claimed {amount} TON, waiting for the transfer to land...")
     else:
-        if not self_wallet.initialized:
-            await self_wallet.initialize()
+        # The cheque stays claimed until the sender's seqno tells whether the transfer went out
+        await msg.edit_text(f"⏳ Checking whether the transfer of {amount} TON was sent...")
+
+    async def on_done(confirmed: bool, information: dict):
+        if not confirmed and status == "unknown" and result["seqno"] == 0:
+            # A seqno 0 message never expires, it may still land
+            await msg.edit_text(f"⚠️ The transfer of {amount} TON may not have been sent, check your balance later")
+            return
+        if not confirmed and status == "unknown":
+            # The message expired without landing, it can't be paid twice anymore
+            await cheque_store.release(transfer_uuid)
+            await msg.edit_text(f"⚠️ The transfer of {amount} TON was not sent, claim the cheque again")
+            return
+        if not confirmed:
+            await msg.edit_text(f"⚠️ The transfer of {amount} TON has not landed yet, check your balance later")
+            return
+
+        if status == "unknown":
+            await cheque_store.complete(transfer_uuid)
+
+        # Deploys the wallet once the funds are there
+        self_wallet.state_cache.invalidate(self_wallet.address)
+        await self_wallet.load_state()
+
+        await msg.edit_text(f"✅ You’ve received: {amount} TON")
 
-    await msg.edit_text(f"✅ You’ve received: {amount} TON")
+    Wallet.confirmations.watch(result["address"], result["seqno"], on_done)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     has_args = update.message.text != "/start"
+    context.user_data.pop("screen", None)
 
     if has_args:
         context.user_data["redirect-args"] = update.message.text
@@ -124,12 +209,22 @@ async def check_password_handler(update: Update, context: ContextTypes.DEFAULT_T
     password_data = context.user_data["password"]
     password = update.message.text
     if is_password_valid(password, password_data["hash"], password_data["salt"]):
-        context.user_data["last_login"] = datetime.datetime.now()
-
         # Load wallet
-        wallet = Wallet.from_password(password)
+        try:
+            wallet = await Wallet.from_password_async(password)
+        except DerivationPoolBusy:
+            await context.user_data["msg"].edit_text(SERVICE_BUSY)
+            return "check-password"
+
+        # Logging in again keeps the wallet and the seqno of the transfers still in flight
+        current = context.user_data.get("wallet")
+        if current is not None and current.address == wallet.address:
+            wallet = current
+
+        context.user_data["last_login"] = datetime.datetime.now()
         await wallet.load_state()
         context.user_data["wallet"] = wallet
+        watch_deposits(context.application, update.effective_user.id)
 
         if redirect_state := context.user_data.get("redirect"):
             context.user_data.pop("redirect")
@@ -146,12 +241,17 @@ async def confirm_password_handler(update: Update, context: ContextTypes.DEFAULT
     password_data = context.user_data["prepassword"]
     password = update.message.text
     if is_password_valid(password, password_data["hash"], password_data["salt"]):
+        # Create wallet
+        effective_password = f"{password} {update.effective_user.id}"
+        try:
+            wallet = await Wallet.from_password_async(effective_password)
+        except DerivationPoolBusy:
+            await context.user_data["msg"].edit_text(SERVICE_BUSY)
+            return "confirm_password"
+
         context.user_data.pop("prepassword")
         context.user_data["password"] = password_data
 
-        # Create wallet
-        effective_password = f"{password} {update.effective_user.id}"
-        wallet = Wallet.from_password(effective_password)
         await wallet.load_state()
         try:
             await wallet.initialize()
@@ -160,6 +260,7 @@ async def confirm_password_handler(update: Update, context: ContextTypes.DEFAULT
 
         context.user_data["wallet"] = wallet
         context.user_data["last_login"] = datetime.datetime.now()
+        watch_deposits(context.application, update.effective_user.id)
 
         # await context.bot.set_chat_menu_button(
         #     update.effective_chat.id,
@@ -191,14 +292,14 @@ async def send_address_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 
     context.user_data['send_address'] = address
 
-    fee = 0.05
-    context.user_data["send_fee"] = fee
+    wallet = context.user_data["wallet"]
+    fee = await quote_send_fee(context)
     min_send = 0.001
-    balance = context.user_data["wallet"].balance
+    balance = wallet.balance
 
     # Prepare the inline keyboard
     keyboard = [
-        [InlineKeyboardButton(f"Min: {min_send}", callback_data="min_send"), InlineKeyboardButton(f"Max: {balance-fee}", callback_data="max_send")],
+        [InlineKeyboardButton(f"Min: {min_send}", callback_data="min_send"), InlineKeyboardButton(f"Max: {max_send_amount(balance, fee)}", callback_data="max_send")],
         [InlineKeyboardButton("Cancel", callback_data="cancel-send")],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -212,6 +313,14 @@ async def send_address_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     return "send_amount"
 
 
+async def quote_send_fee(context: ContextTypes.DEFAULT_TYPE) -> float:
+    # Fee of the transfer to the current send address, kept for the confirmation and the receipt
+    fee = await context.user_data["wallet"].estimate_fee(
+        context.user_data["send_address"], context.user_data.get("send-comment", "todo-comment"))
+    context.user_data["send_fee"] = fee
+    return fee
+
+
 async def send_amount_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, amount: float = None):
     if amount is None:
         context.user_data['send_amount'] = update.message.text
@@ -221,7 +330,7 @@ async def send_amount_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     balance = context.user_data["wallet"].balance
     send_address = context.user_data['send_address']
     send_amount = float(context.user_data['send_amount'])
-    fee = 0.05
+    fee = await quote_send_fee(context)
     total_amount = send_amount + fee
     balance_after = balance - total_amount
 
@@ -239,8 +348,10 @@ async def send_amount_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
         text=SEND_CONFIRM.format(
             address=send_address,
             amount=send_amount,
+            fiat_amount=fiat_value(context, send_amount),
             fee=fee,
             total_amount=round(total_amount, 5),
+            fiat_total=fiat_value(context, total_amount),
             balance_after=round(balance_after, 5),
         ),
         reply_markup=reply_markup,
@@ -279,7 +390,7 @@ async def send_confirm_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             return
 
         await context.user_data["wallet"].transfer(send_amount, send_address, comment=comment)
-        await context.user_data["wallet"].load_state()
+        watch_transfer(chat_id, context, send_amount, send_address)
 
         await send_receipt(chat_id, context)
         await show_wallet_options(update, context)
@@ -314,9 +425,13 @@ async def min_send_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await send_amount_handler(update, context, amount=amount)
 
 
+def max_send_amount(balance: float, fee: float) -> float:
+    # Everything but the fee, in whole nanotons
+    return max(round(balance - fee, 9), 0)
+
+
 async def max_send_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    fee = 0.05
-    amount = float(context.user_data["wallet"].balance) - fee
+    amount = max_send_amount(float(context.user_data["wallet"].balance), await quote_send_fee(context))
     await send_amount_handler(update, context, amount=amount)
 
 
@@ -409,6 +524,49 @@ async def display_wordlist_handler(update: Update, context: ContextTypes.DEFAULT
         return 'check-password'
 
 
+async def history_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 0):
+    wallet = context.user_data["wallet"]
+    if page == 0:
+        # Opening the history only fetches what is newer than the stored transactions
+        await wallet.load_state()
+        await Wallet.history.sync(wallet.address, last_lt=wallet.last_lt)
+
+    transactions, has_older = await Wallet.history.page(wallet.address, page, HISTORY_PAGE_SIZE)
+    context.user_data["history_page"] = page
+
+    lines = []
+    for transaction in transactions:
+        message = HISTORY_IN if transaction.amount >= 0 else HISTORY_OUT
+        lines.append(message.format(
+            amount=to_ton(abs(transaction.amount)),
+            address=transaction.counterparty or "-",
+            time=datetime.datetime.fromtimestamp(transaction.utime).strftime("%d %b %Y %H:%M"),
+        ))
+
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("< Newer", callback_data="history-prev"))
+    if has_older:
+        navigation.append(InlineKeyboardButton("Older >", callback_data="history-next"))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton("< Wallet", callback_data="back")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await context.user_data["msg"].edit_text(
+        HISTORY.format(transactions="\n\n".join(lines) or HISTORY_EMPTY),
+        reply_markup=reply_markup,
+        parse_mode=ParseMode.HTML,
+    )
+
+
+async def history_next_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await history_handler(update, context, page=context.user_data.get("history_page", 0) + 1)
+
+
+async def history_prev_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await history_handler(update, context, page=max(context.user_data.get("history_page", 0) - 1, 0))
+
+
 async def refresh_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer("Refreshing", show_alert=False)
     await context.user_data["wallet"].load_state()
@@ -441,6 +599,9 @@ handlers = {
     "wordlist": display_wordlist_handler,
     "refresh": refresh_handler,
     "deeplink": deeplink_handler,
+    "history": history_handler,
+    "history-next": history_next_handler,
+    "history-prev": history_prev_handler,
 }
 
 deeplink_handlers = {
@@ -32,12 +32,37 @@ INVALID_ADDRESS = "🚫 Invalid Address\n\n" \
                "Send the TON wallet address in text message here."
 
 
+FIAT = " (≈ {value:,.2f} {currency})"
+
 SEND_CONFIRM = "➡️ Withdrawal confirmation: TON\n\n" \
                "<b>Address</b>: {address}\n\n" \
-               "<b>Amount</b>: {amount} TON\n" \
+               "<b>Amount</b>: {amount} TON{fiat_amount}\n" \
                "<b>Fee</b>: {fee} TON\n" \
-               "<b>Total amount</b>: {total_amount} TON\n" \
+               "<b>Total amount</b>: {total_amount} TON{fiat_total}\n" \
                "<b>Balance after</b>: {balance_after} TON\n\n" \
                "Do you confirm this operation?"
 
+TRANSFER_CONFIRMED = "✅ Transfer confirmed\n\n" \
+                     "<b>{amount}</b> TON{fiat} arrived at <code>{address}</code>"
+
+TRANSFER_UNCONFIRMED = "⚠️ Transfer not confirmed yet\n\n" \
+                       "The transfer of <b>{amount}</b> TON to <code>{address}</code> " \
+                       "has not landed yet, check your balance later"
+
+DEPOSIT_RECEIVED = "➕ Deposit received\n\n" \
+                   "<b>{amount}</b> TON from <code>{address}</code>"
+
 SETTINGS = "⚙️ Settings"
+
+SERVICE_BUSY = "⏳ Service Busy\n\n" \
+               "Too many wallets are being unlocked right now.\n" \
+               "Please send your password again in a moment"
+
+HISTORY = "📜 History: TON\n\n" \
+          "{transactions}"
+
+HISTORY_EMPTY = "No transactions yet"
+
+HISTORY_IN = "➕ <b>{amount}</b> TON from <code>{address}</code>\n<i>{time}</i>"
+
+HISTORY_OUT = "➖ <b>{amount}</b> TON to <code>{address}</code>\n<i>{time}</i>"
@@ -0,0 +1,223 @@
+import asyncio
+import datetime
+import enum
+import json
+import logging
+from collections import OrderedDict
+
+from telegram import TelegramObject
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+# Parameters that make up what a message looks like
+RENDER_KEYS = ("text", "caption", "parse_mode", "entities", "caption_entities", "reply_markup",
+               "disable_web_page_preview")
+EDIT_ENDPOINTS = ("editMessageText", "editMessageCaption", "editMessageReplyMarkup")
+# Only these count against the Telegram message limits, answers to queries are never held back
+PACED_PREFIXES = ("send", "edit", "copy", "forward")
+
+
+def _json_value(value):
+    # The data reaches the rate limiter as passed to the bot method, not yet serialized
+    if isinstance(value, TelegramObject):
+        return value.to_dict()
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    return str(value)
+
+
+class _Bucket:
+    # Token bucket handing out reservations: a caller past the burst waits its turn
+    def __init__(self, rate: float, burst: int, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def reserve(self, now: float) -> float:
+        # Reservations may be made for a moment ahead of the last one, time never runs back
+        self.tokens = min(self.burst, self.tokens + max(0.0, now - self.updated) * self.rate) - 1
+        self.updated = max(self.updated, now)
+        return max(0.0, -self.tokens / self.rate)
+
+    def idle(self, now: float) -> bool:
+        return self.tokens + max(0.0, now - self.updated) * self.rate >= self.burst
+
+
+class OutboundScheduler(BaseRateLimiter):
+    """Schedules the Bot API calls of the bot
+
+    The last rendered text and markup of every message is remembered and edits that would
+    not change it are answered locally. An edit waiting for its turn is replaced by a newer
+    edit of the same message and endpoint, only the latest one is sent and every caller gets
+    its result. Edits of different endpoints are sent one after the other, in order.
+    Sends and edits are paced per chat (`chat_rate`/s, bursts of `chat_burst`) and overall
+    (`global_rate`/s), and a flood wait (RetryAfter) is slept off up to `max_retries` times.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: int = 5,
+                 max_retries: int = 3, max_rendered: int = 10000):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_rendered = max_rendered
+
+        self.skipped = 0
+        self.coalesced = 0
+        self.retried = 0
+
+        self._global = None
+        self._chats = {}
+        self._rendered = OrderedDict()
+        self._pending = {}
+
+    async def initialize(self) -> None:
+        self._global = _Bucket(self.global_rate, max(int(self.global_rate), 1), asyncio.get_running_loop().time())
+
+    async def shutdown(self) -> None:
+        self._chats.clear()
+        self._pending.clear()
+
+    # Rendered messages
+
+    @staticmethod
+    def _message_key(endpoint: str, data: dict):
+        if data.get("inline_message_id"):
+            return "inline", data["inline_message_id"]
+        if endpoint in EDIT_ENDPOINTS or endpoint == "deleteMessage":
+            return str(data.get("chat_id")), int(data["message_id"])
+        return None
+
+    @staticmethod
+    def _fingerprint(endpoint: str, data: dict) -> str:
+        # Markup only edits leave the text alone, the text edits drop the markup they leave out
+        keys = ("reply_markup",) if endpoint == "editMessageReplyMarkup" else RENDER_KEYS
+        return json.dumps(
+            {key: data[key] for key in keys if data.get(key) is not None}, default=_json_value, sort_keys=True)
+
+    def _remember(self, key, endpoint: str, data: dict, result):
+        if endpoint == "editMessageReplyMarkup":
+            # Keep the text part, only the markup changed
+            previous = self._rendered.get(key)
+            fingerprint = json.loads(previous[0]) if previous else {}
+            fingerprint.pop("reply_markup", None)
+            fingerprint.update(json.loads(self._fingerprint(endpoint, data)))
+            fingerprint = json.dumps(fingerprint, sort_keys=True)
+        else:
+            fingerprint = self._fingerprint(endpoint, data)
+
+        self._rendered[key] = (fingerprint, result)
+        self._rendered.move_to_end(key)
+        while len(self._rendered) > self.max_rendered:
+            self._rendered.popitem(last=False)
+
+    def _unchanged(self, key, endpoint: str, data: dict):
+        rendered = self._rendered.get(key)
+        if rendered is None:
+            return False
+        if endpoint == "editMessageReplyMarkup":
+            return json.loads(rendered[0]).get("reply_markup") == json.loads(self._fingerprint(endpoint, data)).get(
+                "reply_markup")
+        return rendered[0] == self._fingerprint(endpoint, data)
+
+    # Requests
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        key = self._message_key(endpoint, data)
+
+        if endpoint == "deleteMessage":
+            self._rendered.pop(key, None)
+            return await self._send(callback, args, kwargs, endpoint, data)
+
+        if endpoint not in EDIT_ENDPOINTS:
+            result = await self._send(callback, args, kwargs, endpoint, data)
+            if endpoint == "sendMessage" and isinstance(result, dict) and "message_id" in result:
+                self._remember((str(data.get("chat_id")), int(result["message_id"])), endpoint, data, result)
+            return result
+
+        previous = self._pending.get(key)
+        if previous is not None and previous["call"][3] == endpoint:
+            # The last queued edit has not been sent yet and is of the same kind, it sends this one instead
+            previous["call"] = (callback, args, kwargs, endpoint, data)
+            self.coalesced += 1
+            return await asyncio.shield(previous["future"])
+
+        if previous is None and self._unchanged(key, endpoint, data):
+            self.skipped += 1
+            return self._rendered[key][1]
+
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        pending = self._pending[key] = {"call": (callback, args, kwargs, endpoint, data), "future": future}
+        try:
+            if previous is not None:
+                # A text edit and a markup edit change different parts, both are sent in order
+                await asyncio.wait((previous["future"],))
+            await self._wait_turn(endpoint, data)
+            if self._pending.get(key) is pending:
+                del self._pending[key]
+
+            callback, args, kwargs, endpoint, data = pending["call"]
+            if self._unchanged(key, endpoint, data):
+                self.skipped += 1
+                result = self._rendered[key][1]
+            else:
+                result = await self._call(callback, args, kwargs, endpoint, data)
+                self._remember(key, endpoint, data, result)
+        except BaseException as e:
+            if self._pending.get(key) is pending:
+                del self._pending[key]
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            elif not future.done():
+                future.set_exception(e)
+            raise
+
+        future.set_result(result)
+        return result
+
+    async def _send(self, callback, args, kwargs, endpoint: str, data: dict):
+        await self._wait_turn(endpoint, data)
+        return await self._call(callback, args, kwargs, endpoint, data)
+
+    async def _call(self, callback, args, kwargs, endpoint: str, data: dict):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retried += 1
+                logger.warning("%s to chat %s hit the flood limit, retrying in %ss",
+                               endpoint, data.get("chat_id"), e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                # Our copy of the message was stale (e.g. after a restart), it already looks like this
+                if endpoint in EDIT_ENDPOINTS and "message is not modified" in e.message.lower():
+                    return True
+                raise
+
+    async def _wait_turn(self, endpoint: str, data: dict):
+        if not endpoint.startswith(PACED_PREFIXES):
+            return
+
+        now = asyncio.get_running_loop().time()
+        delay = 0.0
+        chat_id = data.get("chat_id")
+        if chat_id is not None:
+            bucket = self._chats.get(chat_id)
+            if bucket is None:
+                if len(self._chats) > self.max_rendered:
+                    self._chats = {chat: bucket for chat, bucket in self._chats.items() if not bucket.idle(now)}
+                bucket = self._chats[chat_id] = _Bucket(self.chat_rate, self.chat_burst, now)
+            delay = bucket.reserve(now)
+
+        delay = max(delay, self._global.reserve(now + delay) + delay)
+        if delay:
+            await asyncio.sleep(delay)
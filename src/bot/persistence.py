@@ -0,0 +1,374 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import pickle
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+
+from telegram import Bot, TelegramObject
+from telegram.ext import BasePersistence, PersistenceInput, PicklePersistence
+
+from wallet.metrics import PERSISTENCE_FLUSH
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS chat_data (chat_id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS bot_data (key TEXT PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS conversations (name TEXT, key TEXT, state BLOB, PRIMARY KEY (name, key));
+CREATE TABLE IF NOT EXISTS wallets (user_id INTEGER PRIMARY KEY, address TEXT NOT NULL, deposit_lt INTEGER);
+"""
+
+_BOT_ID = "bot"
+
+
+class _BotPickler(pickle.Pickler):
+    # Telegram objects are stored as their API dict and rebuilt around the running bot
+    def __init__(self, bot: Bot, file):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.bot = bot
+
+    def reducer_override(self, obj):
+        if not isinstance(obj, TelegramObject):
+            return NotImplemented
+
+        return obj.__class__.de_json, (obj.to_dict(), self.bot)
+
+    def persistent_id(self, obj):
+        if isinstance(obj, Bot):
+            return _BOT_ID
+        return None
+
+
+class _BotUnpickler(pickle.Unpickler):
+    def __init__(self, bot: Bot, file):
+        super().__init__(file)
+        self.bot = bot
+
+    def persistent_load(self, pid):
+        if pid == _BOT_ID:
+            return self.bot
+        raise pickle.UnpicklingError(f"Unknown persistent id {pid}")
+
+
+class SQLitePersistence(BasePersistence):
+    """Persistence on SQLite (WAL mode) that stores every user, chat and bot_data key as its own row
+
+    Only the users and chats that changed since the last run are written, all writes queued
+    during one persistence run are committed in a single transaction, and all pickling and
+    database I/O runs on a dedicated thread.
+
+    user_data is not loaded at startup, a user's row is loaded on his first update (see
+    refresh_user_data). The loaded users are kept in `sessions` by last access, evicting one
+    writes it back and lets the application drop it from memory. The wallet address of every
+    user is kept in its own table, with the last deposit reported to him even when he is not loaded.
+
+    With `owns` the database is shared by several shards and only the users it accepts are
+    written by this one. The others are read afresh on every refresh and never written. The
+    legacy data of all users is migrated by `prepare` before the shards start.
+    """
+
+    def __init__(self, filepath: str, legacy_filepath: str = None, update_interval: float = 60, owns=None):
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=update_interval)
+        self.filepath = filepath
+        self.legacy_filepath = legacy_filepath
+        self._owns = owns
+
+        # A single worker keeps the connection on one thread and the writes in order
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistence")
+        self._connection = None
+        self._opened = None
+        self._pending = []
+        self._commit = None
+
+        # What was last written, so unchanged bot data is not rewritten
+        self._bot_data_rows = {}
+
+        # Loaded users by last access, their user_data, the digest of their stored row and the
+        # evicted ones whose drop from the application must not delete their row
+        self.sessions = OrderedDict()
+        self._live = {}
+        self._digests = {}
+        self._evicted = set()
+
+    # Serialization
+
+    def _dumps(self, obj) -> bytes:
+        buffer = io.BytesIO()
+        _BotPickler(self.bot, buffer).dump(obj)
+        return buffer.getvalue()
+
+    def _loads(self, data: bytes):
+        return _BotUnpickler(self.bot, io.BytesIO(data)).load()
+
+    # Thread side
+
+    async def _call(self, func, *args):
+        await self._open()
+        return await self._thread(func, *args)
+
+    async def _thread(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _open(self):
+        if self._opened is None:
+            self._opened = asyncio.ensure_future(self._initialize())
+        await asyncio.shield(self._opened)
+
+    async def _initialize(self):
+        # Shard workers find the database migrated by the front, see prepare
+        if await self._thread(self._connect) and self._owns is None:
+            await self._migrate()
+        await self._thread(self._index_wallets)
+
+    async def prepare(self):
+        """Creates the database and migrates the legacy data into it, then closes it
+
+        Run once by the sharded front before it starts the workers sharing the database.
+        """
+        await self._open()
+        await self.flush()
+
+    def _connect(self) -> bool:
+        self._connection = sqlite3.connect(self.filepath, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+
+        empty = not any(
+            self._connection.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone()
+            for table in ("user_data", "chat_data", "bot_data")
+        )
+        return empty and self.legacy_filepath is not None and os.path.exists(self.legacy_filepath)
+
+    def _select(self, query: str, params=()):
+        return self._connection.execute(query, params).fetchall()
+
+    def _execute(self, statements):
+        with self._connection:
+            for statement in statements:
+                statement(self._connection)
+
+    async def _write(self, statement):
+        # Writes issued together (one persistence run) are committed in one transaction
+        self._pending.append(statement)
+        if self._commit is None:
+            self._commit = asyncio.ensure_future(self._commit_pending())
+        await asyncio.shield(self._commit)
+
+    async def _commit_pending(self):
+        await asyncio.sleep(0)
+        statements, self._pending, self._commit = self._pending, [], None
+        with PERSISTENCE_FLUSH.time():
+            await self._thread(self._execute, statements)
+
+    def owns(self, user_id: int) -> bool:
+        return self._owns is None or self._owns(user_id)
+
+    @staticmethod
+    def _digest(blob: bytes) -> bytes:
+        return hashlib.blake2b(blob, digest_size=16).digest()
+
+    def _store_user(self, connection, user_id: int, data, owned_only: bool = True):
+        if owned_only and not self.owns(user_id):
+            return
+
+        blob = self._dumps(data)
+        digest = self._digest(blob)
+        if self._digests.get(user_id) == digest:
+            return
+
+        connection.execute("INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)", (user_id, blob))
+        self._digests[user_id] = digest
+
+        wallet = data.get("wallet")
+        if wallet is not None:
+            connection.execute(
+                "INSERT INTO wallets (user_id, address, deposit_lt) VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET address = excluded.address, "
+                "deposit_lt = NULLIF(MAX(IFNULL(deposit_lt, 0), IFNULL(excluded.deposit_lt, 0)), 0)",
+                (user_id, wallet.address, getattr(wallet, "deposit_lt", None)),
+            )
+
+    def _index_wallets(self):
+        # Databases written before the wallets table existed, indexed once
+        if self._connection.execute("SELECT 1 FROM wallets LIMIT 1").fetchone():
+            return
+
+        with self._connection:
+            for user_id, data in self._select("SELECT user_id, data FROM user_data"):
+                wallet = self._loads(data).get("wallet")
+                if wallet is not None:
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO wallets (user_id, address, deposit_lt) VALUES (?, ?, ?)",
+                        (user_id, wallet.address, getattr(wallet, "deposit_lt", None)),
+                    )
+
+    async def _migrate(self):
+        legacy = PicklePersistence(filepath=self.legacy_filepath, store_data=self.store_data)
+        legacy.set_bot(self.bot)
+
+        for user_id, data in (await legacy.get_user_data()).items():
+            await self._write(
+                lambda connection, user_id=user_id, data=data: self._store_user(connection, user_id, data, False))
+        for chat_id, data in (await legacy.get_chat_data()).items():
+            await self.update_chat_data(chat_id, data)
+        await self.update_bot_data(await legacy.get_bot_data())
+
+    # Loading
+
+    async def get_user_data(self):
+        # Users are loaded on their first update, see refresh_user_data
+        await self._open()
+        return {}
+
+    async def get_chat_data(self):
+        rows = await self._call(self._select, "SELECT chat_id, data FROM chat_data")
+        return {chat_id: self._loads(data) for chat_id, data in rows}
+
+    async def get_bot_data(self):
+        rows = await self._call(self._select, "SELECT key, data FROM bot_data")
+        self._bot_data_rows = dict(rows)
+        return {key: self._loads(data) for key, data in rows}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str):
+        rows = await self._call(self._select, "SELECT key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(key)): self._loads(state) for key, state in rows}
+
+    # Writing
+
+    async def update_user_data(self, user_id: int, data) -> None:
+        # A user that was never loaded (or was evicted) only has a placeholder in the application
+        if user_id not in self.sessions:
+            return
+
+        await self._write(lambda connection: self._store_user(connection, user_id, data))
+
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        def statement(connection):
+            connection.execute(
+                "INSERT OR REPLACE INTO chat_data (chat_id, data) VALUES (?, ?)", (chat_id, self._dumps(data)))
+
+        await self._write(statement)
+
+    async def update_bot_data(self, data) -> None:
+        def statement(connection):
+            data_rows = {key: self._dumps(value) for key, value in data.items()}
+
+            for key, blob in data_rows.items():
+                if self._bot_data_rows.get(key) != blob:
+                    connection.execute("INSERT OR REPLACE INTO bot_data (key, data) VALUES (?, ?)", (key, blob))
+            for key in self._bot_data_rows.keys() - data_rows.keys():
+                connection.execute("DELETE FROM bot_data WHERE key = ?", (key,))
+            self._bot_data_rows = data_rows
+
+        await self._write(statement)
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        def statement(connection):
+            if new_state is None:
+                connection.execute(
+                    "DELETE FROM conversations WHERE name = ? AND key = ?", (name, json.dumps(key)))
+            else:
+                connection.execute(
+                    "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                    (name, json.dumps(key), self._dumps(new_state)),
+                )
+
+        await self._write(statement)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if user_id in self._evicted:
+            # Dropped from memory only, see evict_user_data. When the user came back before this
+            # run, the application skipped his pending write along with the drop
+            self._evicted.discard(user_id)
+            if user_id in self._live:
+                await self.update_user_data(user_id, deepcopy(self._live[user_id]))
+            return
+
+        def statement(connection):
+            connection.execute("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+            connection.execute("DELETE FROM wallets WHERE user_id = ?", (user_id,))
+            self._digests.pop(user_id, None)
+
+        self.sessions.pop(user_id, None)
+        self._live.pop(user_id, None)
+        await self._write(statement)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        await self._write(lambda connection: connection.execute(
+            "DELETE FROM chat_data WHERE chat_id = ?", (chat_id,)))
+
+    async def refresh_user_data(self, user_id: int, user_data) -> None:
+        # Called before each update of the user, loads him on the first one
+        if user_id not in self.sessions:
+            rows = await self._call(self._select, "SELECT data FROM user_data WHERE user_id = ?", (user_id,))
+            if user_id not in self.sessions and rows:
+                self._digests[user_id] = self._digest(rows[0][0])
+                for key, value in self._loads(rows[0][0]).items():
+                    user_data.setdefault(key, value)
+        elif not self.owns(user_id):
+            # Another shard keeps this user up to date
+            rows = await self._call(self._select, "SELECT data FROM user_data WHERE user_id = ?", (user_id,))
+            if rows:
+                user_data.clear()
+                user_data.update(self._loads(rows[0][0]))
+
+        self.sessions[user_id] = time.monotonic()
+        self.sessions.move_to_end(user_id)
+        self._live[user_id] = user_data
+
+    async def evict_user_data(self, user_id: int, data, keep=None) -> bool:
+        """Writes the user back if he changed and forgets him, unless an update of his came in meanwhile
+
+        `keep()` is asked once the write is done, e.g. whether updates of the user are queued.
+        On True the application must drop the user right away.
+        """
+        seen = self.sessions.get(user_id)
+        if seen is None:
+            return False
+
+        await self._write(lambda connection: self._store_user(connection, user_id, data))
+        if self.sessions.get(user_id) != seen or (keep is not None and keep()):
+            return False
+
+        del self.sessions[user_id]
+        self._live.pop(user_id, None)
+        self._digests.pop(user_id, None)
+        self._evicted.add(user_id)
+        return True
+
+    async def wallet_addresses(self):
+        """{user_id: (address, deposit_lt)} of every user with a wallet"""
+        rows = await self._call(self._select, "SELECT user_id, address, deposit_lt FROM wallets")
+        return {user_id: (address, deposit_lt) for user_id, address, deposit_lt in rows}
+
+    async def update_deposit_lt(self, user_id: int, lt: int) -> None:
+        await self._write(lambda connection: connection.execute(
+            "UPDATE wallets SET deposit_lt = MAX(IFNULL(deposit_lt, 0), ?) WHERE user_id = ?", (lt, user_id)))
+
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self._commit is not None:
+            await asyncio.shield(self._commit)
+
+        if self._connection is not None:
+            await self._thread(self._connection.close)
+            self._connection = None
+            self._opened = None
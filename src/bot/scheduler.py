@@ -0,0 +1,89 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class UserUpdateProcessor(BaseUpdateProcessor):
+    """Processes the updates of different users concurrently and the updates of one user in order
+
+    Every user has a lock that is taken in arrival order before the update runs, so the
+    per-user state machine in user_data never sees two updates at once. At most
+    `limit` updates run at the same time, and a user with more than
+    `max_user_pending` updates waiting has further updates dropped.
+    """
+
+    def __init__(self, limit: int, max_user_pending: int = 8):
+        # The base semaphore is taken before the user lock, it must never be the one that
+        # limits, otherwise a blocked user could hold the slots other users need
+        super().__init__(max_concurrent_updates=2 ** 16)
+        self.limit = limit
+        self.max_user_pending = max_user_pending
+        self.dropped = 0
+
+        self._running = asyncio.Semaphore(limit)
+        self._users = {}
+
+    @property
+    def active_users(self) -> int:
+        return len(self._users)
+
+    def busy(self, key) -> bool:
+        # Whether the user has updates running or queued
+        return key in self._users
+
+    @staticmethod
+    def _user_key(update: object):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        return None
+
+    @asynccontextmanager
+    async def turn(self, key):
+        """Waits for the updates of the user queued so far, later ones wait until the block is done
+
+        For work on a user's data outside of his updates, e.g. from a background task.
+        """
+        entry = self._users.get(key)
+        if entry is None:
+            entry = self._users[key] = [asyncio.Lock(), 0]
+
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._users.pop(key, None)
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self._user_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+
+        entry = self._users.get(key)
+        if entry is not None and entry[1] >= self.max_user_pending:
+            self.dropped += 1
+            logger.warning("Dropped update %s, user %s has %d updates pending", update.update_id, key, entry[1])
+            coroutine.close()
+            return
+
+        async with self.turn(key), self._running:
+            await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
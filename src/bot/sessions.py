@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import time
+from copy import deepcopy
+
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+
+class SessionEvictor:
+    """Drops the user_data of idle users from memory, so it follows the active users
+
+    Every `interval` seconds the users idle for more than `idle_ttl` seconds, and the least
+    recently active ones beyond `max_sessions`, are written back by the persistence and
+    dropped from the application. Users with updates running or queued are never evicted.
+    Their next update loads them again, see SQLitePersistence.refresh_user_data.
+    """
+
+    def __init__(self, application: Application, idle_ttl: float = 900, max_sessions: int = 10000,
+                 interval: float = 60):
+        self.application = application
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.interval = interval
+        self.evicted = 0
+
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.evict()
+            except Exception as e:
+                logger.warning("Session eviction failed: %r", e)
+
+    def _busy(self, user_id: int) -> bool:
+        busy = getattr(self.application.update_processor, "busy", None)
+        return busy is not None and busy(user_id)
+
+    def _candidates(self):
+        # Least recently active first, the idle ones and as many more as are over the limit
+        sessions = self.application.persistence.sessions
+        now = time.monotonic()
+        excess = len(sessions) - self.max_sessions
+        for user_id, seen in list(sessions.items()):
+            if now - seen <= self.idle_ttl and excess <= 0:
+                break
+            if not self._busy(user_id):
+                excess -= 1
+                yield user_id, seen
+
+    async def evict(self) -> int:
+        persistence = self.application.persistence
+        evicted = 0
+        for user_id, seen in list(self._candidates()):
+            data = self.application.user_data.get(user_id)
+            # The writes of the earlier candidates gave the user time to come back
+            if data is None or persistence.sessions.get(user_id) != seen or self._busy(user_id):
+                continue
+
+            # Written with a copy, the application keeps using the dict until it is dropped. An
+            # update queued during the write keeps the user, the check and the drop don't await
+            if await persistence.evict_user_data(user_id, deepcopy(data), keep=lambda: self._busy(user_id)):
+                self.application.drop_user_data(user_id)
+                evicted += 1
+
+        self.evicted += evicted
+        if evicted:
+            logger.info("Evicted %d idle user sessions, %d remain", evicted, len(persistence.sessions))
+        return evicted
@@ -0,0 +1,307 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+import secrets
+import signal
+import sys
+
+import aiohttp
+from aiohttp import web
+from telegram import Bot
+
+from .webhook import SECRET_HEADER, webhook_receiver, webhook_secret
+
+logger = logging.getLogger(__name__)
+
+# Update fields that carry the user who caused the update, in the order they are looked up
+USER_FIELDS = (
+    "message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+    "shipping_query", "pre_checkout_query", "poll_answer", "my_chat_member", "chat_member", "chat_join_request",
+)
+
+
+class ShardRing:
+    """Consistent hash ring over the shard indexes, `replicas` points per shard
+
+    Going from N to N+1 shards only moves about 1/(N+1) of the users to another shard.
+    """
+
+    def __init__(self, shards: int, replicas: int = 64):
+        self.shards = shards
+        points = sorted(
+            (self._hash(f"shard-{shard}-{replica}"), shard) for shard in range(shards) for replica in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def shard(self, user_id: int) -> int:
+        i = bisect.bisect(self._hashes, self._hash(str(user_id))) % len(self._hashes)
+        return self._shards[i]
+
+
+def shard_owner(index: int, count: int):
+    """Whether a user id belongs to shard `index` of `count`, None when not sharded"""
+    if count <= 1:
+        return None
+
+    ring = ShardRing(count)
+    return lambda user_id: ring.shard(user_id) == index
+
+
+def update_user_id(data: dict):
+    # Read from the raw update, the front never builds Update objects
+    for field in USER_FIELDS:
+        value = data.get(field)
+        if not value:
+            continue
+        user = value.get("from") or value.get("user") or {}
+        if "id" in user:
+            return user["id"]
+        chat = value.get("chat") or (value.get("message") or {}).get("chat") or {}
+        if "id" in chat:
+            return chat["id"]
+    return None
+
+
+class ShardRouter:
+    """Forwards raw updates to the worker that owns their user
+
+    Every worker has its own queue drained by one forwarder, so the updates of a user reach
+    his worker in the order they came in. A worker that refuses an update (its queue is full,
+    or it is restarting) gets it again after `retry_delay` seconds.
+    """
+
+    def __init__(self, urls, secret_token: str, queue_size: int = 1000, retry_delay: float = 0.5):
+        self.urls = list(urls)
+        self.secret_token = secret_token
+        self.retry_delay = retry_delay
+        self.ring = ShardRing(len(self.urls))
+        self.forwarded = [0] * len(self.urls)
+
+        self._queues = [asyncio.Queue(maxsize=queue_size) for _ in self.urls]
+        self._tasks = []
+        self._session = None
+
+    def queue(self, data: dict) -> asyncio.Queue:
+        user_id = update_user_id(data)
+        # Updates without a user are spread by update id
+        return self._queues[self.ring.shard(user_id if user_id is not None else data.get("update_id", 0))]
+
+    def put_nowait(self, data: dict):
+        self.queue(data).put_nowait(data)
+
+    async def put(self, data: dict):
+        await self.queue(data).put(data)
+
+    async def start(self):
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        self._tasks = [asyncio.ensure_future(self._forward(i)) for i in range(len(self.urls))]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+
+    async def _forward(self, i: int):
+        queue, url = self._queues[i], self.urls[i]
+        headers = {SECRET_HEADER: self.secret_token}
+        while True:
+            data = await queue.get()
+            while True:
+                try:
+                    async with self._session.post(url, json=data, headers=headers) as response:
+                        status = response.status
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    status = repr(e)
+
+                if status == 200:
+                    self.forwarded[i] += 1
+                    break
+                if status in (400, 403):
+                    logger.warning("Shard %d refused update %s with %s", i, data.get("update_id"), status)
+                    break
+                await asyncio.sleep(self.retry_delay)
+
+
+class ShardPeers:
+    """Calls into the worker that owns a user, for work only that worker may do
+
+    A user's wallet is signed with by his own worker only, under its transfer lock and with
+    its seqno, so the other workers ask it through `call` (the worker's "/calls/<name>" route).
+    """
+
+    def __init__(self, count: int, port: int, secret_token: str, timeout: float = 30):
+        self.port = port
+        self.secret_token = secret_token
+        self.timeout = timeout
+        self.ring = ShardRing(count)
+
+        self._session = None
+
+    @classmethod
+    def from_env(cls):
+        # Set up by worker_env, None when the bot is not sharded
+        count = int(os.environ.get("SHARD_COUNT", 1))
+        if count <= 1:
+            return None
+        return cls(count, int(os.environ["SHARD_PORT"]), os.environ["WEBHOOK_SECRET"])
+
+    async def call(self, user_id: int, name: str, data: dict) -> dict:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+        url = f"http://127.0.0.1:{self.port + self.ring.shard(user_id)}/calls/{name}"
+        async with self._session.post(url, json=data, headers={SECRET_HEADER: self.secret_token}) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+peers = ShardPeers.from_env()
+
+
+class WorkerProcess:
+    """One shard worker: the bot in webhook mode on a local port, restarted when it exits"""
+
+    def __init__(self, index: int, command, env: dict, restart_delay: float = 1):
+        self.index = index
+        self.command = command
+        self.env = env
+        self.restart_delay = restart_delay
+
+        self._process = None
+        self._task = None
+        self._stopping = False
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while not self._stopping:
+            self._process = await asyncio.create_subprocess_exec(*self.command, env=self.env)
+            code = await self._process.wait()
+            if not self._stopping:
+                logger.warning("Shard %d exited with %s, restarting", self.index, code)
+                await asyncio.sleep(self.restart_delay)
+
+    async def stop(self, timeout: float = 30):
+        self._stopping = True
+        if self._process is not None and self._process.returncode is None:
+            self._process.send_signal(signal.SIGTERM)
+            try:
+                await asyncio.wait_for(self._process.wait(), timeout)
+            except asyncio.TimeoutError:
+                self._process.kill()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+def worker_env(index: int, count: int, worker_port: int, secret_token: str) -> dict:
+    """Environment of shard `index`: a local webhook worker with its part of the shared limits"""
+    env = dict(os.environ)
+    env.update({
+        "BOT_MODE": "webhook",
+        "WEBHOOK_HOST": "127.0.0.1",
+        "WEBHOOK_PORT": str(worker_port + index),
+        "SHARD_PORT": str(worker_port),
+        "WEBHOOK_PATH": "/webhook",
+        "WEBHOOK_SECRET": secret_token,
+        "SHARD_INDEX": str(index),
+        "SHARD_COUNT": str(count),
+        # Telegram and toncenter limit the bot as a whole, the workers split them
+        "TELEGRAM_GLOBAL_RATE": str(float(os.environ.get("TELEGRAM_GLOBAL_RATE", 30)) / count),
+        "TONCENTER_RPS": str(float(os.environ.get("TONCENTER_RPS", 10)) / count),
+        "KEY_DERIVATION_WORKERS": os.environ.get(
+            "KEY_DERIVATION_WORKERS", str(max(1, (os.cpu_count() or 1) // count))),
+    })
+    env.pop("WEBHOOK_URL", None)
+    if int(os.environ.get("METRICS_PORT", 9101)):
+        env["METRICS_PORT"] = str(int(os.environ.get("METRICS_PORT", 9101)) + 1 + index)
+    return env
+
+
+async def run_front(token: str, shards: int, worker_port: int, mode: str = "polling", host: str = None,
+                    port: int = None, path: str = "/webhook", url: str = None, secret_token: str = None,
+                    allowed_updates=None, command=None, base_url: str = None):
+    """Runs `shards` workers and routes the updates of each user to one of them until SIGINT/SIGTERM
+
+    The front receives the updates by polling or on its own webhook (`host`, `port`, `path`,
+    Telegram is pointed at `url` when given, `secret_token` is required otherwise). Workers
+    listen on `worker_port` onwards and run `command`, the bot itself by default. `base_url`
+    replaces the Bot API server.
+    """
+    if mode == "webhook":
+        secret_token = webhook_secret(secret_token, url)
+
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopped.set)
+
+    worker_secret = secrets.token_urlsafe(32)
+    command = command or [sys.executable, os.path.abspath(sys.argv[0])]
+    workers = [
+        WorkerProcess(i, command, worker_env(i, shards, worker_port, worker_secret)) for i in range(shards)]
+    router = ShardRouter([f"http://127.0.0.1:{worker_port + i}/webhook" for i in range(shards)], worker_secret)
+
+    for worker in workers:
+        worker.start()
+    await router.start()
+    runner = None
+    try:
+        bot = Bot(token, base_url=base_url) if base_url else Bot(token)
+        async with bot:
+            if mode == "webhook":
+                app = web.Application()
+                app.router.add_post(path, webhook_receiver(router.put_nowait, secret_token))
+                runner = web.AppRunner(app)
+                await runner.setup()
+                await web.TCPSite(runner, host, port).start()
+                if url:
+                    await bot.set_webhook(url, secret_token=secret_token, allowed_updates=allowed_updates)
+                logger.info("Routing webhook updates on %s:%s%s to %d shards", host, port, path, shards)
+                await stopped.wait()
+            else:
+                await bot.delete_webhook()
+                logger.info("Routing polled updates to %d shards", shards)
+                await _poll(bot, router, stopped, allowed_updates)
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+        await router.stop()
+        await asyncio.gather(*(worker.stop() for worker in workers))
+
+
+async def _poll(bot: Bot, router: ShardRouter, stopped: asyncio.Event, allowed_updates=None):
+    offset = None
+    while not stopped.is_set():
+        polling = asyncio.ensure_future(bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates))
+        stopping = asyncio.ensure_future(stopped.wait())
+        await asyncio.wait([polling, stopping], return_when=asyncio.FIRST_COMPLETED)
+        stopping.cancel()
+        if not polling.done():
+            polling.cancel()
+            break
+
+        try:
+            updates = polling.result()
+        except Exception as e:
+            logger.warning("Polling failed: %r", e)
+            await asyncio.sleep(1)
+            continue
+
+        for update in updates:
+            # Waits while the worker's queue is full, so the front never runs ahead of the workers
+            await router.put(update.to_dict())
+            offset = update.update_id + 1
@@ -1,24 +1,47 @@
+import logging
+from contextlib import nullcontext
+
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ContextTypes
+from telegram.error import BadRequest
+from telegram.ext import Application, ContextTypes
 from telegram.constants import ParseMode
 
-from .messages import RECEIPT
+from .messages import FIAT, RECEIPT, TRANSFER_CONFIRMED, TRANSFER_UNCONFIRMED, DEPOSIT_RECEIVED
+
+from wallet.wallet import Wallet
+
+logger = logging.getLogger(__name__)
+
+
+def fiat_value(context: ContextTypes.DEFAULT_TYPE, amount: float) -> str:
+    # The amount in the user's currency from the shared price snapshot, empty without a fresh rate
+    currency = context.user_data.get("settings", {}).get("currency", "USD").upper()
+    value = Wallet.prices.value(amount, currency)
+    return "" if value is None else FIAT.format(value=value, currency=currency)
 
 
 async def show_wallet_options(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    wallet_balance = context.user_data["wallet"].balance
+    wallet = context.user_data["wallet"]
+    wallet_balance = wallet.balance
+    try:
+        jettons = await wallet.jetton_balances()
+    except Exception as e:
+        logger.warning("Loading the jetton balances failed: %r", e)
+        jettons = []
 
     # Prepare the inline keyboard
     keyboard = [
         [InlineKeyboardButton("➡️ Send", callback_data="send"), InlineKeyboardButton("➕ Receive", callback_data="receive")],
-        [InlineKeyboardButton("🔄 Refresh", callback_data="refresh")],
+        [InlineKeyboardButton("🔄 Refresh", callback_data="refresh"), InlineKeyboardButton("📜 History", callback_data="history")],
         [InlineKeyboardButton("⚙️ Settings", callback_data="settings")],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    # Show the wallet balance and options
+    # Show the wallet balance and options, until the next update the message stays this screen
+    context.user_data["screen"] = "wallet"
     await context.user_data["msg"].edit_text(
-        text=f"💰 My Wallet\n\nWallet balance: <code>{wallet_balance}</code> TON",
+        text=f"💰 My Wallet\n\nWallet balance: <code>{wallet_balance}</code> TON{fiat_value(context, wallet_balance)}"
+        + "".join(f"\n<code>{amount:g}</code> {jetton.symbol}" for jetton, amount in jettons),
         reply_markup=reply_markup,
         parse_mode=ParseMode.HTML,
     )
@@ -31,8 +54,6 @@ async def send_receipt(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
     send_address = context.user_data['send_address']
     send_total = round(send_amount + send_fee, 4)
 
-    await context.user_data["wallet"].transfer(send_amount, send_address, comment="todo-comment")
-
     await context.bot.send_message(
         chat_id,
         RECEIPT.format(amount=send_amount, fee=send_fee, total=send_total, address=send_address),
@@ -42,3 +63,64 @@ async def send_receipt(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
     old_msg = context.user_data["msg"]
     context.user_data["msg"] = new_message
     await old_msg.delete()
+
+
+def user_turn(application: Application, user_id: int):
+    # Runs a block like an update of the user would run, after his queued ones and alone
+    turn = getattr(application.update_processor, "turn", None)
+    return turn(user_id) if turn is not None else nullcontext()
+
+
+def watch_transfer(chat_id: int, context: ContextTypes.DEFAULT_TYPE, amount: float, address: str):
+    # Tell the user when the transfer just sent from his wallet lands. The wallet chat is the
+    # private chat with the user, its id is his
+    application = context.application
+    wallet = context.user_data["wallet"]
+    fiat = fiat_value(context, amount)
+
+    async def on_done(confirmed: bool, information: dict):
+        if not confirmed:
+            await application.bot.send_message(
+                chat_id, TRANSFER_UNCONFIRMED.format(amount=amount, address=address), parse_mode=ParseMode.HTML)
+            return
+
+        await application.bot.send_message(
+            chat_id, TRANSFER_CONFIRMED.format(amount=amount, fiat=fiat, address=address), parse_mode=ParseMode.HTML)
+
+        # The new balance is shown only on the wallet screen, not in the middle of another step,
+        # and the user's session may have been evicted meanwhile
+        async with user_turn(application, chat_id):
+            user_data = application.user_data.get(chat_id)
+            if user_data is None or user_data.get("screen") != "wallet":
+                return
+
+            await user_data["wallet"].load_state()
+            try:
+                await show_wallet_options(None, context)
+            except BadRequest:
+                pass
+
+    Wallet.confirmations.watch(wallet.address, wallet.sent_seqno, on_done)
+
+
+def watch_deposits(application: Application, user_id: int):
+    # Push a message to the user for every transfer that arrives to his wallet while he is active.
+    # Only the address is kept, the user's session may be evicted and loaded again in the meantime
+    wallet = application.user_data[user_id]["wallet"]
+    address = wallet.address
+    # Newer than the last deposit reported and than the state the wallet was last shown with
+    last_lt = max(getattr(wallet, "deposit_lt", None) or 0, wallet.last_lt or 0) or None
+
+    async def on_deposit(amount: float, source: str, lt: int):
+        await application.persistence.update_deposit_lt(user_id, lt)
+
+        wallet = application.user_data.get(user_id, {}).get("wallet")
+        if wallet is not None:
+            wallet.deposit_lt = lt
+            application.mark_data_for_update_persistence(user_ids=user_id)
+            await wallet.load_state()
+
+        await application.bot.send_message(
+            user_id, DEPOSIT_RECEIVED.format(amount=amount, address=source), parse_mode=ParseMode.HTML)
+
+    Wallet.deposits.watch(address, on_deposit, last_lt=last_lt)
@@ -0,0 +1,121 @@
+import asyncio
+import hmac
+import logging
+import secrets
+import signal
+from functools import partial
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def webhook_secret(secret_token: str = None, url: str = None) -> str:
+    """The secret token the webhook checks, generated when Telegram is pointed at `url` by us
+
+    Without a secret anyone who reaches the port could post updates for any user, so a
+    webhook that is set up elsewhere needs WEBHOOK_SECRET.
+    """
+    if secret_token:
+        return secret_token
+    if url:
+        return secrets.token_urlsafe(32)
+    raise ValueError("The webhook needs WEBHOOK_SECRET, or WEBHOOK_URL to set the webhook with a generated one")
+
+
+def webhook_receiver(put, secret_token: str):
+    """aiohttp handler that hands the update JSON Telegram posts to `put`
+
+    Requests without the right secret token are refused. Updates are acknowledged as soon as
+    `put` returns, when it raises QueueFull Telegram gets a 503 and retries later.
+    """
+    if not secret_token:
+        raise ValueError("The webhook needs a secret token")
+
+    async def receive(request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret_token):
+            return web.Response(status=403)
+
+        try:
+            put(await request.json())
+        except asyncio.QueueFull:
+            return web.Response(status=503)
+        except Exception as e:
+            logger.warning("Bad webhook update: %r", e)
+            return web.Response(status=400)
+
+        return web.Response()
+
+    return receive
+
+
+def call_receiver(handler, secret_token: str):
+    """aiohttp handler for the calls between shard workers, JSON in and `await handler(data)` out"""
+
+    async def receive(request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret_token):
+            return web.Response(status=403)
+        return web.json_response(await handler(await request.json()))
+
+    return receive
+
+
+def create_webhook_app(application: Application, secret_token: str, path: str = "/webhook",
+                       calls: dict = None) -> web.Application:
+    """aiohttp app that feeds the updates Telegram posts to `path` into the application's (bounded) update queue
+
+    `calls` maps names to `async handler(application, data)`, served on "/calls/<name>" with
+    the same secret token.
+    """
+
+    def put(data: dict):
+        application.update_queue.put_nowait(Update.de_json(data, application.bot))
+
+    app = web.Application()
+    app.router.add_post(path, webhook_receiver(put, secret_token))
+    for name, handler in (calls or {}).items():
+        app.router.add_post(f"/calls/{name}", call_receiver(partial(handler, application), secret_token))
+    return app
+
+
+async def run_webhook(application: Application, host: str, port: int, path: str = "/webhook",
+                      url: str = None, secret_token: str = None, allowed_updates=None, calls: dict = None):
+    """Runs the application on the local webhook server until SIGINT/SIGTERM
+
+    Telegram is pointed at `url` when it is given, otherwise the webhook is expected to be
+    set already (or updates to be posted by something else, e.g. a local test) with
+    `secret_token`, which is required then.
+    """
+    secret_token = webhook_secret(secret_token, url)
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopped.set)
+
+    runner = web.AppRunner(create_webhook_app(application, secret_token, path, calls))
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        if url:
+            await application.bot.set_webhook(url, secret_token=secret_token, allowed_updates=allowed_updates)
+        logger.info("Listening for webhook updates on %s:%s%s", host, port, path)
+
+        await stopped.wait()
+    finally:
+        await runner.cleanup()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -0,0 +1,63 @@
+import asyncio
+
+from wallet.limiter import Priority
+
+
+class AddressBatcher:
+    """Collects single address lookups for a short window and resolves them with one bulk fetch
+
+    Lookups of different priorities are batched separately, so an urgent lookup never waits for
+    a bulk fetch queued behind the rate limiter at a lower priority.
+    """
+
+    def __init__(self, fetch_many, window: float = 0.015, max_size: int = 50):
+        self.fetch_many = fetch_many
+        self.window = window
+        self.max_size = max_size
+        self._pending = {priority: {} for priority in Priority}
+        self._timers = {}
+        self._running = set()
+
+    async def get(self, address: str, priority: Priority = Priority.interactive):
+        pending = self._pending[priority]
+        future = pending.get(address)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            # Mark the exception as retrieved even if every waiter was cancelled
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            pending[address] = future
+
+            if len(pending) >= self.max_size:
+                self._flush(priority)
+            elif priority not in self._timers:
+                self._timers[priority] = asyncio.get_running_loop().call_later(
+                    self.window, self._flush, priority)
+
+        return await asyncio.shield(future)
+
+    def _flush(self, priority: Priority):
+        timer = self._timers.pop(priority, None)
+        if timer is not None:
+            timer.cancel()
+
+        batch, self._pending[priority] = self._pending[priority], {}
+        if not batch:
+            return
+
+        task = asyncio.ensure_future(self._run(batch, priority))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: dict, priority: Priority):
+        addresses = list(batch)
+        try:
+            results = await self.fetch_many(addresses, priority=priority)
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for address, result in zip(addresses, results):
+            if not batch[address].done():
+                batch[address].set_result(result)
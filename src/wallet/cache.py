@@ -0,0 +1,64 @@
+import asyncio
+import time
+from functools import partial
+
+from wallet.limiter import Priority
+
+
+class StateCache:
+    """Account state cache keyed by address, concurrent lookups of an address share one request"""
+
+    def __init__(self, ttl: float = 5, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._inflight = {}
+
+    async def get(self, address: str, fetch, priority: Priority = Priority.interactive):
+        entry = self._entries.get(address)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        # Only join a request that is at least as urgent, a transfer never waits on a background refresh
+        inflight_priority, task = self._inflight.get(address, (None, None))
+        if task is None or inflight_priority > priority:
+            task = asyncio.ensure_future(fetch(address, priority=priority))
+            task.add_done_callback(partial(self._store, address))
+            self._inflight[address] = (priority, task)
+
+        # Shield so one cancelled caller does not cancel the request for everybody else
+        return await asyncio.shield(task)
+
+    def _store(self, address: str, task: asyncio.Future):
+        current = self._inflight.get(address, (None, None))[1] is task
+
+        if task.cancelled() or task.exception() is not None:
+            if current:
+                self._inflight.pop(address)
+            return
+
+        # A request that was invalidated or overtaken while running may hold a stale answer
+        if not current:
+            return
+
+        self._inflight.pop(address)
+        if len(self._entries) >= self.max_entries:
+            self._purge()
+        self._entries[address] = (time.monotonic() + self.ttl, task.result())
+
+    def _purge(self):
+        now = time.monotonic()
+        for address in [address for address, (expires, _) in self._entries.items() if expires <= now]:
+            del self._entries[address]
+
+    def put(self, address: str, information: dict):
+        self._inflight.pop(address, None)
+        self._entries[address] = (time.monotonic() + self.ttl, information)
+
+    def invalidate(self, address: str):
+        self._entries.pop(address, None)
+        self._inflight.pop(address, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._inflight.clear()
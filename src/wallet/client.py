@@ -1,5 +1,8 @@
 from abc import ABC, abstractmethod
 import asyncio
+import base64
+import os
+import time
 
 import aiohttp
 from tvm_valuetypes import serialize_tvm_stack
@@ -7,18 +10,172 @@ from tonsdk.provider import ToncenterClient, ToncenterWrongResult, prepare_addre
 from tonsdk.utils import TonCurrencyEnum, from_nano
 from tonsdk.boc import Cell
 
+from wallet.limiter import Priority, RateLimiter
+from wallet.metrics import TONCENTER_ERRORS, TONCENTER_LATENCY, TONCENTER_TIMEOUTS
+
+
+class SessionPool:
+    """Process-wide keep-alive connection pool shared by every toncenter client"""
+
+    def __init__(self, limit_per_host: int = 20, dns_cache_ttl: int = 300, timeout: float = 5):
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = timeout
+        self._session = None
+
+    async def get(self) -> aiohttp.ClientSession:
+        # The session must be created inside the running loop, so it is built on first use
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=30,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+        self._session = None
+
+
+session_pool = SessionPool(
+    limit_per_host=int(os.environ.get("TONCENTER_CONNECTIONS", 20)),
+    dns_cache_ttl=int(os.environ.get("TONCENTER_DNS_CACHE_TTL", 300)),
+)
+
+
+class TonCenterProvider(ToncenterClient):
+    """ToncenterClient with the additional toncenter methods used by the wallet"""
+
+    def raw_get_wallet_information(self, prepared_address: str):
+        return self._jsonrpc_task("getWalletInformation", {"address": prepared_address})
+
+    def raw_get_transactions(self, prepared_address: str, limit: int, lt: int = None, hash: str = None,
+                             to_lt: int = 0):
+        params = {"address": prepared_address, "limit": limit, "to_lt": to_lt}
+        if lt is not None:
+            params["lt"] = lt
+            params["hash"] = hash
+        return self._jsonrpc_task("getTransactions", params)
+
+    def raw_estimate_fee(self, prepared_address: str, body: str, init_code: str = "", init_data: str = ""):
+        return self._jsonrpc_task("estimateFee", {
+            "address": prepared_address,
+            "body": body,
+            "init_code": init_code,
+            "init_data": init_data,
+            "ignore_chksig": True,
+        })
+
+    def _jsonrpc_task(self, method: str, params: dict):
+        return {
+            "func": self._jsonrpc_request,
+            "args": [method],
+            "kwargs": {"params": params},
+        }
+
+    def _headers(self):
+        headers = {
+            'Content-Type': 'application/json',
+            'accept': 'application/json',
+        }
+        if self.api_key:
+            headers["X-API-Key"] = self.api_key
+
+        return headers
+
+    async def _jsonrpc_request(self, session, method: str, params: dict):
+        payload = {
+            "id": "1",
+            "jsonrpc": "2.0",
+            "method": method,
+            "params": params,
+        }
+
+        async with session.post(self.base_url + "jsonRPC", json=payload, headers=self._headers()) as resp:
+            try:
+                result = await resp.json()
+            except Exception:
+                raise ToncenterWrongResult(resp.status)
+
+        if not result['ok']:
+            raise ToncenterWrongResult(result['code'])
+
+        return result['result']
+
+
+class JsonRpcBatchProvider(TonCenterProvider):
+    """Provider whose calls are jsonRPC requests, so any number of them can share one HTTP request"""
+
+    def raw_send_message(self, serialized_boc):
+        return {"method": "sendBoc", "params": {"boc": base64.b64encode(serialized_boc).decode()}}
+
+    def raw_run_method(self, address, method, stack_data, output_layout=None):
+        return {"method": "runGetMethod", "params": {"address": address, "method": method, "stack": stack_data}}
+
+    def raw_get_account_state(self, prepared_address: str):
+        return {"method": "getAddressInformation", "params": {"address": prepared_address}}
+
+    def _jsonrpc_task(self, method: str, params: dict):
+        return {"method": method, "params": params}
+
+    def batch_task(self, calls):
+        methods = {call["method"] for call in calls}
+        return {
+            "func": self._batch_request,
+            "args": [methods.pop() if len(methods) == 1 else "batch"],
+            "kwargs": {"calls": calls},
+        }
+
+    async def _batch_request(self, session, label: str, calls):
+        payload = [
+            {"id": i, "jsonrpc": "2.0", "method": call["method"], "params": call["params"]}
+            for i, call in enumerate(calls)
+        ]
+
+        async with session.post(self.base_url + "jsonRPC", json=payload, headers=self._headers()) as resp:
+            try:
+                results = await resp.json()
+            except Exception:
+                raise ToncenterWrongResult(resp.status)
+
+        # The whole batch was refused, e.g. rate limited
+        if isinstance(results, dict):
+            raise ToncenterWrongResult(results.get("code", resp.status))
+
+        by_id = {result.get("id"): result for result in results}
+        ordered = []
+        for i in range(len(calls)):
+            result = by_id.get(i)
+            if result is None:
+                raise ToncenterWrongResult(resp.status)
+            if not result.get("ok", "result" in result):
+                raise ToncenterWrongResult(result.get("code", 500))
+            ordered.append(result["result"])
+
+        return ordered
+
 
 class AbstractTonClient(ABC):
     @abstractmethod
-    async def _run(self, to_run, *, single_query=True):
+    async def _run(self, to_run, *, single_query=True, priority=Priority.interactive):
         raise NotImplemented
 
     async def get_address_information(self, address: str,
-                                currency_to_show: TonCurrencyEnum = TonCurrencyEnum.ton):
-        return (await self.get_addresses_information([address], currency_to_show))[0]
+                                currency_to_show: TonCurrencyEnum = TonCurrencyEnum.ton,
+                                priority: Priority = Priority.interactive):
+        return (await self.get_addresses_information([address], currency_to_show, priority))[0]
 
     async def get_addresses_information(self, addresses,
-                                  currency_to_show: TonCurrencyEnum = TonCurrencyEnum.ton):
+                                  currency_to_show: TonCurrencyEnum = TonCurrencyEnum.ton,
+                                  priority: Priority = Priority.interactive):
         if not addresses:
             return []
 
@@ -27,7 +184,7 @@ class AbstractTonClient(ABC):
             address = prepare_address(address)
             tasks.append(self.provider.raw_get_account_state(address))
 
-        results = await self._run(tasks, single_query=False)
+        results = await self._run(tasks, single_query=False, priority=priority)
 
         for result in results:
             result["state"] = address_state(result)
@@ -40,40 +197,143 @@ class AbstractTonClient(ABC):
 
         return results
 
-    async def seqno(self, addr: str):
+    async def get_wallets_information(self, addresses,
+                                      currency_to_show: TonCurrencyEnum = TonCurrencyEnum.ton,
+                                      priority: Priority = Priority.interactive):
+        # Balance, state and seqno of each wallet in one call per wallet
+        if not addresses:
+            return []
+
+        tasks = []
+        for address in addresses:
+            address = prepare_address(address)
+            tasks.append(self.provider.raw_get_wallet_information(address))
+
+        results = await self._run(tasks, single_query=False, priority=priority)
+
+        for result in results:
+            result["state"] = result.get("account_state", "uninitialized")
+            result["seqno"] = int(result.get("seqno") or 0)
+            if int(result["balance"]) < 0:
+                result["balance"] = 0
+            else:
+                result["balance"] = from_nano(int(result["balance"]), currency_to_show)
+
+        return results
+
+    async def get_transactions(self, address: str, limit: int = 20, lt: int = None, hash: str = None,
+                               to_lt: int = 0, priority: Priority = Priority.interactive):
+        # Newest first, starting at (lt, hash) when given and stopping at to_lt
+        address = prepare_address(address)
+        task = self.provider.raw_get_transactions(address, limit, lt, hash, to_lt)
+        return (await self._run(task, priority=priority))[0]
+
+    async def estimate_fee(self, address: str, body: bytes, init_code: bytes = None, init_data: bytes = None,
+                           priority: Priority = Priority.interactive):
+        # Fees of an external message, serialized cells in, fees in nanotons out
+        body, init_code, init_data = (base64.b64encode(boc).decode() if boc else "" for boc in (body, init_code, init_data))
+        task = self.provider.raw_estimate_fee(prepare_address(address), body, init_code, init_data)
+        return (await self._run(task, priority=priority))[0]
+
+    async def run_get_methods(self, calls, priority: Priority = Priority.interactive):
+        # (address, method, stack) calls in one run, a single request with batch clients
+        if not calls:
+            return []
+
+        tasks = [self.provider.raw_run_method(prepare_address(address), method, stack) for address, method, stack in calls]
+        return await self._run(tasks, single_query=False, priority=priority)
+
+    async def seqno(self, addr: str, priority: Priority = Priority.transfer):
         addr = prepare_address(addr)
-        result = await self._run(self.provider.raw_run_method(addr, "seqno", []))
+        result = await self._run(self.provider.raw_run_method(addr, "seqno", []), priority=priority)
 
         if 'stack' in result and ('@type' in result and result['@type'] == 'smc.runResult'):
             result['stack'] = serialize_tvm_stack(result['stack'])
 
         return result
 
-    async def send_boc(self, boc: Cell):
-        return await self._run(self.provider.raw_send_message(boc))
+    async def send_boc(self, boc: Cell, priority: Priority = Priority.transfer):
+        return await self._run(self.provider.raw_send_message(boc), priority=priority)
 
 
 class TonCenterTonClient(AbstractTonClient):
-    def __init__(self, toncenter_client: ToncenterClient):
+    # Retries of calls rejected with "429 Too Many Requests"
+    retries = 3
+    retry_backoff = 0.5
+
+    def __init__(self, toncenter_client: ToncenterClient, pool: SessionPool = session_pool,
+                 limiter: RateLimiter = None):
         self.provider = toncenter_client
+        self.pool = pool
+        self.limiter = limiter or RateLimiter(rate=float(os.environ.get("TONCENTER_RPS", 10)))
 
-    async def _run(self, to_run, *, single_query=True):
+    async def _run(self, to_run, *, single_query=True, priority=Priority.interactive):
         try:
-            return await self.__execute(to_run, single_query)
+            return await self._execute(to_run, single_query, priority)
 
         except (ToncenterWrongResult, asyncio.exceptions.TimeoutError, aiohttp.client_exceptions.ClientConnectorError):
             raise
 
-    async def __execute(self, to_run, single_query):
-        timeout = aiohttp.ClientTimeout(total=5)
+    async def close(self):
+        await self.pool.close()
+
+    async def _execute(self, to_run, single_query, priority):
+        session = await self.pool.get()
+
+        if single_query:
+            to_run = [to_run]
+
+        tasks = []
+        for task in to_run:
+            tasks.append(self._call(session, task, priority))
+
+        return await asyncio.gather(*tasks)
+
+    async def _call(self, session, task, priority):
+        # jsonRPC tasks carry the method name, the others the method url
+        method = task["args"][0].rsplit("/", 1)[-1]
 
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            if single_query:
-                to_run = [to_run]
+        for attempt in range(self.retries + 1):
+            await self.limiter.acquire(priority)
+            started = time.perf_counter()
+            try:
+                return await task["func"](session, *task["args"], **task["kwargs"])
+            except ToncenterWrongResult as e:
+                TONCENTER_ERRORS.inc(method=method, code=e.code)
+                if e.code != 429 or attempt == self.retries:
+                    raise
+            except asyncio.TimeoutError:
+                TONCENTER_TIMEOUTS.inc(method=method)
+                raise
+            except aiohttp.ClientError:
+                TONCENTER_ERRORS.inc(method=method, code="connection")
+                raise
+            finally:
+                TONCENTER_LATENCY.observe(time.perf_counter() - started, method=method)
 
-            tasks = []
-            for task in to_run:
-                tasks.append(task["func"](
-                    session, *task["args"], **task["kwargs"]))
+            await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+
+
+class TonCenterBatchClient(TonCenterTonClient):
+    """Client that sends up to `batch_size` calls of one run as a single jsonRPC batch request
+
+    Needs a JsonRpcBatchProvider. Each batch is one HTTP request and one rate limiter token.
+    """
+
+    def __init__(self, toncenter_client: JsonRpcBatchProvider, pool: SessionPool = session_pool,
+                 limiter: RateLimiter = None, batch_size: int = 100):
+        super().__init__(toncenter_client, pool, limiter)
+        self.batch_size = batch_size
+
+    async def _execute(self, to_run, single_query, priority):
+        session = await self.pool.get()
+
+        if single_query:
+            to_run = [to_run]
+
+        tasks = []
+        for i in range(0, len(to_run), self.batch_size):
+            batch = self.provider.batch_task(to_run[i:i + self.batch_size])
+            tasks.append(self._call(session, batch, priority))
 
-            return await asyncio.gather(*tasks)
\ No newline at end of file
+        return [result for results in await asyncio.gather(*tasks) for result in results]
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import time
+
+from wallet.limiter import Priority
+
+logger = logging.getLogger(__name__)
+
+
+class ConfirmationWatcher:
+    """Waits for sent transfers to land by polling the seqno of every pending wallet together
+
+    A transfer signed with seqno N is confirmed once the wallet seqno passes N. The poll
+    interval starts at `min_interval` whenever a new transfer is watched and grows up to
+    `max_interval` while nothing changes. Transfers still pending after `timeout` seconds
+    are reported as unconfirmed.
+    """
+
+    def __init__(self, client, state_cache=None, min_interval: float = 3, max_interval: float = 30,
+                 backoff: float = 1.5, timeout: float = 180):
+        self.client = client
+        self.state_cache = state_cache
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self._pending = {}
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self._callbacks = set()
+
+    @property
+    def pending(self) -> int:
+        return sum(len(watches) for watches in self._pending.values())
+
+    def watch(self, address: str, seqno: int, on_done):
+        """Calls `await on_done(confirmed, information)` once the transfer lands or times out
+
+        `information` is the wallet state that confirmed the transfer, None when it timed out.
+        """
+        deadline = time.monotonic() + self.timeout
+        self._pending.setdefault(address, []).append((seqno, deadline, on_done))
+
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        interval = self.min_interval
+
+        while self._pending:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), interval)
+                interval = self.min_interval
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            changed = await self._poll()
+            # Whether the poll worked or not, a watch past its deadline is over
+            self._expire(time.monotonic())
+
+            interval = self.min_interval if changed else min(interval * self.backoff, self.max_interval)
+
+    async def _poll(self) -> bool:
+        addresses = list(self._pending)
+        try:
+            results = await self.client.get_wallets_information(addresses, priority=Priority.background)
+        except Exception as e:
+            # One failing address fails the whole call, the others are polled on their own
+            logger.warning("Confirmation poll failed: %r", e)
+            results = await asyncio.gather(*(self._information(address) for address in addresses))
+
+        changed = False
+        for address, information in zip(addresses, results):
+            if information is None:
+                continue
+
+            confirmed = False
+            watches = []
+            for seqno, deadline, on_done in self._pending.get(address, []):
+                if information["seqno"] > seqno:
+                    self._notify(on_done, True, information)
+                    confirmed = True
+                else:
+                    watches.append((seqno, deadline, on_done))
+
+            # The answer is fresh, let the next load_state use it instead of fetching again
+            if confirmed and self.state_cache is not None:
+                self.state_cache.put(address, information)
+            changed = changed or confirmed
+
+            if watches:
+                self._pending[address] = watches
+            else:
+                self._pending.pop(address, None)
+
+        return changed
+
+    async def _information(self, address: str):
+        try:
+            return (await self.client.get_wallets_information([address], priority=Priority.background))[0]
+        except Exception as e:
+            logger.warning("Confirmation poll of %s failed: %r", address, e)
+            return None
+
+    def _expire(self, now: float):
+        for address in list(self._pending):
+            watches = []
+            for seqno, deadline, on_done in self._pending[address]:
+                if deadline < now:
+                    self._notify(on_done, False, None)
+                else:
+                    watches.append((seqno, deadline, on_done))
+
+            if watches:
+                self._pending[address] = watches
+            else:
+                del self._pending[address]
+
+    def _notify(self, on_done, confirmed: bool, information: dict):
+        task = asyncio.ensure_future(on_done(confirmed, information))
+        self._callbacks.add(task)
+        task.add_done_callback(self._callback_done)
+
+    def _callback_done(self, task: asyncio.Future):
+        self._callbacks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Confirmation callback failed", exc_info=task.exception())
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import time
+
+from wallet.limiter import Priority
+from wallet.utils import is_bounced, to_ton
+
+logger = logging.getLogger(__name__)
+
+
+class DepositMonitor:
+    """Keeps an index of active wallet addresses and reports their incoming transfers
+
+    Every `interval` seconds the state of all watched addresses is fetched in bulk. Only the
+    addresses whose last transaction moved past the last seen logical time are then scanned,
+    and only for the transactions newer than it. An address that was not watched again for
+    `idle_ttl` seconds is dropped, so the scans follow the active wallets only.
+    """
+
+    def __init__(self, client, state_cache=None, interval: float = 15, batch_size: int = 100,
+                 scan_limit: int = 20, idle_ttl: float = 3600):
+        self.client = client
+        self.state_cache = state_cache
+        self.interval = interval
+        self.batch_size = batch_size
+        self.scan_limit = scan_limit
+        self.idle_ttl = idle_ttl
+
+        # {address: [last seen lt, on_deposit, monotonic time it was last watched]}
+        self._index = {}
+        self._task = None
+        self._callbacks = set()
+
+    def __len__(self):
+        return len(self._index)
+
+    def watch(self, address: str, on_deposit, last_lt: int = None):
+        """Calls `await on_deposit(amount, source, lt)` for every incoming transfer after `last_lt`
+
+        Watching an address again keeps it watched for another `idle_ttl` seconds. The lt it
+        was scanned up to is kept, `last_lt` only seeds a new watch.
+        """
+        entry = self._index.get(address)
+        if entry is not None and entry[0] is not None:
+            last_lt = entry[0]
+        self._index[address] = [last_lt, on_deposit, time.monotonic()]
+
+    def unwatch(self, address: str):
+        self._index.pop(address, None)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.scan()
+            except Exception as e:
+                logger.warning("Deposit scan failed: %r", e)
+
+    async def scan(self):
+        now = time.monotonic()
+        for address in [address for address, entry in self._index.items() if now - entry[2] > self.idle_ttl]:
+            del self._index[address]
+
+        addresses = list(self._index)
+        for i in range(0, len(addresses), self.batch_size):
+            batch = addresses[i:i + self.batch_size]
+            results = await self.client.get_wallets_information(batch, priority=Priority.background)
+
+            changed = []
+            for address, information in zip(batch, results):
+                entry = self._index.get(address)
+                lt = int(information.get("last_transaction_id", {}).get("lt", 0))
+                if entry is None or (entry[0] is not None and lt <= entry[0]):
+                    continue
+
+                if self.state_cache is not None:
+                    self.state_cache.put(address, information)
+
+                if entry[0] is None:
+                    # First time we see this address, nothing to compare with yet
+                    entry[0] = lt
+                else:
+                    changed.append((address, entry, lt))
+
+            await asyncio.gather(*(self._scan_address(*item) for item in changed))
+
+    async def _transactions_since(self, address: str, to_lt: int) -> list:
+        # Newest first, one page of `scan_limit` at a time until to_lt is reached
+        transactions = []
+        lt = hash = None
+        while True:
+            page = await self.client.get_transactions(
+                address, limit=self.scan_limit, lt=lt, hash=hash, to_lt=to_lt, priority=Priority.background)
+            full = len(page) >= self.scan_limit
+            # A page starts at the transaction the previous one ended with
+            if transactions and page and page[0]["transaction_id"] == transactions[-1]["transaction_id"]:
+                page = page[1:]
+            if not page:
+                return transactions
+
+            transactions.extend(page)
+            if not full:
+                return transactions
+            lt, hash = int(page[-1]["transaction_id"]["lt"]), page[-1]["transaction_id"]["hash"]
+
+    async def _scan_address(self, address: str, entry: list, lt: int):
+        transactions = await self._transactions_since(address, entry[0])
+        seen_lt, entry[0] = entry[0], lt
+
+        for transaction in reversed(transactions):
+            transaction_lt = int(transaction["transaction_id"]["lt"])
+            in_msg = transaction.get("in_msg") or {}
+            value = int(in_msg.get("value") or 0)
+
+            # External messages (our own sends) have no source, bounces are our own sends coming back
+            if transaction_lt <= seen_lt or not in_msg.get("source") or value <= 0 or is_bounced(in_msg):
+                continue
+
+            self._notify(entry[1], to_ton(value), in_msg["source"], transaction_lt)
+
+    def _notify(self, on_deposit, amount: float, source: str, lt: int):
+        task = asyncio.ensure_future(on_deposit(amount, source, lt))
+        self._callbacks.add(task)
+        task.add_done_callback(self._callback_done)
+
+    def _callback_done(self, task: asyncio.Future):
+        self._callbacks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Deposit callback failed", exc_info=task.exception())
@@ -0,0 +1,64 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from tonsdk.contract.wallet import Wallets, WalletVersionEnum
+
+from wallet.utils import password_to_wordlist
+
+
+class DerivationPoolBusy(Exception):
+    pass
+
+
+def derive_keys(password: str, version: WalletVersionEnum, workchain: int):
+    # Runs in a worker process, both steps are PBKDF2 heavy
+    wordlist = password_to_wordlist(password=password)
+    _, pub_key, priv_key, _ = Wallets.from_mnemonics(mnemonics=wordlist, version=version, workchain=workchain)
+    return wordlist, pub_key, priv_key
+
+
+class KeyDerivationPool:
+    """Runs password to key derivation in worker processes, so it never blocks the event loop
+
+    At most `max_pending` derivations are accepted at once (running and queued), further
+    requests are rejected with DerivationPoolBusy instead of piling up behind the workers.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+        self._executor = None
+
+    @property
+    def queued(self) -> int:
+        return max(self.pending - self.workers, 0)
+
+    async def derive(self, password: str, version: WalletVersionEnum, workchain: int):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise DerivationPoolBusy()
+
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+        self.pending += 1
+        started = time.monotonic()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, derive_keys, password, version, workchain)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+            self.total_seconds += time.monotonic() - started
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import math
+import time
+from functools import partial
+
+from tonsdk.utils import Address, from_nano
+
+from wallet.limiter import Priority
+from wallet.metrics import FEE_QUOTES
+
+logger = logging.getLogger(__name__)
+
+
+class FeeQuotes:
+    """Transfer fee quotes from toncenter's estimateFee, cached by the shape of the transfer
+
+    The fee of a transfer depends on whether the wallet still has to be deployed, on the
+    destination's bounce flag and on the payload size, not on the amount or the wallet, so
+    one estimate serves every transfer of the same shape. Quotes older than `ttl` are served
+    while a fresh one is estimated in the background. A shape without a quote waits at most
+    `timeout` seconds for the estimate and is quoted `fallback` TON otherwise.
+    """
+
+    # Comments are bucketed by this many bytes, about a fifth of a cell
+    payload_bucket = 24
+
+    def __init__(self, client, ttl: float = 600, timeout: float = 1, fallback: float = 0.05, margin: float = 1.1):
+        self.client = client
+        self.ttl = ttl
+        self.timeout = timeout
+        self.fallback = fallback
+        self.margin = margin
+
+        self._quotes = {}
+        self._inflight = {}
+
+    def _key(self, wallet, address: str, comment: str):
+        payload = len(comment.encode()) if comment else 0
+        return wallet.initialized, Address(address).is_bounceable, math.ceil(payload / self.payload_bucket)
+
+    async def quote(self, wallet, address: str, comment: str = "", priority: Priority = Priority.interactive) -> float:
+        """Fee in TON of sending `comment` from `wallet` to `address`"""
+        key = self._key(wallet, address, comment)
+        quote = self._quotes.get(key)
+        if quote is not None:
+            if quote[0] <= time.monotonic():
+                FEE_QUOTES.inc(result="stale")
+                self._refresh(key, wallet, address, comment, Priority.background)
+            else:
+                FEE_QUOTES.inc(result="hit")
+            return quote[1]
+
+        task = self._refresh(key, wallet, address, comment, priority)
+        try:
+            fee = await asyncio.wait_for(asyncio.shield(task), self.timeout)
+        except Exception as e:
+            # The estimate keeps running and fills the cache for the next transfer
+            logger.warning("Fee estimate failed or is slow, quoting %s TON: %r", self.fallback, e)
+            FEE_QUOTES.inc(result="fallback")
+            return self.fallback
+
+        FEE_QUOTES.inc(result="miss")
+        return fee
+
+    def _refresh(self, key, wallet, address: str, comment: str, priority: Priority) -> asyncio.Future:
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(self._estimate(wallet, address, comment, priority))
+            task.add_done_callback(partial(self._store, key))
+        return task
+
+    def _store(self, key, task: asyncio.Future):
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        self._quotes[key] = (time.monotonic() + self.ttl, task.result())
+
+    async def _estimate(self, wallet, address: str, comment: str, priority: Priority) -> float:
+        # The transfer message the wallet would send, a deployment carries the wallet's code and data
+        seqno = 0 if not wallet.initialized else wallet.seqno or 1
+        message = wallet.create_transfer_message([(address, 0.001, comment)], seqno)
+        result = await self.client.estimate_fee(
+            wallet.address,
+            message["body"].to_boc(False),
+            message["code"].to_boc(False) if message["code"] else None,
+            message["data"].to_boc(False) if message["data"] else None,
+            priority=priority,
+        )
+
+        fees = result["source_fees"]
+        nanotons = sum(int(fees.get(name) or 0) for name in ("in_fwd_fee", "storage_fee", "gas_fee", "fwd_fee"))
+        # Rounded up to 0.0001 TON, with a margin for the storage fee growing until the transfer lands
+        return math.ceil(float(from_nano(nanotons, "ton")) * self.margin * 10000) / 10000
@@ -0,0 +1,224 @@
+import asyncio
+import sqlite3
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from wallet.limiter import Priority
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    address TEXT NOT NULL,
+    lt INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    utime INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    fee INTEGER NOT NULL,
+    counterparty TEXT,
+    comment TEXT,
+    PRIMARY KEY (address, lt)
+);
+CREATE TABLE IF NOT EXISTS history_cursors (
+    address TEXT PRIMARY KEY,
+    newest_lt INTEGER NOT NULL,
+    newest_hash TEXT NOT NULL,
+    oldest_lt INTEGER NOT NULL,
+    oldest_hash TEXT NOT NULL,
+    complete INTEGER NOT NULL
+);
+"""
+
+# Amount is signed nanotons: what came in minus what went out
+Transaction = namedtuple("Transaction", ["lt", "hash", "utime", "amount", "fee", "counterparty", "comment"])
+
+
+def parse_transaction(transaction: dict) -> Transaction:
+    in_msg = transaction.get("in_msg") or {}
+    out_msgs = transaction.get("out_msgs") or []
+
+    amount = int(in_msg.get("value") or 0) - sum(int(msg.get("value") or 0) for msg in out_msgs)
+    if in_msg.get("source"):
+        counterparty, comment = in_msg["source"], in_msg.get("message")
+    elif out_msgs:
+        counterparty, comment = out_msgs[0].get("destination"), out_msgs[0].get("message")
+    else:
+        counterparty, comment = None, None
+
+    return Transaction(
+        lt=int(transaction["transaction_id"]["lt"]),
+        hash=transaction["transaction_id"]["hash"],
+        utime=int(transaction.get("utime") or 0),
+        amount=amount,
+        fee=int(transaction.get("fee") or 0),
+        counterparty=counterparty,
+        comment=comment or None,
+    )
+
+
+class TransactionHistory:
+    """Local copy of the transactions of each wallet, read page by page
+
+    The newest end is synced from the newest stored (lt, hash) onwards, so only new
+    transactions are fetched. The first sync only takes one page, older pages are fetched
+    when a reader gets past the stored ones.
+    """
+
+    def __init__(self, client, filepath: str, fetch_limit: int = 20, max_sync_pages: int = 10):
+        self.client = client
+        self.filepath = filepath
+        self.fetch_limit = fetch_limit
+        self.max_sync_pages = max_sync_pages
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+        self._connection = None
+        self._locks = {}
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.filepath, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(SCHEMA)
+
+        return self._connection
+
+    def _select(self, query: str, params=()):
+        return self._connect().execute(query, params).fetchall()
+
+    def _lock(self, address: str) -> asyncio.Lock:
+        # One sync or backfill per address at a time
+        return self._locks.setdefault(address, asyncio.Lock())
+
+    async def _cursor(self, address: str):
+        rows = await self._call(
+            self._select,
+            "SELECT newest_lt, newest_hash, oldest_lt, oldest_hash, complete FROM history_cursors WHERE address = ?",
+            (address,),
+        )
+        return rows[0] if rows else None
+
+    async def _fetch(self, address: str, lt: int = None, hash: str = None, to_lt: int = 0,
+                     priority: Priority = Priority.interactive):
+        transactions = await self.client.get_transactions(
+            address, limit=self.fetch_limit, lt=lt, hash=hash, to_lt=to_lt, priority=priority)
+        return [parse_transaction(transaction) for transaction in transactions]
+
+    # Syncing
+
+    async def sync(self, address: str, last_lt: int = None, priority: Priority = Priority.interactive) -> int:
+        """Fetches the transactions newer than the stored ones, returns how many were new
+
+        `last_lt`, the lt of the newest transaction from the account state, skips the
+        request when nothing happened since the last sync.
+        """
+        async with self._lock(address):
+            cursor = await self._cursor(address)
+            if cursor is not None and last_lt is not None and last_lt <= cursor[0]:
+                return 0
+
+            newest_lt = cursor[0] if cursor is not None else 0
+            fetched = []
+            lt = hash = None
+            for _ in range(self.max_sync_pages if cursor is not None else 1):
+                page = await self._fetch(address, lt, hash, to_lt=newest_lt, priority=priority)
+                if lt is not None and page and page[0].lt == lt:
+                    page = page[1:]  # The page starts with the transaction it was asked from
+
+                new = [transaction for transaction in page if transaction.lt > newest_lt]
+                fetched.extend(new)
+                if len(new) < len(page) or len(page) < self.fetch_limit - 1 or not new:
+                    caught_up = True
+                    break
+                lt, hash = new[-1].lt, new[-1].hash
+            else:
+                caught_up = cursor is None
+
+            if fetched:
+                await self._call(self._store_newest, address, fetched, cursor, caught_up)
+            elif cursor is None:
+                await self._call(self._store_newest, address, [], None, True)
+            return len(fetched)
+
+    def _store_newest(self, address: str, transactions, cursor, caught_up: bool):
+        connection = self._connect()
+        with connection:
+            if cursor is not None and not caught_up:
+                # Too many new transactions to close the gap, start over from the newest ones
+                connection.execute("DELETE FROM transactions WHERE address = ?", (address,))
+                cursor = None
+
+            self._insert(connection, address, transactions)
+
+            if cursor is None:
+                newest = transactions[0] if transactions else None
+                oldest = transactions[-1] if transactions else None
+                complete = int(len(transactions) < self.fetch_limit)
+                connection.execute(
+                    "INSERT OR REPLACE INTO history_cursors VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        address,
+                        newest.lt if newest else 0, newest.hash if newest else "",
+                        oldest.lt if oldest else 0, oldest.hash if oldest else "",
+                        complete,
+                    ),
+                )
+            else:
+                connection.execute(
+                    "UPDATE history_cursors SET newest_lt = ?, newest_hash = ? WHERE address = ?",
+                    (transactions[0].lt, transactions[0].hash, address),
+                )
+
+    @staticmethod
+    def _insert(connection, address: str, transactions):
+        connection.executemany(
+            "INSERT OR IGNORE INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(address, *transaction) for transaction in transactions],
+        )
+
+    async def backfill(self, address: str, priority: Priority = Priority.interactive) -> int:
+        """Fetches one page older than the oldest stored transaction, returns how many were stored"""
+        async with self._lock(address):
+            cursor = await self._cursor(address)
+            if cursor is None or cursor[4]:
+                return 0
+
+            page = await self._fetch(address, cursor[2], cursor[3], priority=priority)
+            older = [transaction for transaction in page if transaction.lt < cursor[2]]
+            complete = len(page) < self.fetch_limit
+
+            def store():
+                connection = self._connect()
+                with connection:
+                    self._insert(connection, address, older)
+                    oldest_lt, oldest_hash = (older[-1].lt, older[-1].hash) if older else cursor[2:4]
+                    connection.execute(
+                        "UPDATE history_cursors SET oldest_lt = ?, oldest_hash = ?, complete = ? WHERE address = ?",
+                        (oldest_lt, oldest_hash, int(complete or not older), address),
+                    )
+
+            await self._call(store)
+            return len(older)
+
+    # Reading
+
+    async def page(self, address: str, number: int, page_size: int = 5, priority: Priority = Priority.interactive):
+        """Returns (transactions, has_older) for page `number`, newest first, backfilling when needed"""
+        while True:
+            rows = await self._call(
+                self._select,
+                "SELECT lt, hash, utime, amount, fee, counterparty, comment FROM transactions "
+                "WHERE address = ? ORDER BY lt DESC LIMIT ? OFFSET ?",
+                (address, page_size + 1, number * page_size),
+            )
+            if len(rows) > page_size:
+                return [Transaction(*row) for row in rows[:page_size]], True
+
+            if not await self.backfill(address, priority):
+                return [Transaction(*row) for row in rows], False
+
+    async def close(self):
+        if self._connection is not None:
+            await self._call(self._connection.close)
+            self._connection = None
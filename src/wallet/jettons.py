@@ -0,0 +1,199 @@
+import asyncio
+import base64
+import logging
+import sqlite3
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from tonsdk.boc import Cell, Slice
+from tonsdk.utils import Address
+
+from wallet.batcher import AddressBatcher
+from wallet.cache import StateCache
+from wallet.limiter import Priority
+
+logger = logging.getLogger(__name__)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jetton_wallets (
+    owner TEXT NOT NULL,
+    master TEXT NOT NULL,
+    address TEXT NOT NULL,
+    PRIMARY KEY (owner, master)
+);
+CREATE TABLE IF NOT EXISTS jetton_wallet_misses (
+    owner TEXT NOT NULL,
+    master TEXT NOT NULL,
+    checked_at REAL NOT NULL,
+    PRIMARY KEY (owner, master)
+);
+"""
+
+Jetton = namedtuple("Jetton", ["symbol", "master", "decimals"])
+
+
+def parse_jettons(spec: str):
+    """Jettons from "SYMBOL|master_address|decimals,...", decimals default to 9"""
+    jettons = []
+    for item in filter(None, (item.strip() for item in spec.split(","))):
+        symbol, master, decimals = (item.split("|") + [None])[:3]
+        jettons.append(Jetton(symbol, Address(master).to_string(False), int(decimals or 9)))
+    return jettons
+
+
+def address_slice(address: str) -> list:
+    # A get method argument holding an address
+    cell = Cell()
+    cell.bits.write_address(Address(address))
+    return ["tvm.Slice", base64.b64encode(cell.to_boc(False)).decode()]
+
+
+def stack_address(entry) -> str:
+    # Toncenter returns cells and slices as ["cell", {"bytes": boc}]
+    value = entry[1]
+    boc = value["bytes"] if isinstance(value, dict) else value
+    return Slice(Cell.one_from_boc(base64.b64decode(boc))).read_msg_addr().to_string(False)
+
+
+def stack_int(entry) -> int:
+    return int(entry[1], 16) if isinstance(entry[1], str) else int(entry[1])
+
+
+class JettonIndex:
+    """Jetton wallets of the users and their balances, for the configured jettons
+
+    The jetton wallet of an owner never changes, so it is resolved once (get_wallet_address
+    of every missing jetton in one run) and stored for good. A lookup the master refused,
+    e.g. a master that does not exist on this network, is stored too and not tried again
+    for `miss_ttl` seconds. Balances (get_wallet_data) are cached for `ttl` seconds like TON
+    balances, and the lookups of all users within `window` seconds are sent as one run, a
+    single request with a batch client.
+    """
+
+    def __init__(self, client, jettons, filepath: str, ttl: float = 5, window: float = 0.015,
+                 max_size: int = 50, max_owners: int = 100000, miss_ttl: float = 3600):
+        self.client = client
+        self.jettons = list(jettons)
+        self.filepath = filepath
+        self.max_owners = max_owners
+        self.miss_ttl = miss_ttl
+
+        self.cache = StateCache(ttl=ttl)
+        self.batcher = AddressBatcher(self._wallets_data, window=window, max_size=max_size)
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jettons")
+        self._connection = None
+        # {owner: ({master: jetton wallet}, {master: time its lookup was refused})}
+        self._wallets = OrderedDict()
+        self._resolving = {}
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.filepath, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(SCHEMA)
+
+        return self._connection
+
+    def _select(self, owner: str):
+        connection = self._connect()
+        return (
+            dict(connection.execute("SELECT master, address FROM jetton_wallets WHERE owner = ?", (owner,))),
+            dict(connection.execute("SELECT master, checked_at FROM jetton_wallet_misses WHERE owner = ?", (owner,))),
+        )
+
+    def _insert(self, owner: str, wallets: dict, misses: dict):
+        with self._connect() as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO jetton_wallets VALUES (?, ?, ?)",
+                [(owner, master, address) for master, address in wallets.items()],
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO jetton_wallet_misses VALUES (?, ?, ?)",
+                [(owner, master, checked_at) for master, checked_at in misses.items()],
+            )
+
+    def _missing(self, wallets: dict, misses: dict):
+        # Jettons without a wallet, but for the refused lookups that are not due again yet
+        now = time.time()
+        return [
+            jetton for jetton in self.jettons
+            if jetton.master not in wallets and now - misses.get(jetton.master, 0) >= self.miss_ttl
+        ]
+
+    # Jetton wallets
+
+    async def wallets(self, owner: str, priority: Priority = Priority.interactive) -> dict:
+        """{master: jetton wallet address} of the owner, for the jettons that could be resolved"""
+        owner = Address(owner).to_string(False)
+        entry = self._wallets.get(owner)
+        if entry is None or self._missing(*entry):
+            # Concurrent lookups of one owner share the resolution
+            task = self._resolving.get(owner)
+            if task is None:
+                task = self._resolving[owner] = asyncio.ensure_future(self._resolve(owner, priority))
+                task.add_done_callback(lambda _: self._resolving.pop(owner, None))
+            entry = await asyncio.shield(task)
+
+        self._wallets.move_to_end(owner)
+        return entry[0]
+
+    async def _resolve(self, owner: str, priority: Priority):
+        wallets, misses = self._wallets.get(owner) or await self._call(self._select, owner)
+        missing = self._missing(wallets, misses)
+        if missing:
+            try:
+                results = await self.client.run_get_methods(
+                    [(jetton.master, "get_wallet_address", [address_slice(owner)]) for jetton in missing],
+                    priority=priority,
+                )
+                resolved = {
+                    jetton.master: stack_address(result["stack"][0])
+                    for jetton, result in zip(missing, results) if result.get("exit_code") == 0
+                }
+                refused = {
+                    jetton.master: time.time()
+                    for jetton, result in zip(missing, results) if result.get("exit_code") != 0
+                }
+            except Exception as e:
+                # Shown without the jettons this time, resolved on the next lookup
+                logger.warning("Resolving the jetton wallets of %s failed: %r", owner, e)
+                resolved, refused = {}, {}
+
+            if resolved or refused:
+                await self._call(self._insert, owner, resolved, refused)
+            wallets, misses = {**wallets, **resolved}, {**misses, **refused}
+
+        entry = self._wallets[owner] = (wallets, misses)
+        while len(self._wallets) > self.max_owners:
+            self._wallets.popitem(last=False)
+        return entry
+
+    # Balances
+
+    async def _wallets_data(self, addresses, priority: Priority = Priority.interactive):
+        results = await self.client.run_get_methods(
+            [(address, "get_wallet_data", []) for address in addresses], priority=priority)
+        # A jetton wallet that never received anything is not deployed, its balance is 0
+        return [stack_int(result["stack"][0]) if result.get("exit_code") == 0 else 0 for result in results]
+
+    async def balances(self, owner: str, priority: Priority = Priority.interactive):
+        """[(jetton, balance in jetton units)] of every configured jetton the owner has a wallet of"""
+        if not self.jettons:
+            return []
+
+        wallets = await self.wallets(owner, priority)
+        jettons = [jetton for jetton in self.jettons if jetton.master in wallets]
+        amounts = await asyncio.gather(
+            *(self.cache.get(wallets[jetton.master], self.batcher.get, priority) for jetton in jettons))
+        return [(jetton, amount / 10 ** jetton.decimals) for jetton, amount in zip(jettons, amounts)]
+
+    async def close(self):
+        if self._connection is not None:
+            await self._call(self._connection.close)
+            self._connection = None
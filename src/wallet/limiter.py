@@ -0,0 +1,96 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from enum import IntEnum
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    # Lower values are served first
+    transfer = 0
+    interactive = 1
+    background = 2
+
+
+class RateLimiter:
+    """Token bucket that hands out tokens to waiting callers by priority, then by arrival order"""
+
+    slow_wait = 1.0
+
+    def __init__(self, rate: float, burst: int = None):
+        self.rate = rate
+        self.capacity = burst or max(int(rate), 1)
+        self._tokens = float(self.capacity)
+        self._updated = None
+        self._waiters = []
+        self._counter = itertools.count()
+        self._wakeup = None
+
+        self.queued = {priority: 0 for priority in Priority}
+        self.waited = {priority: 0.0 for priority in Priority}
+        self.served = {priority: 0 for priority in Priority}
+
+    async def acquire(self, priority: Priority = Priority.interactive) -> float:
+        loop = asyncio.get_running_loop()
+        self._refill(loop.time())
+
+        if not self._waiters and self._tokens >= 1:
+            self._tokens -= 1
+            self.served[priority] += 1
+            return 0.0
+
+        future = loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        self.queued[priority] += 1
+        self._schedule(loop)
+
+        started = loop.time()
+        try:
+            await future
+        finally:
+            self.queued[priority] -= 1
+
+        waited = loop.time() - started
+        self.waited[priority] += waited
+        self.served[priority] += 1
+        if waited > self.slow_wait:
+            logger.warning("toncenter %s call waited %.2fs for a rate limit token", priority.name, waited)
+
+        return waited
+
+    def stats(self) -> dict:
+        return {
+            priority.name: {
+                "queued": self.queued[priority],
+                "served": self.served[priority],
+                "waited": round(self.waited[priority], 3),
+            }
+            for priority in Priority
+        }
+
+    def _refill(self, now: float):
+        if self._updated is not None:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _schedule(self, loop):
+        if self._wakeup is None and self._waiters:
+            delay = max(1 - self._tokens, 0) / self.rate
+            self._wakeup = loop.call_later(delay, self._drain, loop)
+
+    def _drain(self, loop):
+        self._wakeup = None
+        self._refill(loop.time())
+
+        while self._waiters and self._tokens >= 1:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                # The waiter was cancelled
+                continue
+
+            self._tokens -= 1
+            future.set_result(None)
+
+        self._schedule(loop)
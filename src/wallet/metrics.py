@@ -0,0 +1,149 @@
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_registry = []
+
+
+def _escape(value) -> str:
+    # Label values in the text format escape backslashes, double quotes and line feeds
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    values = ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+    return "{" + values + "}"
+
+
+class Counter:
+    """Counter raised with `inc`, or read on every scrape from `function` like Gauge
+
+    `function` returns a total that only grows, {labels tuple: total} or a number.
+    """
+
+    def __init__(self, name: str, documentation: str, function=None, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.labelnames = labelnames
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        if self.function is None:
+            samples = [(dict(key), value) for key, value in self._values.items()]
+        else:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+            samples = [(dict(zip(self.labelnames, key)), value) for key, value in values.items()]
+
+        for labels, value in samples:
+            yield f"{self.name}{_labels(labels)} {value}"
+
+
+class Gauge:
+    """Gauge read on every scrape from `function`, which returns {labels tuple: value} or a number"""
+
+    def __init__(self, name: str, documentation: str, function, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.labelnames = labelnames
+        _registry.append(self)
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in values.items():
+            yield f"{self.name}{_labels(dict(zip(self.labelnames, key)))} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self._values = {}
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for key, (counts, total, count) in self._values.items():
+            labels = dict(key)
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                yield f"{self.name}_bucket{_labels({**labels, 'le': le})} {cumulative}"
+            yield f"{self.name}_sum{_labels(labels)} {total}"
+            yield f"{self.name}_count{_labels(labels)} {count}"
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    async def metrics(request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+# Shared metrics
+
+HANDLER_LATENCY = Histogram("twallet_handler_seconds", "Bot handler latency by state")
+TONCENTER_LATENCY = Histogram("twallet_toncenter_request_seconds", "Toncenter request latency by method")
+TONCENTER_ERRORS = Counter("twallet_toncenter_errors_total", "Toncenter requests that failed, by method and code")
+TONCENTER_TIMEOUTS = Counter("twallet_toncenter_timeouts_total", "Toncenter requests that timed out, by method")
+KEY_DERIVATION = Histogram(
+    "twallet_key_derivation_seconds", "Password to key derivation time", buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30))
+FEE_QUOTES = Counter("twallet_fee_quotes_total", "Fee quotes by result: hit, stale, miss or fallback")
+PERSISTENCE_FLUSH = Histogram("twallet_persistence_flush_seconds", "Time to commit one batch of persistence writes")
@@ -0,0 +1,129 @@
+from abc import ABC, abstractmethod
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class PriceSource(ABC):
+    """Where the TON rates come from, `fetch` returns {currency: fiat per TON}"""
+
+    @abstractmethod
+    async def fetch(self, currencies) -> dict:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class StaticRates(PriceSource):
+    """Fixed rates, for tests and benchmarks"""
+
+    def __init__(self, rates: dict):
+        self.rates = {currency.upper(): float(rate) for currency, rate in rates.items()}
+
+    @classmethod
+    def from_spec(cls, spec: str):
+        # "USD=2.5,ILS=9.1"
+        return cls(dict(item.strip().split("=") for item in spec.split(",") if item.strip()))
+
+    async def fetch(self, currencies) -> dict:
+        return {currency: self.rates[currency] for currency in currencies if currency in self.rates}
+
+
+class CoinGeckoRates(PriceSource):
+    """Rates from CoinGecko's simple/price, or any endpoint answering like it"""
+
+    def __init__(self, url: str = "https://api.coingecko.com/api/v3/simple/price", coin: str = "the-open-network",
+                 timeout: float = 10):
+        self.url = url
+        self.coin = coin
+        self.timeout = timeout
+        self._session = None
+
+    async def fetch(self, currencies) -> dict:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+        params = {"ids": self.coin, "vs_currencies": ",".join(currency.lower() for currency in currencies)}
+        async with self._session.get(self.url, params=params) as response:
+            response.raise_for_status()
+            prices = (await response.json()).get(self.coin, {})
+
+        return {currency: prices[currency.lower()] for currency in currencies if currency.lower() in prices}
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+class PriceFeed:
+    """One in-memory snapshot of the TON rates of every configured currency
+
+    The rates are fetched from `source` every `interval` seconds in the background, renders
+    only read the snapshot. A rate older than `max_age` seconds is stale and not shown, a
+    failed refresh is retried after `retry_delay` seconds and keeps the rates it has.
+    """
+
+    def __init__(self, source: PriceSource, currencies, interval: float = 60, max_age: float = 900,
+                 retry_delay: float = 10):
+        self.source = source
+        self.currencies = [currency.upper() for currency in currencies]
+        self.interval = interval
+        self.max_age = max_age
+        self.retry_delay = retry_delay
+        self.failures = 0
+
+        # {currency: (rate, monotonic time it was fetched)}
+        self._rates = {}
+        self._task = None
+
+    def rate(self, currency: str):
+        """Fiat per TON, None when the rate is unknown or stale"""
+        entry = self._rates.get(currency.upper())
+        if entry is None or time.monotonic() - entry[1] > self.max_age:
+            return None
+        return entry[0]
+
+    def value(self, amount: float, currency: str):
+        rate = self.rate(currency)
+        return None if rate is None else float(amount) * rate
+
+    def age(self, currency: str):
+        entry = self._rates.get(currency.upper())
+        return None if entry is None else time.monotonic() - entry[1]
+
+    def start(self):
+        if self.currencies and (self._task is None or self._task.done()):
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.source.close()
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+                delay = self.interval
+            except Exception as e:
+                self.failures += 1
+                logger.warning("Price refresh failed: %r", e)
+                delay = min(self.retry_delay, self.interval)
+            await asyncio.sleep(delay)
+
+    async def refresh(self):
+        rates = await self.source.fetch(self.currencies)
+        fetched = time.monotonic()
+        # Currencies missing from the answer keep their last rate until it goes stale
+        self._rates = {
+            **self._rates,
+            **{currency.upper(): (float(rate), fetched) for currency, rate in rates.items() if float(rate) > 0},
+        }
@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import time
+
+import aiohttp
+from tonsdk.provider import ToncenterWrongResult
+
+from wallet.client import (
+    AbstractTonClient,
+    JsonRpcBatchProvider,
+    TonCenterBatchClient,
+    TonCenterProvider,
+    TonCenterTonClient,
+    session_pool,
+)
+from wallet.limiter import Priority, RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+class _CallRecorder:
+    # Stands in for the provider, so calls can be replayed on whichever backend is picked
+    def __getattr__(self, name: str):
+        def record(*args, **kwargs):
+            return name, args, kwargs
+
+        return record
+
+
+class Backend:
+    """One endpoint with its health: latency and error rate averages and the breaker state"""
+
+    def __init__(self, name: str, client: TonCenterTonClient):
+        self.name = name
+        self.client = client
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.failures = 0
+        self.open_until = 0
+        self.probing = False
+
+    @property
+    def open(self) -> bool:
+        return self.open_until > time.monotonic()
+
+    @property
+    def score(self) -> float:
+        return self.latency * (1 + 10 * self.error_rate)
+
+
+class RoutedTonClient(AbstractTonClient):
+    """Client over several toncenter compatible endpoints
+
+    Reads go to the healthy backend with the best latency/error score. When it has not
+    answered after `hedge_delay` seconds the same read is sent to the next backend as well,
+    and the first answer wins. A read that fails on one backend moves on to the next one.
+    `failure_threshold` failures in a row open a backend's breaker for `cooldown` seconds,
+    after which a single request probes it. Sent messages go to every healthy backend.
+    """
+
+    # Weight of the newest sample in the latency and error rate averages
+    smoothing = 0.2
+
+    def __init__(self, backends, hedge_delay: float = 0.3, failure_threshold: int = 5, cooldown: float = 30):
+        self.backends = list(backends)
+        self.hedge_delay = hedge_delay
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.provider = _CallRecorder()
+
+        self._background = set()
+
+    @classmethod
+    def from_endpoints(cls, endpoints: str, rate: float = 10, batch_size: int = None, **kwargs):
+        """Builds the client from "url|api_key|rps,url|api_key|rps", the key and rate are optional
+
+        With `batch_size` the endpoints are called with jsonRPC batches of up to that many calls.
+        """
+        backends = []
+        for endpoint in filter(None, (endpoint.strip() for endpoint in endpoints.split(","))):
+            url, api_key, rps = (endpoint.split("|") + [None, None])[:3]
+            limiter = RateLimiter(rate=float(rps or rate))
+            if batch_size:
+                provider = JsonRpcBatchProvider(base_url=url, api_key=api_key or None)
+                client = TonCenterBatchClient(provider, session_pool, limiter, batch_size)
+            else:
+                provider = TonCenterProvider(base_url=url, api_key=api_key or None)
+                client = TonCenterTonClient(provider, session_pool, limiter)
+            backends.append(Backend(url, client))
+
+        return cls(backends, **kwargs)
+
+    async def close(self):
+        for pool in {id(backend.client.pool): backend.client.pool for backend in self.backends}.values():
+            await pool.close()
+
+    async def _run(self, to_run, *, single_query=True, priority=Priority.interactive):
+        calls = [to_run] if single_query else to_run
+        if calls and calls[0][0] == "raw_send_message":
+            return await self._broadcast(calls, single_query, priority)
+
+        return await self._read(calls, single_query, priority)
+
+    # Routing
+
+    def _ordered(self):
+        now = time.monotonic()
+        healthy = [
+            backend for backend in self.backends
+            if backend.failures < self.failure_threshold or (backend.open_until <= now and not backend.probing)
+        ]
+        if not healthy:
+            # Every breaker is open, trying the one that opened first beats failing right away
+            return sorted(self.backends, key=lambda backend: backend.open_until)
+
+        return sorted(healthy, key=lambda backend: backend.score)
+
+    async def _read(self, calls, single_query, priority):
+        candidates = iter(self._ordered())
+        pending = set()
+        error = None
+
+        try:
+            while True:
+                # At most one hedge in flight next to the original read
+                if len(pending) < 2:
+                    backend = next(candidates, None)
+                    if backend is not None:
+                        pending.add(asyncio.ensure_future(self._attempt(backend, calls, single_query, priority)))
+                if not pending:
+                    raise error
+
+                done, pending = await asyncio.wait(
+                    pending, timeout=self.hedge_delay, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+
+                    error = task.exception()
+                    if not self._is_failure(error, send=False):
+                        raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _broadcast(self, calls, single_query, priority):
+        backends = self._ordered()
+        tasks = [asyncio.ensure_future(self._attempt(backend, calls, single_query, priority)) for backend in backends]
+        errors = []
+
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                result = await next_done
+            except Exception as e:
+                errors.append(e)
+                continue
+
+            # The other backends keep sending in the background
+            for task in tasks:
+                if not task.done():
+                    self._background.add(task)
+                    task.add_done_callback(self._forget)
+            return result
+
+        # A toncenter answer (e.g. a rejected seqno) tells more than a connection error
+        raise next((e for e in errors if isinstance(e, ToncenterWrongResult)), errors[0])
+
+    def _forget(self, task: asyncio.Future):
+        self._background.discard(task)
+        if not task.cancelled():
+            task.exception()
+
+    # Health
+
+    async def _attempt(self, backend: Backend, calls, single_query, priority):
+        if backend.failures >= self.failure_threshold:
+            backend.probing = True
+
+        tasks = [getattr(backend.client.provider, name)(*args, **kwargs) for name, args, kwargs in calls]
+        started = time.monotonic()
+        try:
+            result = await backend.client._run(
+                tasks[0] if single_query else tasks, single_query=single_query, priority=priority)
+        except asyncio.CancelledError:
+            # Lost to a hedged read, it was at least this slow
+            self._record(backend, time.monotonic() - started, False)
+            raise
+        except Exception as e:
+            self._record(backend, time.monotonic() - started, self._is_failure(e, send=calls[0][0] == "raw_send_message"))
+            raise
+
+        self._record(backend, time.monotonic() - started, False)
+        return result
+
+    @staticmethod
+    def _is_failure(error: Exception, send: bool) -> bool:
+        # Whether the error is the backend's fault, rather than the request's
+        if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientError)):
+            return True
+        if isinstance(error, ToncenterWrongResult):
+            # Sent messages are rejected with 500 when they can't be applied, by every backend alike
+            return not send and (error.code == 429 or (isinstance(error.code, int) and error.code >= 500))
+        return False
+
+    def _record(self, backend: Backend, elapsed: float, failed: bool):
+        alpha = self.smoothing
+        backend.latency = elapsed if not backend.latency else (1 - alpha) * backend.latency + alpha * elapsed
+        backend.error_rate = (1 - alpha) * backend.error_rate + alpha * failed
+        backend.probing = False
+
+        if not failed:
+            if backend.failures >= self.failure_threshold:
+                logger.warning("Toncenter backend %s recovered", backend.name)
+            backend.failures = 0
+            return
+
+        backend.failures += 1
+        if backend.failures >= self.failure_threshold:
+            if not backend.open:
+                logger.warning("Toncenter backend %s failed %d times, opening its breaker", backend.name, backend.failures)
+            backend.open_until = time.monotonic() + self.cooldown
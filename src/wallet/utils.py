@@ -1,7 +1,9 @@
+import base64
 from random import seed, choices
 
 from tonsdk.crypto._mnemonic import english
 from tonsdk.crypto import mnemonic_is_valid
+from tonsdk.boc import Cell, Slice
 from tonsdk.utils import Address, InvalidAddressError, from_nano, TonCurrencyEnum
 
 
@@ -43,3 +45,17 @@ def is_unbounceable_address(address: str) -> bool:
 def change_address(address: str, bounceable: bool = True) -> str:
     addr = Address(address)
     return addr.to_string(is_user_friendly=True, is_url_safe=True, is_bounceable=bounceable)
+
+
+def is_bounced(message: dict) -> bool:
+    # A bounce carries the 0xffffffff op, toncenter only reports the flag in some versions
+    if message.get("bounced"):
+        return True
+
+    body = (message.get("msg_data") or {}).get("body")
+    if not body:
+        return False
+    try:
+        return Slice(Cell.one_from_boc(base64.b64decode(body))).read_uint(32) == 0xFFFFFFFF
+    except Exception:
+        return False
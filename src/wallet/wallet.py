@@ -1,28 +1,154 @@
+import asyncio
+import decimal
 import os
+import time
 from typing import List
 
-from tonsdk.utils import to_nano
+from tonsdk.boc import Cell
+from tonsdk.contract import Contract
+from tonsdk.utils import Address, to_nano
 from tonsdk.contract.wallet import WalletVersionEnum, Wallets, WalletContract, SendModeEnum
 
-from src.wallet.client import TonCenterTonClient, ToncenterClient, ToncenterWrongResult
-from src.wallet.utils import password_to_wordlist
+from wallet.batcher import AddressBatcher
+from wallet.cache import StateCache
+from wallet.client import (
+    JsonRpcBatchProvider,
+    TonCenterBatchClient,
+    TonCenterProvider,
+    TonCenterTonClient,
+    ToncenterWrongResult,
+)
+from wallet.confirmations import ConfirmationWatcher
+from wallet.deposits import DepositMonitor
+from wallet.derivation import KeyDerivationPool
+from wallet.fees import FeeQuotes
+from wallet.history import TransactionHistory
+from wallet.jettons import JettonIndex, parse_jettons
+from wallet.limiter import Priority
+from wallet.metrics import KEY_DERIVATION
+from wallet.prices import CoinGeckoRates, PriceFeed, StaticRates
+from wallet.router import RoutedTonClient
+from wallet.utils import password_to_wordlist
+
+
+class TransferUncertain(Exception):
+    """sendBoc failed in a way that does not tell whether the message was accepted
+
+    The seqno it was signed with stays taken, whether the wallet seqno passes it tells.
+    """
+
+    def __init__(self, seqno: int):
+        super().__init__(seqno)
+        self.seqno = seqno
 
 
 class Wallet:
     workchain: int = 0
     version = WalletVersionEnum.v3r2
-    send_mode = SendModeEnum.pay_gas_separately.value
-    toncenter_base_url = "https://toncenter.com/api/v2/"
+    send_mode = SendModeEnum.ignore_errors | SendModeEnum.pay_gas_separately
+    # A v3r2 external message carries up to 4 internal messages
+    max_messages = 4
+    # Transfer messages are valid for 60 seconds after signing, plus a margin for the network.
+    # Except with seqno 0, those are signed valid until 0xFFFFFFFF and may land any time
+    message_ttl = 60 + 15
+    toncenter_base_url = os.environ.get("TONCENTER_BASE_URL", "https://toncenter.com/api/v2/")
     toncenter_api_key = os.environ["TONCENTER_API_KEY"]
 
+    # Shared by every wallet so all of them reuse the same connection pool. With TONCENTER_ENDPOINTS
+    # ("url|api_key|rps,...") the calls are routed over several endpoints instead of the single one,
+    # with TONCENTER_BATCH_SIZE the calls of one run are sent as jsonRPC batches
+    toncenter_batch_size = int(os.environ.get("TONCENTER_BATCH_SIZE", 0))
+    if os.environ.get("TONCENTER_ENDPOINTS"):
+        client = RoutedTonClient.from_endpoints(
+            os.environ["TONCENTER_ENDPOINTS"],
+            rate=float(os.environ.get("TONCENTER_RPS", 10)),
+            batch_size=toncenter_batch_size,
+            hedge_delay=float(os.environ.get("TONCENTER_HEDGE_DELAY_MS", 300)) / 1000,
+            failure_threshold=int(os.environ.get("TONCENTER_BREAKER_FAILURES", 5)),
+            cooldown=float(os.environ.get("TONCENTER_BREAKER_COOLDOWN", 30)),
+        )
+    elif toncenter_batch_size:
+        client = TonCenterBatchClient(
+            JsonRpcBatchProvider(base_url=toncenter_base_url, api_key=toncenter_api_key),
+            batch_size=toncenter_batch_size,
+        )
+    else:
+        client = TonCenterTonClient(TonCenterProvider(base_url=toncenter_base_url, api_key=toncenter_api_key))
+    state_cache = StateCache(ttl=float(os.environ.get("STATE_CACHE_TTL", 5)))
+    state_batcher = AddressBatcher(
+        client.get_wallets_information,
+        window=float(os.environ.get("STATE_BATCH_WINDOW_MS", 15)) / 1000,
+        max_size=int(os.environ.get("STATE_BATCH_SIZE", 50)),
+    )
+    confirmations = ConfirmationWatcher(client, state_cache)
+    deposits = DepositMonitor(
+        client,
+        state_cache,
+        interval=float(os.environ.get("DEPOSIT_SCAN_INTERVAL", 15)),
+        idle_ttl=float(os.environ.get("DEPOSIT_WATCH_TTL", 3600)),
+    )
+    history = TransactionHistory(client, filepath=os.environ.get("HISTORY_DB", "../data/data.sqlite"))
+    fees = FeeQuotes(
+        client,
+        ttl=float(os.environ.get("FEE_QUOTE_TTL", 600)),
+        timeout=float(os.environ.get("FEE_QUOTE_TIMEOUT_MS", 1000)) / 1000,
+        fallback=float(os.environ.get("FEE_FALLBACK", 0.05)),
+    )
+    # JETTONS ("SYMBOL|master_address|decimals,...") are shown next to the TON balance
+    jettons = JettonIndex(
+        client,
+        parse_jettons(os.environ.get("JETTONS", "")),
+        filepath=os.environ.get("JETTON_DB", os.environ.get("HISTORY_DB", "../data/data.sqlite")),
+        ttl=float(os.environ.get("STATE_CACHE_TTL", 5)),
+        window=float(os.environ.get("STATE_BATCH_WINDOW_MS", 15)) / 1000,
+        max_size=int(os.environ.get("STATE_BATCH_SIZE", 50)),
+        miss_ttl=float(os.environ.get("JETTON_MISS_TTL", 3600)),
+    )
+    # TON rates of FIAT_CURRENCIES, from FIAT_RATES ("USD=2.5,...") when set instead of PRICE_API_URL
+    prices = PriceFeed(
+        StaticRates.from_spec(os.environ["FIAT_RATES"]) if os.environ.get("FIAT_RATES")
+        else CoinGeckoRates(os.environ.get("PRICE_API_URL", "https://api.coingecko.com/api/v3/simple/price")),
+        os.environ.get("FIAT_CURRENCIES", "USD,ILS").split(","),
+        interval=float(os.environ.get("PRICE_REFRESH_INTERVAL", 60)),
+        max_age=float(os.environ.get("PRICE_MAX_AGE", 900)),
+    )
+    derivation_pool = KeyDerivationPool(
+        workers=int(os.environ.get("KEY_DERIVATION_WORKERS", os.cpu_count() or 1)),
+        max_pending=int(os.environ.get("KEY_DERIVATION_MAX_PENDING", 32)),
+    )
+
     def __init__(self, private_key: bytes, public_key: bytes, wallet_contract: WalletContract, wordlist: list):
         self.private_key = private_key
         self.public_key = public_key
         self.wallet = wallet_contract
         self.wordlist = wordlist
 
-        toncenter_client = ToncenterClient(base_url=self.toncenter_base_url, api_key=self.toncenter_api_key)
-        self.client = TonCenterTonClient(toncenter_client)
+        # Next seqno to sign with, ahead of the chain while sent transfers are in flight
+        self.seqno = None
+        self.seqno_expires = 0
+        self.loaded_at = 0
+        self.last_lt = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_transfer_lock", None)
+        return state
+
+    def __setstate__(self, state):
+        # Wallets pickled before the client became shared still carry their own one
+        state.pop("client", None)
+        state.setdefault("seqno", None)
+        state.setdefault("seqno_expires", 0)
+        state.setdefault("loaded_at", 0)
+        state.setdefault("last_lt", None)
+        self.__dict__.update(state)
+
+    @property
+    def transfer_lock(self) -> asyncio.Lock:
+        # Transfers of one wallet must not race on the seqno
+        if "_transfer_lock" not in self.__dict__:
+            self._transfer_lock = asyncio.Lock()
+        return self._transfer_lock
 
     @property
     def address(self):
@@ -38,22 +164,48 @@ class Wallet:
 
     @classmethod
     def from_password(cls, password: str):
-        wordlist = password_to_wordlist(password=password)
-        return cls.from_wordlist(wordlist)
+        with KEY_DERIVATION.time(mode="sync"):
+            wordlist = password_to_wordlist(password=password)
+            return cls.from_wordlist(wordlist)
+
+    @classmethod
+    async def from_password_async(cls, password: str):
+        # Same as from_password, but the derivation runs in the worker pool
+        started = time.perf_counter()
+        wordlist, pub_key, priv_key = await cls.derivation_pool.derive(password, cls.version, cls.workchain)
+        KEY_DERIVATION.observe(time.perf_counter() - started, mode="pool")
+        wallet = Wallets.ALL[cls.version](public_key=pub_key, private_key=priv_key, wc=cls.workchain)
+        return Wallet(priv_key, pub_key, wallet, wordlist)
 
     @classmethod
     def from_wordlist(cls, wordlist: List[str]):
         _, pub_key, priv_key, wallet = Wallets.from_mnemonics(mnemonics=wordlist, version=cls.version, workchain=cls.workchain)
         return Wallet(priv_key, pub_key, wallet, wordlist)
 
-    async def load_state(self):
+    async def load_state(self, priority: Priority = Priority.interactive):
         # Load wallet state
-        information = await self.client.get_address_information(self.address)
+        information = await self.state_cache.get(self.address, self.state_batcher.get, priority)
         self.balance = float(information["balance"])
         self.state = information["state"]
+        self.loaded_at = time.time()
+        self.last_lt = int(information.get("last_transaction_id", {}).get("lt", 0))
+        self.sync_seqno(information["seqno"])
         if self.balance > 0 and not self.initialized:
             await self.initialize()
 
+    async def jetton_balances(self, priority: Priority = Priority.interactive):
+        # [(jetton, balance)] of the configured jettons, cached and batched like the TON balance
+        return await self.jettons.balances(self.address, priority)
+
+    async def estimate_fee(self, address: str, comment: str = "", priority: Priority = Priority.interactive) -> float:
+        # Fee in TON of a transfer to address, quoted from the cache when possible
+        return await self.fees.quote(self, address, comment, priority)
+
+    def sync_seqno(self, seqno: int):
+        # Keep a local seqno that is ahead of the chain unless its transfers can no longer land
+        if self.seqno is None or seqno >= self.seqno or time.time() > self.seqno_expires:
+            self.seqno = seqno
+
     async def initialize(self):
         result = self.wallet.create_init_external_message()
         boc = result["message"].to_boc(False)
@@ -61,17 +213,109 @@ class Wallet:
             return await self.client.send_boc(boc)
         except ToncenterWrongResult as e:
             print("Initialization error", e)
+        finally:
+            self.state_cache.invalidate(self.address)
 
     async def transfer(self, amount: float, address: str, comment: str):
-        await self.load_state()
-
-        nano_amount = to_nano(number=amount, unit="TON")
-        result = self.wallet.create_transfer_message(
-            address,
-            nano_amount,
-            payload=comment,
-            seqno=int((await self.client.seqno(self.address))[0]["stack"][0][1], 16)
-        )
-        boc = result["message"].to_boc(False)
-        result = await self.client.send_boc(boc)
-        return result
+        return await self._send([(address, amount, comment)])
+
+    async def transfer_many(self, transfers: List[tuple]):
+        """Sends (address, amount, comment) transfers packed `max_messages` per external message
+
+        A wallet only accepts its next message once the previous one landed, so the messages
+        are sent one after the other. Returns one result per transfer, in the given order.
+        """
+        results = []
+        landed = True
+        for i in range(0, len(transfers), self.max_messages):
+            chunk = transfers[i:i + self.max_messages]
+            seqno = error = None
+            last = i + self.max_messages >= len(transfers)
+
+            if i and not landed:
+                error = "previous message did not land"
+            else:
+                try:
+                    await self._send(chunk)
+                    seqno = self.sent_seqno
+                    if not last:
+                        landed = await self.wait_confirmed(seqno)
+                except TransferUncertain as e:
+                    # Whether it was sent after all, the wallet seqno tells
+                    seqno = e.seqno
+                    landed = await self.wait_confirmed(seqno)
+                    if not landed:
+                        error = repr(e)
+                except Exception as e:
+                    error = repr(e)
+
+            results.extend(
+                {"address": address, "amount": amount, "seqno": seqno, "error": error}
+                for address, amount, _ in chunk
+            )
+
+        return results
+
+    async def wait_confirmed(self, seqno: int) -> bool:
+        future = asyncio.get_running_loop().create_future()
+
+        async def on_done(confirmed: bool, information: dict):
+            future.set_result(confirmed)
+
+        self.confirmations.watch(self.address, seqno, on_done)
+        return await future
+
+    def create_transfer_message(self, transfers: List[tuple], seqno: int):
+        # Same as WalletContract.create_transfer_message, with one internal message per transfer
+        signing_message = self.wallet.create_signing_message(seqno)
+        for address, amount, comment in transfers:
+            payload = Cell()
+            if comment:
+                payload.bits.write_uint(0, 32)
+                payload.bits.write_string(comment)
+
+            header = Contract.create_internal_message_header(
+                Address(address), decimal.Decimal(to_nano(number=amount, unit="TON")))
+            signing_message.bits.write_uint8(self.send_mode)
+            signing_message.refs.append(Contract.create_common_msg_info(header, None, payload))
+
+        return self.wallet.create_external_message(signing_message, seqno)
+
+    async def _send(self, transfers: List[tuple]):
+        async with self.transfer_lock:
+            if self.seqno is None:
+                await self.load_state(priority=Priority.transfer)
+
+            for attempt in range(2):
+                seqno = self.seqno
+                boc = self.create_transfer_message(transfers, seqno)["message"].to_boc(False)
+                try:
+                    result = await self.client.send_boc(boc)
+                except ToncenterWrongResult:
+                    # Retry only if the chain shows the local seqno was off. While our previous
+                    # message may still land, reusing its seqno could silently drop one of them.
+                    self.state_cache.invalidate(self.address)
+                    await self.load_state(priority=Priority.transfer)
+                    if attempt or self.seqno == seqno:
+                        raise
+                    continue
+                except asyncio.CancelledError:
+                    self._sent(seqno)
+                    raise
+                except Exception as e:
+                    # A timeout or a dropped connection, toncenter may have taken the message all the same
+                    self._sent(seqno)
+                    raise TransferUncertain(seqno) from e
+                finally:
+                    self.state_cache.invalidate(self.address)
+
+                self._sent(seqno)
+                return result
+
+    def _sent(self, seqno: int):
+        # The next transfer signs after this one, until this one can no longer land
+        self.seqno = seqno + 1
+        self.seqno_expires = time.time() + self.message_ttl if seqno else float("inf")
+
+        # Watch this seqno with Wallet.confirmations to learn when the transfer landed
+        self.sent_seqno = seqno
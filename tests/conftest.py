@@ -0,0 +1,5 @@
+import os
+
+# The bot and wallet modules read their settings from the environment when imported
+os.environ.setdefault("BOT_TOKEN", "1:test")
+os.environ.setdefault("TONCENTER_API_KEY", "test")
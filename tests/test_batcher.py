@@ -0,0 +1,73 @@
+import asyncio
+
+from wallet.batcher import AddressBatcher
+from wallet.limiter import Priority
+
+
+class FakeFetchMany:
+    def __init__(self, error=None):
+        self.error = error
+        self.batches = []
+
+    async def __call__(self, addresses, priority=None):
+        self.batches.append((addresses, priority))
+        if self.error:
+            raise self.error
+        return [{"address": address} for address in addresses]
+
+
+def test_lookups_within_the_window_share_one_fetch():
+    async def run():
+        fetch = FakeFetchMany()
+        batcher = AddressBatcher(fetch, window=0.01)
+        results = await asyncio.gather(*(batcher.get(address) for address in ["a", "b", "a", "c"]))
+        return results, fetch.batches
+
+    results, batches = asyncio.run(run())
+    assert [result["address"] for result in results] == ["a", "b", "a", "c"]
+    assert batches == [(["a", "b", "c"], Priority.interactive)]
+
+
+def test_full_batch_is_fetched_without_waiting_for_the_window():
+    async def run():
+        fetch = FakeFetchMany()
+        batcher = AddressBatcher(fetch, window=10, max_size=2)
+        return await asyncio.wait_for(asyncio.gather(batcher.get("a"), batcher.get("b")), 1), fetch.batches
+
+    results, batches = asyncio.run(run())
+    assert [result["address"] for result in results] == ["a", "b"]
+    assert batches == [(["a", "b"], Priority.interactive)]
+
+
+def test_priorities_are_batched_separately():
+    async def run():
+        fetch = FakeFetchMany()
+        batcher = AddressBatcher(fetch, window=0.01)
+        await asyncio.gather(batcher.get("a", Priority.background), batcher.get("b", Priority.transfer))
+        return fetch.batches
+
+    batches = asyncio.run(run())
+    assert sorted(batches, key=lambda batch: batch[1]) == [(["b"], Priority.transfer), (["a"], Priority.background)]
+
+
+def test_failed_fetch_fails_every_lookup_of_the_batch():
+    async def run():
+        batcher = AddressBatcher(FakeFetchMany(RuntimeError("toncenter is down")), window=0.01)
+        return await asyncio.gather(batcher.get("a"), batcher.get("b"), return_exceptions=True)
+
+    assert [type(result) for result in asyncio.run(run())] == [RuntimeError, RuntimeError]
+
+
+def test_cancelled_lookup_does_not_cancel_the_batch():
+    async def run():
+        fetch = FakeFetchMany()
+        batcher = AddressBatcher(fetch, window=0.01)
+        cancelled = asyncio.ensure_future(batcher.get("a"))
+        other = asyncio.ensure_future(batcher.get("a"))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        return await other, fetch.batches
+
+    result, batches = asyncio.run(run())
+    assert result == {"address": "a"}
+    assert len(batches) == 1
@@ -0,0 +1,107 @@
+import asyncio
+
+from wallet.cache import StateCache
+from wallet.limiter import Priority
+
+ADDRESS = "EQ-wallet"
+
+
+class FakeFetch:
+    """Counts lookups and answers each with its own number, once `release` is set"""
+
+    def __init__(self):
+        self.calls = []
+        self.release = asyncio.Event()
+
+    async def __call__(self, address, priority=None):
+        self.calls.append(priority)
+        number = len(self.calls)
+        await self.release.wait()
+        return {"lookup": number}
+
+
+def test_concurrent_lookups_share_one_request():
+    async def run():
+        cache, fetch = StateCache(), FakeFetch()
+        waiters = [asyncio.ensure_future(cache.get(ADDRESS, fetch)) for _ in range(5)]
+        await asyncio.sleep(0)
+        fetch.release.set()
+        return await asyncio.gather(*waiters), fetch.calls
+
+    results, calls = asyncio.run(run())
+    assert results == [{"lookup": 1}] * 5
+    assert len(calls) == 1
+
+
+def test_answers_from_cache_until_the_ttl_or_an_invalidation():
+    async def run():
+        cache, fetch = StateCache(ttl=0.05), FakeFetch()
+        fetch.release.set()
+        results = [await cache.get(ADDRESS, fetch), await cache.get(ADDRESS, fetch)]
+        await asyncio.sleep(0.06)
+        results.append(await cache.get(ADDRESS, fetch))
+        cache.invalidate(ADDRESS)
+        results.append(await cache.get(ADDRESS, fetch))
+        return results
+
+    assert [result["lookup"] for result in asyncio.run(run())] == [1, 1, 2, 3]
+
+
+def test_a_request_running_across_an_invalidation_is_not_cached():
+    async def run():
+        cache, fetch = StateCache(), FakeFetch()
+        stale = asyncio.ensure_future(cache.get(ADDRESS, fetch))
+        await asyncio.sleep(0)
+        cache.invalidate(ADDRESS)
+        fetch.release.set()
+        await stale
+        return await cache.get(ADDRESS, fetch)
+
+    assert asyncio.run(run()) == {"lookup": 2}
+
+
+def test_urgent_lookup_does_not_join_a_background_request():
+    async def run():
+        cache, fetch = StateCache(), FakeFetch()
+        background = asyncio.ensure_future(cache.get(ADDRESS, fetch, Priority.background))
+        await asyncio.sleep(0)
+        transfer = asyncio.ensure_future(cache.get(ADDRESS, fetch, Priority.transfer))
+        interactive = asyncio.ensure_future(cache.get(ADDRESS, fetch, Priority.interactive))
+        await asyncio.sleep(0)
+        fetch.release.set()
+        return await asyncio.gather(background, transfer, interactive), fetch.calls
+
+    results, calls = asyncio.run(run())
+    assert calls == [Priority.background, Priority.transfer]
+    # The interactive lookup joined the more urgent transfer request
+    assert results == [{"lookup": 1}, {"lookup": 2}, {"lookup": 2}]
+
+
+def test_failed_request_is_not_cached():
+    attempts = []
+
+    async def fetch(address, priority=None):
+        attempts.append(address)
+        if len(attempts) == 1:
+            raise RuntimeError("toncenter is down")
+        return {"balance": "1"}
+
+    async def run():
+        cache = StateCache()
+        try:
+            await cache.get(ADDRESS, fetch)
+        except RuntimeError:
+            pass
+        return await cache.get(ADDRESS, fetch)
+
+    assert asyncio.run(run()) == {"balance": "1"}
+    assert len(attempts) == 2
+
+
+def test_put_answers_without_a_request():
+    async def run():
+        cache, fetch = StateCache(), FakeFetch()
+        cache.put(ADDRESS, {"balance": "2"})
+        return await cache.get(ADDRESS, fetch), fetch.calls
+
+    assert asyncio.run(run()) == ({"balance": "2"}, [])
@@ -0,0 +1,127 @@
+import asyncio
+import re
+from types import SimpleNamespace
+
+from bot.cheques import ChequeStore
+
+
+def store(tmp_path, **kwargs):
+    return ChequeStore(filepath=str(tmp_path / "cheques.sqlite"), secret=b"test secret", **kwargs)
+
+
+def test_id_fits_start_parameter(tmp_path):
+    cheque_id = store(tmp_path).new_id(2 ** 52, 10 ** 18)
+    # Telegram start parameters are up to 64 characters of A-Z, a-z, 0-9, _ and -
+    assert re.fullmatch(r"[A-Za-z0-9_-]{1,64}", f"accept-{cheque_id}")
+
+
+def test_unstored_cheque_is_claimed_once(tmp_path):
+    # Inline feedback off: the chosen result was never reported, only the id was handed out
+    cheques = store(tmp_path)
+
+    async def run():
+        cheque_id = cheques.new_id(42, 500_000_000)
+        first = await cheques.claim(cheque_id, 7)
+        second = await cheques.claim(cheque_id, 8)
+        await cheques.close()
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert (first.sender_id, first.amount, first.claimed_by) == (42, 500_000_000, 7)
+    assert second is None
+
+
+def test_forged_and_expired_ids_are_refused(tmp_path):
+    cheques = store(tmp_path, ttl=60)
+
+    async def run():
+        cheque_id = cheques.new_id(42, 500_000_000)
+        forged = cheque_id[:-2] + ("AA" if cheque_id[-2:] != "AA" else "BB")
+        other = ChequeStore(filepath=cheques.filepath, secret=b"another secret").new_id(42, 500_000_000)
+        results = [await cheques.claim(forged, 7), await cheques.claim(other, 7), await cheques.claim("short", 7)]
+        await cheques.close()
+        return results
+
+    assert asyncio.run(run()) == [None, None, None]
+
+    expired = store(tmp_path, ttl=60)
+    cheque_id = expired.new_id(42, 500_000_000)
+    expired.ttl = -1
+    assert asyncio.run(expired.claim(cheque_id, 7)) is None
+
+
+def test_released_cheque_is_claimed_again(tmp_path):
+    cheques = store(tmp_path)
+
+    async def run():
+        cheque_id = await cheques.create(42, 500_000_000)
+        assert await cheques.claim(cheque_id, 7)
+        await cheques.release(cheque_id)
+        cheque = await cheques.claim(cheque_id, 8)
+        await cheques.close()
+        return cheque
+
+    assert asyncio.run(run()).claimed_by == 8
+
+
+class FakeBot:
+    def __init__(self):
+        self.edits = []
+
+    async def edit_message_reply_markup(self, inline_message_id, reply_markup):
+        self.edits.append((inline_message_id, reply_markup.inline_keyboard[0][0].url))
+
+
+def choose(cheques, cheque_id, inline_message_id, monkeypatch):
+    from bot import bot
+
+    monkeypatch.setattr(bot, "cheque_store", cheques)
+    update = SimpleNamespace(chosen_inline_result=SimpleNamespace(
+        query="0.5", result_id=cheque_id, inline_message_id=inline_message_id, from_user=SimpleNamespace(id=42)))
+    context = SimpleNamespace(bot=FakeBot())
+    asyncio.run(bot.chosen_cheque(update, context))
+    return context.bot.edits
+
+
+def test_reused_cached_result_gets_a_cheque_of_its_own(tmp_path, monkeypatch):
+    cheques = store(tmp_path)
+    cheque_id = cheques.new_id(42, 500_000_000)
+
+    assert choose(cheques, cheque_id, "message-1", monkeypatch) == []
+    # Reported twice for the same message
+    assert choose(cheques, cheque_id, "message-1", monkeypatch) == []
+
+    edits = choose(cheques, cheque_id, "message-2", monkeypatch)
+    assert len(edits) == 1 and edits[0][0] == "message-2" and cheque_id not in edits[0][1]
+    asyncio.run(cheques.close())
+
+
+def test_cheque_claimed_before_it_was_reported_keeps_its_button(tmp_path, monkeypatch):
+    cheques = store(tmp_path)
+    cheque_id = cheques.new_id(42, 500_000_000)
+
+    assert asyncio.run(cheques.claim(cheque_id, 7))
+    # The link was opened before Telegram reported the chosen result, the message already pays out
+    assert choose(cheques, cheque_id, "message-1", monkeypatch) == []
+    assert asyncio.run(cheques.get(cheque_id)).inline_message_id == "message-1"
+    asyncio.run(cheques.close())
+
+
+def test_store_without_message_column_is_upgraded(tmp_path):
+    import sqlite3
+
+    connection = sqlite3.connect(tmp_path / "cheques.sqlite")
+    connection.execute(
+        "CREATE TABLE cheques (cheque_id TEXT PRIMARY KEY, sender_id INTEGER NOT NULL, amount INTEGER NOT NULL, "
+        "created_at REAL NOT NULL, status TEXT NOT NULL, claimed_by INTEGER)")
+    connection.close()
+
+    cheques = store(tmp_path)
+
+    async def run():
+        cheque_id = await cheques.create(42, 500_000_000, inline_message_id="message-1")
+        cheque = await cheques.get(cheque_id)
+        await cheques.close()
+        return cheque
+
+    assert asyncio.run(run()).inline_message_id == "message-1"
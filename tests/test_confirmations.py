@@ -0,0 +1,53 @@
+import asyncio
+
+from wallet.confirmations import ConfirmationWatcher
+
+
+class FakeClient:
+    """Wallet seqnos by address, an address mapped to None fails every lookup"""
+
+    def __init__(self, seqnos):
+        self.seqnos = seqnos
+
+    async def get_wallets_information(self, addresses, priority=None):
+        if any(self.seqnos.get(address) is None for address in addresses):
+            raise ConnectionError("toncenter is down")
+        return [{"seqno": self.seqnos[address]} for address in addresses]
+
+
+def run_watches(client, watches, timeout=0.2, wait=0.5):
+    watcher = ConfirmationWatcher(client, min_interval=0.01, max_interval=0.02, timeout=timeout)
+    results = {}
+
+    async def run():
+        for address, seqno in watches:
+            async def on_done(confirmed, information, address=address):
+                results[address] = confirmed
+            watcher.watch(address, seqno, on_done)
+        await asyncio.sleep(wait)
+        pending = watcher.pending
+        await watcher.stop()
+        return pending
+
+    return asyncio.run(run()), results
+
+
+def test_failing_address_does_not_hold_back_the_others():
+    pending, results = run_watches(FakeClient({"good": 6, "bad": None}), [("good", 5), ("bad", 5)], timeout=10)
+
+    assert results == {"good": True}
+    assert pending == 1
+
+
+def test_watches_expire_while_polls_keep_failing():
+    pending, results = run_watches(FakeClient({"bad": None}), [("bad", 5)])
+
+    assert results == {"bad": False}
+    assert pending == 0
+
+
+def test_unchanged_seqno_times_out():
+    pending, results = run_watches(FakeClient({"slow": 5}), [("slow", 5)])
+
+    assert results == {"slow": False}
+    assert pending == 0
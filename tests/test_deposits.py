@@ -0,0 +1,136 @@
+import asyncio
+import base64
+
+from tonsdk.boc import Cell
+
+from wallet.deposits import DepositMonitor
+
+ADDRESS = "EQ-wallet"
+
+
+def bounce_body():
+    cell = Cell()
+    cell.bits.write_uint(0xFFFFFFFF, 32)
+    return base64.b64encode(cell.to_boc(False)).decode()
+
+
+class FakeClient:
+    """Transactions of one address, answered newest first like toncenter's getTransactions"""
+
+    def __init__(self, transactions):
+        self.transactions = transactions
+        self.calls = 0
+
+    async def get_transactions(self, address, limit=20, lt=None, hash=None, to_lt=0, priority=None):
+        self.calls += 1
+        newest = sorted(self.transactions, key=lambda transaction: -transaction["transaction_id"]["lt"])
+        if lt is not None:
+            newest = [transaction for transaction in newest if transaction["transaction_id"]["lt"] <= lt]
+        return [transaction for transaction in newest if transaction["transaction_id"]["lt"] > to_lt][:limit]
+
+    async def get_wallets_information(self, addresses, priority=None):
+        self.calls += 1
+        last_lt = max((transaction["transaction_id"]["lt"] for transaction in self.transactions), default=0)
+        return [{"last_transaction_id": {"lt": str(last_lt)}} for _ in addresses]
+
+
+def transaction(lt, source="EQ-sender", value=10 ** 9, **in_msg):
+    return {
+        "transaction_id": {"lt": lt, "hash": f"hash-{lt}"},
+        "in_msg": {"source": source, "value": str(value), **in_msg},
+    }
+
+
+def scan(transactions, seen_lt, scan_limit=3):
+    client = FakeClient(transactions)
+    monitor = DepositMonitor(client, scan_limit=scan_limit)
+    deposits = []
+
+    async def on_deposit(amount, source, lt):
+        deposits.append(lt)
+
+    entry = [seen_lt, on_deposit]
+    last_lt = max(transaction["transaction_id"]["lt"] for transaction in transactions)
+
+    async def run():
+        await monitor._scan_address(ADDRESS, entry, last_lt)
+        await asyncio.gather(*monitor._callbacks)
+
+    asyncio.run(run())
+    return deposits, client.calls, entry[0]
+
+
+def test_every_deposit_since_the_last_scan_is_reported():
+    deposits, calls, seen_lt = scan([transaction(lt) for lt in range(1, 11)], seen_lt=2)
+
+    assert deposits == list(range(3, 11))
+    assert calls > 1
+    assert seen_lt == 10
+
+
+def test_bounces_and_own_sends_are_not_deposits():
+    transactions = [
+        transaction(1),
+        transaction(2, msg_data={"@type": "msg.dataRaw", "body": bounce_body()}),
+        transaction(3, bounced=True),
+        transaction(4, source=""),
+        transaction(5),
+    ]
+    deposits, _, _ = scan(transactions, seen_lt=0)
+
+    assert deposits == [1, 5]
+
+
+def watched(client, **kwargs):
+    monitor = DepositMonitor(client, **kwargs)
+    deposits = []
+
+    async def on_deposit(amount, source, lt):
+        deposits.append(lt)
+
+    return monitor, deposits, on_deposit
+
+
+def test_deposit_before_the_first_scan_is_reported():
+    client = FakeClient([transaction(1), transaction(2)])
+    monitor, deposits, on_deposit = watched(client)
+
+    async def run():
+        # Watched with the lt the wallet was shown with, then a deposit lands before any scan
+        monitor.watch(ADDRESS, on_deposit, last_lt=2)
+        client.transactions.append(transaction(3))
+        await monitor.scan()
+        await asyncio.gather(*monitor._callbacks)
+
+    asyncio.run(run())
+    assert deposits == [3]
+
+
+def test_watching_again_keeps_the_scanned_lt():
+    client = FakeClient([transaction(1)])
+    monitor, deposits, on_deposit = watched(client)
+
+    async def run():
+        monitor.watch(ADDRESS, on_deposit, last_lt=1)
+        client.transactions.append(transaction(2))
+        # The wallet was loaded after the deposit landed, it is reported all the same
+        monitor.watch(ADDRESS, on_deposit, last_lt=2)
+        await monitor.scan()
+        await asyncio.gather(*monitor._callbacks)
+
+    asyncio.run(run())
+    assert deposits == [2]
+
+
+def test_idle_watches_are_dropped():
+    client = FakeClient([transaction(1)])
+    monitor, deposits, on_deposit = watched(client, idle_ttl=0)
+
+    async def run():
+        monitor.watch(ADDRESS, on_deposit, last_lt=1)
+        await asyncio.sleep(0.01)
+        await monitor.scan()
+
+    asyncio.run(run())
+    assert len(monitor) == 0
+    assert client.calls == 0
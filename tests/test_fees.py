@@ -0,0 +1,82 @@
+import asyncio
+
+from tonsdk.boc import Cell
+
+from wallet.fees import FeeQuotes
+from wallet.limiter import Priority
+
+RECIPIENT = "EQCD39VS5jcptHL8vMjEXrzGaRcCVYto7HUn4bpAOg8xqB2N"
+
+
+class FakeWallet:
+    address = "EQ-wallet"
+    initialized = True
+    seqno = 3
+
+    def create_transfer_message(self, transfers, seqno):
+        return {"body": Cell(), "code": None, "data": None}
+
+
+class FakeClient:
+    def __init__(self, delay=0.0, error=None):
+        self.delay = delay
+        self.error = error
+        self.calls = []
+
+    async def estimate_fee(self, address, body, init_code=None, init_data=None, priority=None):
+        self.calls.append(priority)
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return {"source_fees": {"in_fwd_fee": 2000000, "storage_fee": 1000000, "gas_fee": 9345678, "fwd_fee": 0}}
+
+
+def test_estimate_serves_every_transfer_of_the_same_shape():
+    fees = FeeQuotes(FakeClient())
+
+    async def run():
+        wallet = FakeWallet()
+        quotes = [await fees.quote(wallet, RECIPIENT, comment) for comment in ("", "", "a" * 30, "b" * 40)]
+        return quotes
+
+    # 0.012345678 TON with the 10% margin, rounded up, comments of 25 to 48 bytes share a shape
+    assert asyncio.run(run()) == [0.0136] * 4
+    assert len(fees.client.calls) == 2
+
+
+def test_stale_quote_is_served_while_refreshed_in_the_background():
+    fees = FeeQuotes(FakeClient(), ttl=0)
+
+    async def run():
+        wallet = FakeWallet()
+        first = await fees.quote(wallet, RECIPIENT)
+        stale = await fees.quote(wallet, RECIPIENT)
+        await asyncio.sleep(0)
+        return first, stale
+
+    assert asyncio.run(run()) == (0.0136, 0.0136)
+    assert fees.client.calls == [Priority.interactive, Priority.background]
+
+
+def test_slow_estimate_is_quoted_the_fallback_and_cached_for_the_next_transfer():
+    fees = FeeQuotes(FakeClient(delay=0.05), timeout=0.01, fallback=0.05)
+
+    async def run():
+        wallet = FakeWallet()
+        slow = await fees.quote(wallet, RECIPIENT)
+        await asyncio.sleep(0.06)
+        return slow, await fees.quote(wallet, RECIPIENT)
+
+    assert asyncio.run(run()) == (0.05, 0.0136)
+    assert len(fees.client.calls) == 1
+
+
+def test_failed_estimate_is_quoted_the_fallback_and_not_cached():
+    fees = FeeQuotes(FakeClient(error=RuntimeError("toncenter is down")), fallback=0.05)
+
+    async def run():
+        wallet = FakeWallet()
+        return await fees.quote(wallet, RECIPIENT), await fees.quote(wallet, RECIPIENT)
+
+    assert asyncio.run(run()) == (0.05, 0.05)
+    assert len(fees.client.calls) == 2
@@ -0,0 +1,105 @@
+import asyncio
+
+from wallet.history import Transaction, TransactionHistory, parse_transaction
+
+ADDRESS = "EQ-wallet"
+
+
+class FakeClient:
+    """Transactions of one address, answered newest first like toncenter's getTransactions"""
+
+    def __init__(self, count):
+        self.transactions = [transaction(lt) for lt in range(1, count + 1)]
+        self.calls = []
+
+    def add(self, count):
+        newest = int(self.transactions[-1]["transaction_id"]["lt"])
+        self.transactions += [transaction(lt) for lt in range(newest + 1, newest + count + 1)]
+
+    async def get_transactions(self, address, limit=20, lt=None, hash=None, to_lt=0, priority=None):
+        self.calls.append((lt, to_lt))
+        newest = sorted(self.transactions, key=lambda transaction: -int(transaction["transaction_id"]["lt"]))
+        if lt is not None:
+            newest = [transaction for transaction in newest if int(transaction["transaction_id"]["lt"]) <= lt]
+        return [transaction for transaction in newest if int(transaction["transaction_id"]["lt"]) > to_lt][:limit]
+
+
+def transaction(lt):
+    return {
+        "transaction_id": {"lt": str(lt), "hash": f"hash-{lt}"},
+        "utime": 1700000000 + lt,
+        "fee": "1000",
+        "in_msg": {"source": "EQ-sender", "value": str(lt * 10 ** 9), "message": f"deposit {lt}"},
+        "out_msgs": [],
+    }
+
+
+def new_history(tmp_path, count, **kwargs):
+    return TransactionHistory(FakeClient(count), str(tmp_path / "history.sqlite"), fetch_limit=5, **kwargs)
+
+
+def lts(transactions):
+    return [transaction.lt for transaction in transactions]
+
+
+def test_parse_transaction_nets_incoming_and_outgoing_values():
+    outgoing = {
+        "transaction_id": {"lt": "7", "hash": "hash-7"},
+        "utime": 1, "fee": "5",
+        "in_msg": {"source": "", "value": "0"},
+        "out_msgs": [{"destination": "EQ-friend", "value": "300", "message": "rent"}, {"value": "200"}],
+    }
+
+    assert parse_transaction(outgoing) == Transaction(7, "hash-7", 1, -500, 5, "EQ-friend", "rent")
+    assert parse_transaction(transaction(2)) == Transaction(
+        2, "hash-2", 1700000002, 2 * 10 ** 9, 1000, "EQ-sender", "deposit 2")
+
+
+def test_first_sync_takes_one_page_and_reading_backfills_the_rest(tmp_path):
+    history = new_history(tmp_path, 12)
+
+    async def run():
+        synced = await history.sync(ADDRESS)
+        calls = len(history.client.calls)
+        pages = [await history.page(ADDRESS, number, page_size=4) for number in range(3)]
+        return synced, calls, pages
+
+    synced, calls, pages = asyncio.run(run())
+    assert synced == 5 and calls == 1
+    assert [lts(transactions) for transactions, _ in pages] == [[12, 11, 10, 9], [8, 7, 6, 5], [4, 3, 2, 1]]
+    assert [has_older for _, has_older in pages] == [True, True, False]
+
+
+def test_sync_fetches_only_new_transactions(tmp_path):
+    history = new_history(tmp_path, 3)
+
+    async def run():
+        await history.sync(ADDRESS)
+        # Nothing happened according to the account state
+        unchanged = await history.sync(ADDRESS, last_lt=3)
+        calls = len(history.client.calls)
+
+        history.client.add(7)
+        synced = await history.sync(ADDRESS, last_lt=10)
+        return unchanged, calls, synced, await history.page(ADDRESS, 0, page_size=20)
+
+    unchanged, calls, synced, (transactions, has_older) = asyncio.run(run())
+    assert (unchanged, calls) == (0, 1)
+    assert synced == 7
+    assert lts(transactions) == list(range(10, 0, -1)) and not has_older
+    # Every request after the first stops at the newest stored transaction
+    assert all(to_lt == 3 for _, to_lt in history.client.calls[1:])
+
+
+def test_sync_starts_over_when_the_gap_is_too_long(tmp_path):
+    history = new_history(tmp_path, 3, max_sync_pages=2)
+
+    async def run():
+        await history.sync(ADDRESS)
+        history.client.add(20)
+        await history.sync(ADDRESS)
+        return await history.page(ADDRESS, 0, page_size=30)
+
+    transactions, has_older = asyncio.run(run())
+    # Nothing is missing in between, the older ones are backfilled again
+    assert lts(transactions) == list(range(23, 0, -1)) and not has_older
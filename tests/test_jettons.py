@@ -0,0 +1,86 @@
+import asyncio
+
+from tonsdk.utils import Address
+
+from wallet.jettons import Jetton, JettonIndex, address_slice, parse_jettons
+
+OWNER = "EQCD39VS5jcptHL8vMjEXrzGaRcCVYto7HUn4bpAOg8xqB2N"
+USDT = Address("EQCxE6mUtQJKFnGfaROTKOt1lZbDiiX1kCixRv7Nw2Id_sDs").to_string(False)
+GONE = "0:" + "ab" * 32
+WALLET = "0:" + "cd" * 32
+
+
+class FakeClient:
+    """Jetton masters that know every owner's wallet, but GONE that does not exist here"""
+
+    def __init__(self, balance=5 * 10 ** 6):
+        self.balance = balance
+        self.runs = []
+
+    async def run_get_methods(self, calls, priority=None):
+        self.runs.append([method for _, method, _ in calls])
+        results = []
+        for address, method, stack in calls:
+            if address == GONE:
+                results.append({"exit_code": -13, "stack": []})
+            elif method == "get_wallet_address":
+                results.append({"exit_code": 0, "stack": [["cell", {"bytes": address_slice(WALLET)[1]}]]})
+            else:
+                results.append({"exit_code": 0, "stack": [["num", hex(self.balance)]]})
+        return results
+
+
+def index(tmp_path, client, jettons, **kwargs):
+    return JettonIndex(client, jettons, filepath=str(tmp_path / "jettons.sqlite"), window=0.001, **kwargs)
+
+
+def test_parse_jettons():
+    assert parse_jettons(f"USDT|{USDT}|6, GONE|{GONE}") == [Jetton("USDT", USDT, 6), Jetton("GONE", GONE, 9)]
+
+
+def test_wallets_are_resolved_once_and_stored(tmp_path):
+    client = FakeClient()
+    jettons = [Jetton("USDT", USDT, 6)]
+
+    async def run():
+        first = index(tmp_path, client, jettons)
+        balances = await first.balances(OWNER)
+        await first.balances(OWNER)
+        await first.close()
+
+        # Another process finds the wallet in the database
+        second = index(tmp_path, client, jettons)
+        wallets = await second.wallets(OWNER)
+        await second.close()
+        return balances, wallets
+
+    balances, wallets = asyncio.run(run())
+    assert balances == [(jettons[0], 5.0)]
+    assert wallets == {USDT: WALLET}
+    assert [run for run in client.runs if "get_wallet_address" in run] == [["get_wallet_address"]]
+
+
+def test_refused_lookups_are_not_retried_until_due(tmp_path):
+    client = FakeClient()
+    jettons = [Jetton("USDT", USDT, 6), Jetton("GONE", GONE, 9)]
+
+    async def run():
+        jetton_index = index(tmp_path, client, jettons)
+        for _ in range(3):
+            await jetton_index.balances(OWNER)
+        await jetton_index.close()
+
+        # Stored, a restart does not ask again either
+        restarted = index(tmp_path, client, jettons)
+        balances = await restarted.balances(OWNER)
+        lookups = sum(run.count("get_wallet_address") for run in client.runs)
+
+        restarted.miss_ttl = 0
+        await restarted.balances(OWNER)
+        await restarted.close()
+        return balances, lookups
+
+    balances, lookups = asyncio.run(run())
+    assert balances == [(jettons[0], 5.0)]
+    assert lookups == 2
+    assert client.runs[-1] == ["get_wallet_address"]
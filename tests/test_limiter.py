@@ -0,0 +1,76 @@
+import asyncio
+
+from wallet.limiter import Priority, RateLimiter
+
+
+def test_burst_is_served_without_waiting():
+    async def run():
+        limiter = RateLimiter(rate=1000, burst=3)
+        return [await limiter.acquire() for _ in range(3)]
+
+    assert asyncio.run(run()) == [0.0, 0.0, 0.0]
+
+
+def test_waiters_are_served_by_priority_then_arrival():
+    async def run():
+        limiter = RateLimiter(rate=100, burst=1)
+        await limiter.acquire()
+        order = []
+
+        async def acquire(name, priority):
+            await limiter.acquire(priority)
+            order.append(name)
+
+        await asyncio.gather(
+            acquire("background", Priority.background),
+            acquire("interactive 1", Priority.interactive),
+            acquire("transfer", Priority.transfer),
+            acquire("interactive 2", Priority.interactive),
+        )
+        return order
+
+    assert asyncio.run(run()) == ["transfer", "interactive 1", "interactive 2", "background"]
+
+
+def test_tokens_are_handed_out_at_the_rate():
+    async def run():
+        limiter = RateLimiter(rate=50, burst=1)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await asyncio.gather(*(limiter.acquire() for _ in range(6)))
+        return loop.time() - started
+
+    # One token right away, then five at 50 per second
+    assert 0.09 <= asyncio.run(run()) < 0.3
+
+
+def test_cancelled_waiter_does_not_take_a_token():
+    async def run():
+        limiter = RateLimiter(rate=20, burst=1)
+        await limiter.acquire()
+        cancelled = asyncio.ensure_future(limiter.acquire(Priority.transfer))
+        waiting = asyncio.ensure_future(limiter.acquire(Priority.background))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.wait_for(waiting, 0.09)
+        return limiter.stats()
+
+    stats = asyncio.run(run())
+    assert stats["transfer"] == {"queued": 0, "served": 0, "waited": 0.0}
+    assert stats["background"]["served"] == 1
+    assert stats["interactive"]["served"] == 1
+
+
+def test_stats_count_queued_and_served_callers():
+    async def run():
+        limiter = RateLimiter(rate=20, burst=1)
+        await limiter.acquire()
+        waiting = asyncio.ensure_future(limiter.acquire(Priority.background))
+        await asyncio.sleep(0)
+        queued = limiter.stats()["background"]["queued"]
+        await waiting
+        return queued, limiter.stats()["background"]
+
+    queued, background = asyncio.run(run())
+    assert queued == 1
+    assert background["queued"] == 0 and background["served"] == 1 and background["waited"] > 0
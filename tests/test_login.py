@@ -0,0 +1,57 @@
+import asyncio
+from types import SimpleNamespace
+
+from tonsdk.crypto import mnemonic_new
+
+from bot import handlers
+from bot.helpers import create_password_hash
+from wallet.wallet import Wallet
+
+PASSWORD = "correct horse"
+
+
+class FakeMessage:
+    async def edit_text(self, text, **kwargs):
+        pass
+
+
+def login(monkeypatch, current):
+    wordlist = current.wordlist if current is not None else mnemonic_new()
+
+    async def from_password_async(password):
+        return Wallet.from_wordlist(wordlist)
+
+    async def load_state(self, priority=None):
+        pass
+
+    async def show_wallet_options(update, context):
+        pass
+
+    monkeypatch.setattr(Wallet, "from_password_async", from_password_async)
+    monkeypatch.setattr(Wallet, "load_state", load_state)
+    monkeypatch.setattr(handlers, "show_wallet_options", show_wallet_options)
+    monkeypatch.setattr(handlers, "watch_deposits", lambda application, user_id: None)
+
+    password_hash, salt = create_password_hash(PASSWORD)
+    user_data = {"password": {"hash": password_hash, "salt": salt}, "msg": FakeMessage()}
+    if current is not None:
+        user_data["wallet"] = current
+    update = SimpleNamespace(message=SimpleNamespace(text=PASSWORD), effective_user=SimpleNamespace(id=42))
+    context = SimpleNamespace(user_data=user_data, application=None)
+
+    asyncio.run(handlers.check_password_handler(update, context))
+    return user_data["wallet"]
+
+
+def test_login_keeps_the_seqno_of_transfers_in_flight(monkeypatch):
+    current = Wallet.from_wordlist(mnemonic_new())
+    current.seqno, current.seqno_expires = 8, float("inf")
+
+    wallet = login(monkeypatch, current)
+    assert wallet is current
+    assert wallet.seqno == 8
+
+
+def test_first_login_loads_the_wallet(monkeypatch):
+    wallet = login(monkeypatch, None)
+    assert wallet.seqno is None
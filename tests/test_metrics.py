@@ -0,0 +1,37 @@
+import re
+
+from wallet.metrics import Counter, Histogram, _registry, render
+
+
+def test_label_values_are_escaped():
+    histogram = Histogram("test_escape_seconds", "Escaping test")
+    _registry.remove(histogram)
+    histogram.observe(0.01, handler='a"b\\c\nd')
+
+    lines = list(histogram.collect())
+    assert 'test_escape_seconds_count{handler="a\\"b\\\\c\\nd"} 1' in lines
+    assert all("\n" not in line for line in lines)
+
+
+def test_counter_read_from_a_function():
+    totals = {("default", "interactive"): 1.5}
+    counter = Counter("test_waited_seconds_total", "Function test", lambda: totals, labelnames=("backend", "priority"))
+    _registry.remove(counter)
+
+    lines = list(counter.collect())
+    assert "# TYPE test_waited_seconds_total counter" in lines
+    assert 'test_waited_seconds_total{backend="default",priority="interactive"} 1.5' in lines
+
+
+def test_totals_are_exported_as_counters():
+    import bot.bot  # noqa: F401, registers the bot metrics
+
+    types = dict(re.findall(r"^# TYPE (\S+) (\S+)$", render(), re.MULTILINE))
+    for name in (
+        "twallet_telegram_edits_skipped_total", "twallet_telegram_edits_coalesced_total", "twallet_telegram_retries_total",
+        "twallet_user_sessions_evicted_total", "twallet_key_derivation_rejected_total",
+        "twallet_price_refresh_failures_total", "twallet_toncenter_wait_seconds_total",
+    ):
+        assert types[name] == "counter"
+    # Prometheus counters are named with the _total suffix
+    assert all(name.endswith("_total") for name, kind in types.items() if kind == "counter")
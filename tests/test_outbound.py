@@ -0,0 +1,107 @@
+import asyncio
+
+from telegram.error import BadRequest, RetryAfter
+
+from bot.outbound import OutboundScheduler
+
+CHAT = 12345
+
+
+class FakeApi:
+    """Records the calls that reach Telegram, fails the first `failures` of them"""
+
+    def __init__(self, failures=()):
+        self.calls = []
+        self.failures = list(failures)
+
+    def request(self, scheduler, endpoint, **data):
+        data = {"chat_id": CHAT, "message_id": 7, **data}
+
+        async def callback():
+            if self.failures:
+                raise self.failures.pop(0)
+            self.calls.append((endpoint, data.get("text"), data.get("reply_markup")))
+            return {"message_id": 7, "text": data.get("text")}
+
+        return scheduler.process_request(callback, (), {}, endpoint, data, None)
+
+
+def scheduler(chat_rate=20, chat_burst=1):
+    # One message at once, the next edits of it queue for 50ms
+    return OutboundScheduler(global_rate=1000, chat_rate=chat_rate, chat_burst=chat_burst)
+
+
+def run(outbound, api, *requests, gap=0.001):
+    async def main():
+        await outbound.initialize()
+        tasks = []
+        for endpoint, data in requests:
+            tasks.append(asyncio.ensure_future(api.request(outbound, endpoint, **data)))
+            await asyncio.sleep(gap)
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    return asyncio.run(main())
+
+
+def test_unchanged_edit_is_answered_locally():
+    outbound, api = scheduler(chat_rate=1000, chat_burst=10), FakeApi()
+    run(outbound, api, ("editMessageText", {"text": "a"}), ("editMessageText", {"text": "a"}), gap=0.01)
+
+    assert api.calls == [("editMessageText", "a", None)]
+    assert outbound.skipped == 1
+
+
+def test_queued_edits_send_only_the_latest():
+    outbound, api = scheduler(), FakeApi()
+    results = run(outbound, api, *(("editMessageText", {"text": text}) for text in "abcd"))
+
+    assert [call[1] for call in api.calls] == ["a", "d"]
+    assert outbound.coalesced == 2
+    # Every caller gets the result of the edit that replaced his
+    assert [result["text"] for result in results] == ["a", "d", "d", "d"]
+
+
+def test_text_and_markup_edits_are_not_merged():
+    outbound, api = scheduler(), FakeApi()
+    run(
+        outbound, api,
+        ("editMessageText", {"text": "a"}),
+        ("editMessageText", {"text": "b"}),
+        ("editMessageReplyMarkup", {"reply_markup": "m1"}),
+        ("editMessageText", {"text": "c"}),
+        ("editMessageText", {"text": "d"}),
+    )
+
+    assert [call[:2] for call in api.calls] == [
+        ("editMessageText", "a"), ("editMessageText", "b"), ("editMessageReplyMarkup", None), ("editMessageText", "d"),
+    ]
+    assert outbound.coalesced == 1
+
+
+def test_flood_wait_is_retried():
+    outbound, api = scheduler(chat_rate=1000), FakeApi([RetryAfter(0)])
+    run(outbound, api, ("sendMessage", {"text": "a"}))
+
+    assert api.calls == [("sendMessage", "a", None)]
+    assert outbound.retried == 1
+
+
+def test_edit_of_a_stale_copy_is_not_an_error():
+    outbound, api = scheduler(chat_rate=1000), FakeApi([BadRequest("Message is not modified")])
+    results = run(outbound, api, ("editMessageText", {"text": "a"}))
+
+    assert results == [True]
+
+
+def test_chat_is_paced():
+    outbound, api = scheduler(chat_rate=20, chat_burst=2), FakeApi()
+
+    async def main():
+        await outbound.initialize()
+        started = asyncio.get_running_loop().time()
+        await asyncio.gather(*(api.request(outbound, "sendMessage", text=str(i)) for i in range(4)))
+        return asyncio.get_running_loop().time() - started
+
+    # Two in the burst, then one every 50ms
+    assert asyncio.run(main()) >= 0.09
+    assert len(api.calls) == 4
@@ -0,0 +1,93 @@
+import asyncio
+from types import SimpleNamespace
+
+import aiohttp
+from tonsdk.crypto import mnemonic_new
+from tonsdk.provider import ToncenterWrongResult
+
+from bot.handlers import pay_cheque
+from wallet.wallet import TransferUncertain, Wallet
+
+RECIPIENT = "EQCD39VS5jcptHL8vMjEXrzGaRcCVYto7HUn4bpAOg8xqB2N"
+
+
+class FakeClient:
+    def __init__(self, error=None):
+        self.error = error
+        self.sent = 0
+
+    async def send_boc(self, boc):
+        self.sent += 1
+        if self.error is not None:
+            raise self.error
+        return {"@type": "ok"}
+
+
+class FakePersistence:
+    def owns(self, user_id):
+        return True
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+
+def sender_wallet(client, balance=10.0, load_error=None):
+    wallet = Wallet.from_wordlist(mnemonic_new())
+    wallet.client = client
+    wallet.seqno = 5
+    wallet.balance = balance
+
+    async def load_state(priority=None):
+        if load_error is not None:
+            raise load_error
+
+    wallet.load_state = load_state
+    return wallet
+
+
+def pay(wallet):
+    application = SimpleNamespace(persistence=FakePersistence(), user_data={42: {"wallet": wallet}})
+    return asyncio.run(pay_cheque(application, {"sender_id": 42, "amount": 1.0, "address": RECIPIENT}))
+
+
+def test_timed_out_send_keeps_its_seqno():
+    wallet = sender_wallet(FakeClient(asyncio.TimeoutError()))
+
+    async def run():
+        try:
+            await wallet.transfer(1.0, RECIPIENT, "")
+        except TransferUncertain as e:
+            return e.seqno
+
+    assert asyncio.run(run()) == 5
+    # Even if that message lands, the next transfer can't be signed with the same seqno
+    assert wallet.seqno == 6
+
+
+def test_uncertain_payout_is_reported_with_its_seqno():
+    wallet = sender_wallet(FakeClient(aiohttp.ServerDisconnectedError()))
+
+    assert pay(wallet) == {"status": "unknown", "address": wallet.address, "seqno": 5}
+
+
+def test_rejected_payout_sent_nothing():
+    client = FakeClient(ToncenterWrongResult(500))
+    wallet = sender_wallet(client)
+
+    assert pay(wallet) == {"status": "error"}
+    assert client.sent == 1
+
+
+def test_failure_before_sending_sent_nothing():
+    client = FakeClient()
+    wallet = sender_wallet(client, load_error=aiohttp.ClientConnectionError())
+
+    assert pay(wallet) == {"status": "error"}
+    assert client.sent == 0
+
+
+def test_insufficient_balance_sent_nothing():
+    client = FakeClient()
+
+    assert pay(sender_wallet(client, balance=0.5)) == {"status": "insufficient"}
+    assert client.sent == 0
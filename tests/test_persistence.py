@@ -0,0 +1,108 @@
+import asyncio
+import sqlite3
+
+from telegram import Bot, User
+from telegram.ext import PersistenceInput, PicklePersistence
+
+from bot.persistence import SQLitePersistence
+
+
+def new_persistence(tmp_path, **kwargs):
+    persistence = SQLitePersistence(str(tmp_path / "bot.sqlite"), **kwargs)
+    persistence.set_bot(Bot("1:test"))
+    return persistence
+
+
+async def load_user(persistence, user_id):
+    user_data = {}
+    await persistence.refresh_user_data(user_id, user_data)
+    return user_data
+
+
+def test_user_data_survives_a_restart(tmp_path):
+    async def run():
+        persistence = new_persistence(tmp_path)
+        user_data = await load_user(persistence, 1)
+        user_data["user"] = User(1, "Alice", False)
+        await persistence.update_user_data(1, user_data)
+        await persistence.flush()
+
+        persistence = new_persistence(tmp_path)
+        return await persistence.get_user_data(), await load_user(persistence, 1), await load_user(persistence, 2)
+
+    everybody, alice, nobody = asyncio.run(run())
+    # Users are loaded on their first update only
+    assert everybody == {}
+    assert alice["user"].first_name == "Alice"
+    assert alice["user"].get_bot() is not None
+    assert nobody == {}
+
+
+def test_unchanged_user_is_not_rewritten(tmp_path):
+    async def run():
+        persistence = new_persistence(tmp_path)
+        user_data = await load_user(persistence, 1)
+        user_data["language"] = "en"
+        await persistence.update_user_data(1, user_data)
+
+        # Changed behind its back, the persistence only sees that its own copy did not change
+        await persistence._thread(persistence._execute, [
+            lambda connection: connection.execute("UPDATE user_data SET data = x'00' WHERE user_id = 1")])
+        await persistence.update_user_data(1, dict(user_data))
+        await persistence.flush()
+
+    asyncio.run(run())
+    connection = sqlite3.connect(tmp_path / "bot.sqlite")
+    assert connection.execute("SELECT data FROM user_data").fetchall() == [(b"\x00",)]
+
+
+def test_chat_bot_and_conversation_data_survive_a_restart(tmp_path):
+    async def run():
+        persistence = new_persistence(tmp_path)
+        await persistence.get_bot_data()
+        await persistence.update_chat_data(10, {"title": "chat"})
+        await persistence.update_bot_data({"rates": 2.5, "stale": 1})
+        await persistence.update_bot_data({"rates": 3.0})
+        await persistence.update_conversation("login", (1, 1), "password")
+        await persistence.update_conversation("login", (2, 2), "password")
+        await persistence.update_conversation("login", (2, 2), None)
+        await persistence.flush()
+
+        persistence = new_persistence(tmp_path)
+        return (await persistence.get_chat_data(), await persistence.get_bot_data(),
+                await persistence.get_conversations("login"))
+
+    chat_data, bot_data, conversations = asyncio.run(run())
+    assert chat_data == {10: {"title": "chat"}}
+    assert bot_data == {"rates": 3.0}
+    assert conversations == {(1, 1): "password"}
+
+
+def test_dropped_user_is_deleted(tmp_path):
+    async def run():
+        persistence = new_persistence(tmp_path)
+        user_data = await load_user(persistence, 1)
+        user_data["language"] = "en"
+        await persistence.update_user_data(1, user_data)
+        await persistence.drop_user_data(1)
+        await persistence.flush()
+        return await load_user(new_persistence(tmp_path), 1)
+
+    assert asyncio.run(run()) == {}
+
+
+def test_legacy_pickle_data_is_migrated(tmp_path):
+    async def run():
+        legacy = PicklePersistence(tmp_path / "legacy.pickle", PersistenceInput(callback_data=False))
+        legacy.set_bot(Bot("1:test"))
+        # Loaded at startup by the application that wrote it
+        for get in (legacy.get_user_data, legacy.get_chat_data, legacy.get_bot_data):
+            await get()
+        await legacy.update_user_data(1, {"language": "en"})
+        await legacy.update_bot_data({"rates": 2.5})
+        await legacy.flush()
+
+        persistence = new_persistence(tmp_path, legacy_filepath=str(tmp_path / "legacy.pickle"))
+        return await persistence.get_bot_data(), await load_user(persistence, 1)
+
+    assert asyncio.run(run()) == ({"rates": 2.5}, {"language": "en"})
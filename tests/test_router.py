@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+from tonsdk.provider import ToncenterWrongResult
+
+from wallet.router import Backend, RoutedTonClient, _CallRecorder
+
+ADDRESS = "EQCD39VS5jcptHL8vMjEXrzGaRcCVYto7HUn4bpAOg8xqB2N"
+
+
+class FakeClient:
+    """Backend client answering with its name after `delay`, or raising the next of `errors`"""
+
+    def __init__(self, name, delay=0.0, errors=()):
+        self.name = name
+        self.delay = delay
+        self.errors = list(errors)
+        self.provider = _CallRecorder()
+        self.calls = []
+
+    async def _run(self, to_run, *, single_query=True, priority=None):
+        self.calls.append(to_run)
+        await asyncio.sleep(self.delay)
+        if self.errors:
+            error = self.errors.pop(0)
+            if error is not None:
+                raise error
+        return [self.name]
+
+
+def router(*clients, **kwargs):
+    backends = [Backend(client.name, client) for client in clients]
+    return RoutedTonClient(backends, **kwargs)
+
+
+def test_read_moves_on_to_the_next_backend_when_one_fails():
+    a, b = FakeClient("a", errors=[asyncio.TimeoutError()]), FakeClient("b")
+    client = router(a, b)
+
+    assert asyncio.run(client.get_transactions(ADDRESS)) == "b"
+    assert client.backends[0].failures == 1 and client.backends[1].failures == 0
+
+
+def test_read_error_of_the_request_is_not_retried():
+    a, b = FakeClient("a", errors=[ToncenterWrongResult(416)]), FakeClient("b")
+
+    with pytest.raises(ToncenterWrongResult):
+        asyncio.run(router(a, b).get_transactions(ADDRESS))
+    assert b.calls == []
+
+
+def test_slow_read_is_hedged_on_the_next_backend():
+    a, b = FakeClient("a", delay=1), FakeClient("b")
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        result = await router(a, b, hedge_delay=0.05).get_transactions(ADDRESS)
+        return result, loop.time() - started
+
+    result, elapsed = asyncio.run(run())
+    assert result == "b" and elapsed < 0.5
+
+
+def test_reads_go_to_the_best_scoring_backend():
+    a, b = FakeClient("a", delay=0.03), FakeClient("b")
+    client = router(a, b)
+
+    async def run():
+        await client.get_transactions(ADDRESS)
+        client.backends[1].latency = 0.001
+        return await client.get_transactions(ADDRESS)
+
+    assert asyncio.run(run()) == "b"
+
+
+def test_breaker_opens_after_repeated_failures_and_probes_after_the_cooldown():
+    a, b = FakeClient("a", errors=[asyncio.TimeoutError()] * 2), FakeClient("b")
+    client = router(a, b, failure_threshold=2, cooldown=0.05)
+    # a would be preferred whenever it is healthy
+    client.backends[1].latency = 1
+
+    async def run():
+        for _ in range(2):
+            await client.get_transactions(ADDRESS)
+        while_open = await client.get_transactions(ADDRESS)
+        await asyncio.sleep(0.06)
+        return while_open, await client.get_transactions(ADDRESS)
+
+    while_open, after_cooldown = asyncio.run(run())
+    assert while_open == "b"
+    assert after_cooldown == "a" and client.backends[0].failures == 0
+    assert len(a.calls) == 3
+
+
+def test_message_is_sent_to_every_backend():
+    a, b = FakeClient("a"), FakeClient("b", delay=0.01)
+    client = router(a, b)
+
+    async def run():
+        result = await client.send_boc(b"boc")
+        await asyncio.sleep(0.02)
+        return result
+
+    assert asyncio.run(run()) == ["a"]
+    assert a.calls == b.calls == [("raw_send_message", (b"boc",), {})]
+
+
+def test_rejected_message_prefers_the_toncenter_answer_and_is_not_a_failure():
+    a = FakeClient("a", errors=[asyncio.TimeoutError()])
+    b = FakeClient("b", delay=0.01, errors=[ToncenterWrongResult(500)])
+    client = router(a, b)
+
+    with pytest.raises(ToncenterWrongResult):
+        asyncio.run(client.send_boc(b"boc"))
+    assert client.backends[0].failures == 1 and client.backends[1].failures == 0
@@ -0,0 +1,83 @@
+import asyncio
+import datetime
+
+from telegram import Chat, Message, Update, User
+
+from bot.scheduler import UserUpdateProcessor
+
+
+def update(update_id, user_id):
+    user = User(user_id, "user", False)
+    message = Message(update_id, datetime.datetime.now(), Chat(user_id, Chat.PRIVATE), from_user=user)
+    return Update(update_id, message=message)
+
+
+class Recorder:
+    def __init__(self):
+        self.events = []
+        self.running = 0
+        self.most_running = 0
+
+    async def handle(self, name, delay=0.01):
+        self.running += 1
+        self.most_running = max(self.most_running, self.running)
+        self.events.append(("start", name))
+        await asyncio.sleep(delay)
+        self.events.append(("end", name))
+        self.running -= 1
+
+
+def test_updates_of_one_user_run_in_order_one_at_a_time():
+    async def run():
+        processor, recorder = UserUpdateProcessor(limit=8), Recorder()
+        await asyncio.gather(*(
+            processor.do_process_update(update(i, 1), recorder.handle(i, delay=0.01 * (3 - i))) for i in range(3)))
+        return recorder
+
+    recorder = asyncio.run(run())
+    assert recorder.events == [("start", 0), ("end", 0), ("start", 1), ("end", 1), ("start", 2), ("end", 2)]
+    assert recorder.most_running == 1
+
+
+def test_users_run_concurrently_up_to_the_limit():
+    async def run():
+        processor, recorder = UserUpdateProcessor(limit=3), Recorder()
+        await asyncio.gather(*(processor.do_process_update(update(i, i), recorder.handle(i)) for i in range(6)))
+        return recorder.most_running, processor.active_users
+
+    assert asyncio.run(run()) == (3, 0)
+
+
+def test_updates_beyond_max_user_pending_are_dropped():
+    async def run():
+        processor, recorder = UserUpdateProcessor(limit=8, max_user_pending=2), Recorder()
+        await asyncio.gather(*(processor.do_process_update(update(i, 1), recorder.handle(i)) for i in range(4)))
+        return recorder.events, processor.dropped
+
+    events, dropped = asyncio.run(run())
+    assert events == [("start", 0), ("end", 0), ("start", 1), ("end", 1)]
+    assert dropped == 2
+
+
+def test_turn_waits_for_queued_updates_and_holds_later_ones():
+    async def run():
+        processor, recorder = UserUpdateProcessor(limit=8), Recorder()
+        first = asyncio.ensure_future(processor.do_process_update(update(0, 1), recorder.handle(0)))
+        await asyncio.sleep(0)
+
+        async def background():
+            async with processor.turn(1):
+                busy = processor.busy(1)
+                await recorder.handle("background")
+            return busy
+
+        task = asyncio.ensure_future(background())
+        await asyncio.sleep(0)
+        later = asyncio.ensure_future(processor.do_process_update(update(1, 1), recorder.handle(1)))
+        busy = await task
+        await asyncio.gather(first, later)
+        return recorder.events, busy, processor.busy(1)
+
+    events, busy, still_busy = asyncio.run(run())
+    assert [name for kind, name in events if kind == "start"] == [0, "background", 1]
+    assert busy and not still_busy
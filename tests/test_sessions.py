@@ -0,0 +1,108 @@
+import asyncio
+import time
+
+from telegram import Bot
+
+from bot.persistence import SQLitePersistence
+from bot.sessions import SessionEvictor
+
+
+class FakeProcessor:
+    def __init__(self):
+        self.busy_users = set()
+
+    def busy(self, user_id):
+        return user_id in self.busy_users
+
+
+class FakeApplication:
+    def __init__(self, persistence):
+        self.persistence = persistence
+        self.update_processor = FakeProcessor()
+        self.user_data = {}
+
+    async def load(self, user_id, seen=None):
+        # What the application does before each update of the user
+        user_data = self.user_data.setdefault(user_id, {})
+        await self.persistence.refresh_user_data(user_id, user_data)
+        if seen is not None:
+            self.persistence.sessions[user_id] = seen
+        return user_data
+
+    def drop_user_data(self, user_id):
+        # The application drops the user and its persistence run tells the persistence
+        self.user_data.pop(user_id)
+        asyncio.ensure_future(self.persistence.drop_user_data(user_id))
+
+
+def new_application(tmp_path):
+    persistence = SQLitePersistence(str(tmp_path / "bot.sqlite"))
+    persistence.set_bot(Bot("1:test"))
+    return FakeApplication(persistence)
+
+
+def test_idle_users_are_written_back_and_loaded_again(tmp_path):
+    async def run():
+        application = new_application(tmp_path)
+        evictor = SessionEvictor(application, idle_ttl=60)
+        idle = await application.load(1, seen=time.monotonic() - 120)
+        idle["language"] = "en"
+        await application.load(2)
+
+        evicted = await evictor.evict()
+        await asyncio.sleep(0.01)
+        users = set(application.user_data)
+        return evicted, users, await application.load(1)
+
+    evicted, users, reloaded = asyncio.run(run())
+    assert evicted == 1
+    assert users == {2}
+    # Dropped from memory only, the row is kept
+    assert reloaded == {"language": "en"}
+
+
+def test_least_recent_users_beyond_max_sessions_are_evicted(tmp_path):
+    async def run():
+        application = new_application(tmp_path)
+        evictor = SessionEvictor(application, max_sessions=2)
+        for user_id in (1, 2, 3, 4):
+            await application.load(user_id)
+        await application.load(1)
+
+        await evictor.evict()
+        return list(application.persistence.sessions)
+
+    assert asyncio.run(run()) == [4, 1]
+
+
+def test_busy_users_are_not_evicted(tmp_path):
+    async def run():
+        application = new_application(tmp_path)
+        evictor = SessionEvictor(application, idle_ttl=60)
+        for user_id in (1, 2):
+            await application.load(user_id, seen=time.monotonic() - 120)
+        application.update_processor.busy_users.add(1)
+
+        return await evictor.evict(), set(application.user_data)
+
+    assert asyncio.run(run()) == (1, {1})
+
+
+def test_user_that_came_back_during_the_write_is_kept(tmp_path):
+    async def run():
+        application = new_application(tmp_path)
+        persistence = application.persistence
+        user_data = await application.load(1, seen=time.monotonic() - 120)
+
+        # An update of the user is queued while his data is written
+        write = persistence._write
+
+        async def queued_write(statement):
+            application.update_processor.busy_users.add(1)
+            await write(statement)
+
+        persistence._write = queued_write
+        evicted = await SessionEvictor(application, idle_ttl=60).evict()
+        return evicted, application.user_data.get(1) is user_data, 1 in persistence.sessions
+
+    assert asyncio.run(run()) == (0, True, True)
@@ -0,0 +1,142 @@
+import asyncio
+import time
+
+from tonsdk.crypto import mnemonic_new
+
+from wallet.client import ToncenterWrongResult
+from wallet.wallet import Wallet
+
+RECIPIENT = "EQCD39VS5jcptHL8vMjEXrzGaRcCVYto7HUn4bpAOg8xqB2N"
+
+
+class FakeClient:
+    def __init__(self, errors=()):
+        # errors[i], if set, is raised by the i-th send
+        self.errors = list(errors)
+        self.sent = []
+
+    async def send_boc(self, boc):
+        error = self.errors[len(self.sent)] if len(self.sent) < len(self.errors) else None
+        self.sent.append(boc)
+        if error:
+            raise error
+        return {"@type": "ok"}
+
+
+class FakeConfirmations:
+    def __init__(self, lands=lambda seqno: True):
+        self.lands = lands
+        self.watched = []
+
+    def watch(self, address, seqno, on_done):
+        self.watched.append(seqno)
+        asyncio.ensure_future(on_done(self.lands(seqno), None))
+
+
+def new_wallet(seqno, errors=()):
+    wallet = Wallet.from_wordlist(mnemonic_new())
+    wallet.client = FakeClient(errors)
+    wallet.confirmations = FakeConfirmations()
+    wallet.seqno = seqno
+    return wallet
+
+
+def recipients(count):
+    return [(RECIPIENT, i + 1, "") for i in range(count)]
+
+
+def packed(wallet, monkeypatch):
+    # Sizes of the sent messages
+    sizes = []
+    create = wallet.create_transfer_message
+
+    def create_transfer_message(transfers, seqno):
+        sizes.append(len(transfers))
+        return create(transfers, seqno)
+
+    monkeypatch.setattr(wallet, "create_transfer_message", create_transfer_message)
+    return sizes
+
+
+async def unchanged_state(priority=None):
+    pass
+
+
+def test_seqno_runs_ahead_of_the_chain_until_the_message_expires():
+    wallet = new_wallet(5)
+    asyncio.run(wallet.transfer(1.0, RECIPIENT, ""))
+
+    wallet.sync_seqno(5)
+    assert wallet.seqno == 6
+
+    wallet.seqno_expires = time.time() - 1
+    wallet.sync_seqno(5)
+    assert wallet.seqno == 5
+
+
+def test_seqno_zero_message_never_expires():
+    wallet = new_wallet(0)
+    asyncio.run(wallet.transfer(1.0, RECIPIENT, ""))
+
+    # Signed valid until 0xFFFFFFFF, it may land long after the usual message lifetime
+    wallet.seqno_expires -= 10 ** 6
+    wallet.sync_seqno(0)
+    assert wallet.seqno == 1
+
+    wallet.sync_seqno(1)
+    assert wallet.seqno == 1
+
+
+def test_transfer_many_packs_max_messages_per_message(monkeypatch):
+    wallet = new_wallet(5)
+    sizes = packed(wallet, monkeypatch)
+
+    results = asyncio.run(wallet.transfer_many(recipients(9)))
+
+    assert sizes == [4, 4, 1]
+    assert [r["seqno"] for r in results] == [5] * 4 + [6] * 4 + [7]
+    assert [r["amount"] for r in results] == list(range(1, 10))
+    assert all(r["error"] is None for r in results)
+    # Each message waits for the previous one, the last one is not waited for
+    assert wallet.confirmations.watched == [5, 6]
+
+
+def test_transfer_many_reports_a_refused_chunk_and_sends_the_next(monkeypatch):
+    wallet = new_wallet(5, errors=[None, ToncenterWrongResult(500)])
+    monkeypatch.setattr(wallet, "load_state", unchanged_state)
+    sizes = packed(wallet, monkeypatch)
+
+    results = asyncio.run(wallet.transfer_many(recipients(9)))
+
+    assert sizes == [4, 4, 1]
+    assert [r["seqno"] for r in results[:4]] == [5] * 4
+    assert all(r["seqno"] is None and "ToncenterWrongResult" in r["error"] for r in results[4:8])
+    # The refused message did not use its seqno
+    assert results[8]["seqno"] == 6 and results[8]["error"] is None
+
+
+def test_transfer_many_stops_when_a_message_does_not_land(monkeypatch):
+    wallet = new_wallet(5)
+    wallet.confirmations = FakeConfirmations(lands=lambda seqno: seqno != 6)
+    sizes = packed(wallet, monkeypatch)
+
+    results = asyncio.run(wallet.transfer_many(recipients(12)))
+
+    assert sizes == [4, 4]
+    assert all(r["error"] is None for r in results[:8])
+    assert all(r["seqno"] is None and r["error"] == "previous message did not land" for r in results[8:])
+
+
+def test_transfer_many_confirms_an_uncertain_chunk(monkeypatch):
+    wallet = new_wallet(5, errors=[None, asyncio.TimeoutError(), asyncio.TimeoutError()])
+    wallet.confirmations = FakeConfirmations(lands=lambda seqno: seqno != 7)
+    sizes = packed(wallet, monkeypatch)
+
+    results = asyncio.run(wallet.transfer_many(recipients(9)))
+
+    assert sizes == [4, 4, 1]
+    # Timed out but landed, so the next message was sent
+    assert all(r["seqno"] == 6 and r["error"] is None for r in results[4:8])
+    # The last message is waited for too when its send was unclear
+    assert results[8]["seqno"] == 7 and "TransferUncertain" in results[8]["error"]
+    assert wallet.confirmations.watched == [5, 6, 7]
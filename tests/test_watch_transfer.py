@@ -0,0 +1,99 @@
+import asyncio
+from types import SimpleNamespace
+
+from bot import shared_actions
+from bot.scheduler import UserUpdateProcessor
+
+USER_ID = 12345
+
+
+class FakeWallet:
+    address = "EQ-wallet"
+    sent_seqno = 3
+    balance = 1.5
+
+    def __init__(self):
+        self.loads = 0
+
+    async def load_state(self, priority=None):
+        self.loads += 1
+        self.balance = 0.5
+
+    async def jetton_balances(self, priority=None):
+        return []
+
+
+class FakeMessage:
+    def __init__(self):
+        self.texts = []
+
+    async def edit_text(self, text, **kwargs):
+        self.texts.append(text)
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(text)
+
+
+def confirm(monkeypatch, screen, evicted=False, busy=None):
+    watches = []
+    monkeypatch.setattr(shared_actions.Wallet.confirmations, "watch", lambda *args: watches.append(args))
+
+    wallet, message = FakeWallet(), FakeMessage()
+    user_data = {"wallet": wallet, "msg": message, "settings": {"currency": "USD"}}
+    if screen:
+        user_data["screen"] = screen
+    processor = UserUpdateProcessor(4)
+    application = SimpleNamespace(
+        bot=FakeBot(), update_processor=processor, user_data={} if evicted else {USER_ID: user_data})
+    context = SimpleNamespace(application=application, user_data=user_data)
+
+    shared_actions.watch_transfer(USER_ID, context, 1.0, "EQ-recipient")
+    on_done = watches[0][2]
+
+    async def run():
+        if busy is None:
+            await on_done(True, {"seqno": 4})
+            return
+        # An update of the user is running, the refresh waits for it
+        async with processor.turn(USER_ID):
+            task = asyncio.ensure_future(on_done(True, {"seqno": 4}))
+            await asyncio.sleep(0.01)
+            assert not message.texts
+            user_data["screen"] = busy
+        await task
+
+    asyncio.run(run())
+    return application.bot.sent, message.texts, wallet.loads
+
+
+def test_wallet_screen_is_refreshed(monkeypatch):
+    sent, texts, loads = confirm(monkeypatch, "wallet")
+
+    assert len(sent) == 1
+    assert len(texts) == 1 and "0.5" in texts[0]
+    assert loads == 1
+
+
+def test_other_screens_are_left_alone(monkeypatch):
+    sent, texts, loads = confirm(monkeypatch, None)
+
+    assert len(sent) == 1
+    assert texts == [] and loads == 0
+
+
+def test_evicted_user_only_gets_the_notification(monkeypatch):
+    sent, texts, _ = confirm(monkeypatch, "wallet", evicted=True)
+
+    assert len(sent) == 1 and texts == []
+
+
+def test_refresh_waits_for_the_running_update(monkeypatch):
+    # The update moved the user on to another screen before the refresh got its turn
+    sent, texts, _ = confirm(monkeypatch, "wallet", busy="send-address")
+
+    assert len(sent) == 1 and texts == []
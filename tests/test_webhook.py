@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from telegram.ext import Application
+
+from bot.webhook import SECRET_HEADER, create_webhook_app, webhook_receiver, webhook_secret
+
+SECRET = "test-secret"
+
+# A callback query as Telegram posts it, the kind of update that moves funds
+UPDATE = {
+    "update_id": 1001,
+    "callback_query": {
+        "id": "4382",
+        "from": {"id": 12345, "is_bot": False, "first_name": "Alice"},
+        "chat_instance": "-8113",
+        "data": "send-confirm",
+        "message": {
+            "message_id": 7,
+            "date": 1700000000,
+            "chat": {"id": 12345, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "Wallet"},
+            "text": ".",
+        },
+    },
+}
+
+
+async def post(app, headers=None):
+    async with TestClient(TestServer(app)) as client:
+        response = await client.post("/webhook", json=UPDATE, headers=headers or {})
+        return response.status
+
+
+def test_update_with_secret_is_queued():
+    application = Application.builder().token("1:test").build()
+    status = asyncio.run(post(create_webhook_app(application, SECRET), {SECRET_HEADER: SECRET}))
+
+    assert status == 200
+    update = application.update_queue.get_nowait()
+    assert update.callback_query.data == "send-confirm"
+
+
+@pytest.mark.parametrize("headers", [None, {SECRET_HEADER: "wrong"}, {SECRET_HEADER: ""}])
+def test_update_without_secret_is_refused(headers):
+    application = Application.builder().token("1:test").build()
+    status = asyncio.run(post(create_webhook_app(application, SECRET), headers))
+
+    assert status == 403
+    assert application.update_queue.empty()
+
+
+def test_receiver_requires_secret():
+    with pytest.raises(ValueError):
+        webhook_receiver(lambda data: None, None)
+    with pytest.raises(ValueError):
+        webhook_receiver(lambda data: None, "")
+
+
+def test_webhook_secret():
+    assert webhook_secret(SECRET) == SECRET
+    # Generated when the webhook is set by the bot itself, refused otherwise
+    assert webhook_secret(None, "https://example.com/webhook")
+    with pytest.raises(ValueError):
+        webhook_secret(None)